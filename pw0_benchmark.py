@@ -0,0 +1,282 @@
+'''
+    Benchmarks of the conversion pipeline on synthetic layers at real LCD resolutions:
+
+        python pw0_benchmark.py                           all patterns and stages on a Mono 4 LCD
+        python pw0_benchmark.py -r m3plus -p dense        one pattern on another LCD
+        python pw0_benchmark.py --save-baseline base.json
+        python pw0_benchmark.py --baseline base.json      exits with 1 if a stage got slower
+
+    Every case runs in a fresh process, so the reported peak RSS belongs to that case.
+    Before timing, the fast encoders, the decoder and the bitmap operations are checked
+    against the reference implementations, any difference makes the run fail.
+'''
+
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageOps
+
+import pw0_utils
+from pw0_bitmap import PackedBitmap
+from pw0_file import HeaderSection, LayerDef, LayerDefSection, PW0File
+from pw0_trace import peak_rss_mb
+
+
+RESOLUTIONS = {
+    'mono4': (9024, 5120),
+    'm3plus': (5760, 3600),
+    'mono': (1620, 2560),
+}
+PATTERNS = ('blank', 'sparse', 'dense', 'checkerboard')
+STAGES = ('encode', 'encode_stream', 'encode_reference', 'decode', 'transform', 'binarize', 'center', 'pad', 'patch')
+DEFAULT_STAGES = tuple(stage for stage in STAGES if stage != 'encode_reference')  # pure Python, minutes per layer
+
+
+def make_layer(pattern, resolution, seed=0):
+    # Synthetic layer as a PackedBitmap, the same pattern and seed always give the same bitmap
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    if pattern == 'blank':
+        return PackedBitmap.blank(width, height, white=False)
+
+    if pattern == 'checkerboard':   # every pixel is its own run, the worst case for RLL
+        bitmap = PackedBitmap.blank(width, height)
+        bitmap.bits[0::2] = 0xAA
+        bitmap.bits[1::2] = 0x55
+        return bitmap
+
+    image = Image.new('1', resolution, 1 if pattern == 'sparse' else 0)
+    draw = ImageDraw.Draw(image)
+    area = width * height
+    if pattern == 'sparse':     # thin traces on an empty board
+        for _ in range(area // 40000):
+            x, y = rng.integers(0, width), rng.integers(0, height)
+            length, trace = rng.integers(50, 1500), rng.integers(4, 16)
+            if rng.random() < 0.5:
+                draw.rectangle([x, y, x + length, y + trace], fill=0)
+            else:
+                draw.rectangle([x, y, x + trace, y + length], fill=0)
+            draw.ellipse([x - trace, y - trace, x + 2 * trace, y + 2 * trace], fill=0)
+    elif pattern == 'dense':    # ground pour with clearances around pads and traces
+        for _ in range(area // 5000):
+            x, y = rng.integers(0, width), rng.integers(0, height)
+            w, h = rng.integers(8, 80, size=2)
+            draw.rectangle([x, y, x + w, y + h], fill=1)
+            draw.rectangle([x + 4, y + 4, x + w - 4, y + h - 4], fill=0)
+    else:
+        raise ValueError(f"Unknown pattern {pattern}")
+    return PackedBitmap.from_image(image)
+
+
+def section(name, body):
+    return name.encode('ascii').ljust(12, b'\0') + struct.pack('<I', len(body)) + body
+
+
+def write_template(file_path, resolution, pixel_size=17.0, exposure_time=2.0):
+    # Minimal one-layer printer file with the sections PW0File needs
+    mark_size = 20 + 4 * 4
+    header = bytearray(HeaderSection.resolution_y.offset + 4 - 16)
+    struct.pack_into('<f', header, HeaderSection.pixel_size.offset - 16, pixel_size)
+    struct.pack_into('<f', header, HeaderSection.exposure_time.offset - 16, exposure_time)
+    struct.pack_into('<II', header, HeaderSection.resolution_x.offset - 16, *resolution)
+    header = section('HEADER', bytes(header))
+    machine = section('MACHINE', b'Benchmark'.ljust(96, b'\0') + b'pw0Img'.ljust(16, b'\0'))
+
+    header_addr = mark_size
+    machine_addr = header_addr + len(header)
+    layer_def_addr = machine_addr + len(machine)
+    image_addr = layer_def_addr + LayerDefSection.table_offset + LayerDef.size
+    layer = bytearray(LayerDef.size)
+    struct.pack_into('<I', layer, LayerDef.img_data_addr.offset, image_addr)
+    struct.pack_into('<f', layer, LayerDef.exposure_time.offset, exposure_time)
+    layer_def = section('LAYERDEF', struct.pack('<I', 1) + bytes(layer))
+
+    mark = b'ANYCUBIC'.ljust(12, b'\0') + struct.pack('<II', 516, 3)
+    mark += struct.pack('<4I', header_addr, machine_addr, layer_def_addr, 0)
+    with open(file_path, 'wb') as file:
+        file.write(mark + header + machine + layer_def)
+
+
+def prepare_stage(stage, bitmap, work_dir):
+    # Returns the function that is timed, everything it needs is made here
+    resolution = bitmap.size
+    if stage == 'encode':
+        return lambda: pw0_utils.rll_encode_image_np(bitmap)
+    if stage == 'encode_stream':
+        return lambda: sum(len(chunk) for chunk, _ in pw0_utils.rll_encode_stream(bitmap))
+    if stage == 'encode_reference':
+        image = bitmap.to_image().convert('L')
+        return lambda: pw0_utils.rll_encode_image(image)
+    if stage == 'decode':
+        rll_data, rll_size, white_pixel_count = pw0_utils.rll_encode_image_np(bitmap)
+        data = bytes(rll_data)
+        return lambda: pw0_utils.rll_decode(data, 0, rll_size, white_pixel_count, resolution)
+    if stage == 'transform':
+        rll_result = pw0_utils.rll_encode_image_np(bitmap)
+        return lambda: pw0_utils.rll_transform(rll_result, resolution, True, True)
+    if stage == 'binarize':
+        image = bitmap.to_image().convert('RGBA')
+        return lambda: pw0_utils.binarize_image(image)
+    if stage == 'center':
+        return lambda: pw0_utils.center_image(bitmap)
+    if stage == 'pad':
+        board = bitmap.crop((0, 0, resolution[0] // 2, resolution[1] // 2))
+        return lambda: pw0_utils.pad_image(board, resolution)
+    if stage == 'patch':
+        template = os.path.join(work_dir, 'template.pwmb')
+        write_template(template, resolution)
+        with PW0File(template) as printer_file:
+            layer_data = printer_file.layer_data()
+            exp_time_addr2 = printer_file.display_properties()[3]
+        rll_result = pw0_utils.rll_encode_image_np(bitmap)
+        file_out = os.path.join(work_dir, 'patched.pwmb')
+        return lambda: pw0_utils.patch_pw0(template, layer_data, rll_result, exp_time_addr2, 2.0, file_out=file_out)
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def run_case(pattern, stage, resolution, repeats):
+    # Runs in its own process, returns the best time and the peak RSS of the process
+    bitmap = make_layer(pattern, resolution)
+    with tempfile.TemporaryDirectory() as work_dir, redirect_stdout(io.StringIO()):   # the pipeline prints its stages
+        run = prepare_stage(stage, bitmap, work_dir)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    seconds = min(times)
+    return {'seconds': seconds, 'mpix_s': resolution[0] * resolution[1] / seconds / 1e6, 'peak_rss_mb': peak_rss_mb()}
+
+
+def check_pattern(pattern, resolution, check_rows):
+    # Differential checks against the reference implementations, returns a list of failures
+    failures = []
+    bitmap = make_layer(pattern, resolution)
+    strip = bitmap.crop((0, 0, bitmap.width, min(check_rows, bitmap.height)))
+    strip_image = strip.to_image().convert('L')
+
+    with redirect_stdout(io.StringIO()):
+        reference = pw0_utils.rll_encode_image(strip_image)
+        fast = pw0_utils.rll_encode_image_np(strip)
+        fast_image = pw0_utils.rll_encode_image_np(strip_image)
+        full = pw0_utils.rll_encode_image_np(bitmap)
+        chunks = list(pw0_utils.rll_encode_stream(bitmap))
+        decoded = pw0_utils.rll_decode(bytes(full[0]), 0, full[1], full[2], bitmap.size)
+        padded = pw0_utils.pad_image(strip, (strip.width + 37, strip.height + 5))
+        padded_rll = [pw0_utils.rll_encode_image_np(padded), pw0_utils.rll_encode_image_np(padded.to_bitmap())]
+        transformed = {(invert, mirror): [pw0_utils.rll_transform(fast, strip.size, invert, mirror),
+                                          pw0_utils.rll_encode_image_np(pw0_utils.transform_image(strip, invert, mirror))]
+                       for invert in (False, True) for mirror in (False, True)}
+
+    if bytes(fast[0]) != bytes(reference[0]) or fast[2] != reference[2]:
+        failures.append("rll_encode_image_np(PackedBitmap) differs from rll_encode_image()")
+    if bytes(fast_image[0]) != bytes(reference[0]) or fast_image[2] != reference[2]:
+        failures.append("rll_encode_image_np(Image) differs from rll_encode_image()")
+    if b''.join(chunk for chunk, _ in chunks) != bytes(full[0]) or sum(white for _, white in chunks) != full[2]:
+        failures.append("rll_encode_stream() differs from rll_encode_image_np()")
+
+    if bytes(padded_rll[0][0]) != bytes(padded_rll[1][0]) or padded_rll[0][2] != padded_rll[1][2]:
+        failures.append("rll_encode_image_np(VirtualCanvas) differs from encoding the flattened canvas")
+    for (invert, mirror), (runs, encoded) in transformed.items():
+        if bytes(runs[0]) != bytes(encoded[0]) or runs[2] != encoded[2]:
+            failures.append(f"rll_transform(invert={invert}, mirror={mirror}) differs from encoding the transformed image")
+
+    # The encoder drops the last run, the decoder has to restore it from the white pixel count
+    if not np.array_equal(decoded, bitmap.unpack_rows(0, bitmap.height) * np.uint8(0xFF)):
+        failures.append("rll_decode() doesn't give back the encoded image")
+
+    if strip.invert().to_image() != ImageOps.invert(strip_image).convert('1'):
+        failures.append("PackedBitmap.invert() differs from ImageOps.invert()")
+    if strip.mirror().to_image() != strip.to_image().transpose(Image.FLIP_LEFT_RIGHT):
+        failures.append("PackedBitmap.mirror() differs from Image.transpose()")
+    size = (strip.width * 2 // 3, strip.height * 3 // 2)
+    if strip.resize(size).to_image() != strip.to_image().resize(size, Image.NEAREST):
+        failures.append("PackedBitmap.resize() differs from Image.resize(NEAREST)")
+    return failures
+
+
+def parse_resolution(value):
+    if value in RESOLUTIONS:
+        return RESOLUTIONS[value]
+    try:
+        width, height = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(RESOLUTIONS)} or WxH")
+    return (width, height)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the PW0 conversion pipeline on synthetic layers")
+    parser.add_argument('-r', '--resolution', type=parse_resolution, default='mono4',
+                        help=f"LCD resolution: {', '.join(RESOLUTIONS)} or WxH")
+    parser.add_argument('-p', '--patterns', nargs='+', choices=PATTERNS, default=PATTERNS)
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=DEFAULT_STAGES)
+    parser.add_argument('-n', '--repeats', type=int, default=3, help="runs per case, the best one counts")
+    parser.add_argument('--check-rows', type=int, default=64,
+                        help="rows compared against the reference encoder, it's pure Python")
+    parser.add_argument('--no-check', action='store_true', help="skip the differential checks")
+    parser.add_argument('--save-baseline', metavar='FILE', help="store the results as a baseline")
+    parser.add_argument('--baseline', metavar='FILE', help="compare the results with a baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown against the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    resolution = options.resolution
+    print(f"LCD {resolution[0]}x{resolution[1]}, {resolution[0] * resolution[1] / 1e6:.1f} MPix")
+
+    if not options.no_check:
+        failures = []
+        for pattern in options.patterns:
+            failures += [f"{pattern}: {failure}" for failure in check_pattern(pattern, resolution, options.check_rows)]
+        for failure in failures:
+            print(f"CHECK FAILED {failure}")
+        if failures:
+            return 1
+        print("Output matches the reference implementations")
+
+    results = {}
+    print(f"\n{'case':32} {'time, s':>9} {'MPix/s':>9} {'peak RSS, MB':>13}")
+    for pattern in options.patterns:
+        for stage in options.stages:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_case, pattern, stage, resolution, options.repeats).result()
+            case = f"{resolution[0]}x{resolution[1]}/{pattern}/{stage}"
+            results[case] = result
+            rss = f"{result['peak_rss_mb']:.0f}" if result['peak_rss_mb'] is not None else '-'
+            print(f"{pattern + '/' + stage:32} {result['seconds']:9.3f} {result['mpix_s']:9.1f} {rss:>13}")
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as file:
+            baseline = json.load(file)
+        for case, result in results.items():
+            if case in baseline and result['seconds'] > baseline[case]['seconds'] * (1 + options.tolerance):
+                regressions.append(f"{case}: {result['seconds']:.3f} s, baseline {baseline[case]['seconds']:.3f} s")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+    if options.save_baseline:
+        baseline = {}
+        if os.path.exists(options.save_baseline):   # keep the cases that weren't run this time
+            with open(options.save_baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with pw0_utils.atomic_write(options.save_baseline) as file:
+            file.write(json.dumps(baseline, indent=2, sort_keys=True).encode())
+        print(f"\nBaseline saved to {options.save_baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
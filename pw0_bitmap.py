@@ -0,0 +1,333 @@
+'''
+    1 bpp bitmap used between binarization and encoding.
+
+    Rows are packed MSB first and padded to whole bytes, which is the same layout
+    PIL uses for mode '1' images. A set bit is a white pixel. Operations that need
+    single pixels unpack at most BAND_ROWS rows at a time.
+
+    VirtualCanvas is an LCD-sized bitmap that only keeps the bitmaps placed on it,
+    so centering or moving a board doesn't copy the frame and the encoder gets the
+    blank margins as runs.
+'''
+
+import numpy as np
+from PIL import Image
+
+
+BAND_ROWS = 256
+BIT_REVERSE = np.array([int(f'{i:08b}'[::-1], 2) for i in range(256)], dtype=np.uint8)
+
+
+def nearest_indices(src_size, dst_size):
+    # Source index for every destination pixel, matches PIL's Image.NEAREST resize.
+    # PIL adds the step up one pixel at a time, so the float rounding is repeated exactly
+    steps = np.full(dst_size, src_size / dst_size)
+    steps[0] *= 0.5
+    return np.add.accumulate(steps).astype(np.intp)
+
+
+class PackedBitmap:
+    __slots__ = ('bits', 'width', 'height')
+
+    def __init__(self, bits, width, height):
+        self.bits = bits
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def blank(cls, width, height, white=True):
+        bits = np.full((height, (width + 7) // 8), 0xFF if white else 0, dtype=np.uint8)
+        return cls(bits, width, height)
+
+    @classmethod
+    def from_array(cls, pixels):
+        # pixels is a 2D array, non-zero values become white
+        height, width = pixels.shape
+        return cls(np.packbits(pixels.astype(bool), axis=1), width, height)
+
+    @classmethod
+    def from_image(cls, image, threshold=128):
+        if image.mode != '1':
+            image = image.convert('L').point(lambda p: 255 if p >= threshold else 0, '1')
+        bits = np.frombuffer(bytearray(image.tobytes()), dtype=np.uint8)
+        return cls(bits.reshape(image.height, -1), image.width, image.height)
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_image(self):
+        return Image.frombytes('1', self.size, np.ascontiguousarray(self.bits).tobytes())
+
+    def unpack_rows(self, top, bottom):
+        # Returns rows top..bottom as a 2D array of 0 and 1
+        return np.unpackbits(self.bits[top:bottom], axis=1, count=self.width)
+
+    def set_rows(self, top, pixels):
+        self.bits[top:top + pixels.shape[0]] = np.packbits(pixels.astype(bool), axis=1)
+
+    def row_blocks(self, block_rows=BAND_ROWS):
+        # Flat blocks of 0/255 pixels in image order, the form rll_encode_blocks() takes
+        for top in range(0, self.height, block_rows):
+            yield (self.unpack_rows(top, top + block_rows) * np.uint8(0xFF)).ravel()
+
+    def getbbox(self):
+        # Bounding box of the black pixels, like ImageOps.invert(image).getbbox()
+        if self.width == 0 or self.height == 0:
+            return None
+        black = ~self.bits
+        black[:, -1] &= np.uint8((0xFF << (-self.width % 8)) & 0xFF)  # ignore row padding
+        rows = np.flatnonzero(black.any(axis=1))
+        if rows.size == 0:
+            return None
+        columns = np.bitwise_or.reduce(black[rows[0]:rows[-1] + 1], axis=0)
+        columns = np.flatnonzero(np.unpackbits(columns, count=self.width))
+        return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+    def crop(self, box):
+        left, top, right, bottom = box
+        cropped = PackedBitmap.blank(right - left, bottom - top)
+        for band_top in range(top, bottom, BAND_ROWS):
+            band_bottom = min(band_top + BAND_ROWS, bottom)
+            cropped.set_rows(band_top - top, self.unpack_rows(band_top, band_bottom)[:, left:right])
+        return cropped
+
+    def paste(self, bitmap, position, op=None):
+        # Pastes bitmap in place, it has to fit inside this one.
+        # op combines the pixels instead of replacing them, e.g. np.logical_and
+        x, y = position
+        if x < 0 or y < 0 or x + bitmap.width > self.width or y + bitmap.height > self.height:
+            raise ValueError("Pasted bitmap is out of bounds")
+        for band_top in range(0, bitmap.height, BAND_ROWS):
+            band_bottom = min(band_top + BAND_ROWS, bitmap.height)
+            rows = self.unpack_rows(y + band_top, y + band_bottom)
+            pasted = bitmap.unpack_rows(band_top, band_bottom)
+            rows[:, x:x + bitmap.width] = pasted if op is None else op(rows[:, x:x + bitmap.width], pasted)
+            self.set_rows(y + band_top, rows)
+
+    def invert(self):
+        return PackedBitmap(~self.bits, self.width, self.height)
+
+    def mirror(self):
+        # Reverse the bytes and the bits in them, then shift the row padding back to the end
+        reversed_bits = BIT_REVERSE[self.bits[:, ::-1]]
+        padding = -self.width % 8
+        if padding:
+            carry = np.zeros_like(reversed_bits)
+            carry[:, :-1] = reversed_bits[:, 1:] >> (8 - padding)
+            reversed_bits = (reversed_bits << padding) | carry
+        return PackedBitmap(reversed_bits, self.width, self.height)
+
+    def resize(self, size):
+        # Nearest neighbour scaling, same result as PIL's Image.NEAREST
+        width, height = size
+        columns = nearest_indices(self.width, width)
+        rows = nearest_indices(self.height, height)
+        resized = PackedBitmap.blank(width, height)
+        for band_top in range(0, height, BAND_ROWS):
+            band_rows = rows[band_top:band_top + BAND_ROWS]
+            source = self.unpack_rows(band_rows[0], band_rows[-1] + 1)
+            resized.set_rows(band_top, source[band_rows - band_rows[0]][:, columns])
+        return resized
+
+    def reduce(self, factor):
+        # Box-averaged 8-bit image, every output pixel covers factor x factor pixels.
+        # Edges that don't fill a whole box are padded with white
+        width = -(-self.width // factor)
+        height = -(-self.height // factor)
+        band_rows = max(BAND_ROWS // factor, 1) * factor
+        reduced = np.empty((height, width), dtype=np.uint8)
+        for band_top in range(0, self.height, band_rows):
+            rows = self.unpack_rows(band_top, band_top + band_rows)
+            boxes = np.ones((-(-rows.shape[0] // factor) * factor, width * factor), dtype=np.uint8)
+            boxes[:rows.shape[0], :self.width] = rows
+            white = boxes.reshape(-1, factor, width, factor).sum(axis=(1, 3), dtype=np.uint32)
+            reduced[band_top // factor:band_top // factor + white.shape[0]] = white * 255 // (factor * factor)
+        return Image.fromarray(reduced, 'L')
+
+
+def merge_runs(values, lengths):
+    # Drops empty runs and joins neighbours of the same value
+    keep = lengths > 0
+    values, lengths = values[keep], lengths[keep]
+    if values.size == 0:
+        return [values, lengths]
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return [values[starts], np.add.reduceat(lengths, starts)]
+
+
+class VirtualCanvas:
+    '''
+            A width x height bitmap made of PackedBitmaps placed at offsets on a white
+            or black background. Reads like a PackedBitmap, but only the placed
+            bitmaps take memory and only their rows are ever unpacked
+    '''
+
+    __slots__ = ('width', 'height', 'white', 'items')
+
+    def __init__(self, width, height, white=True):
+        self.width = width
+        self.height = height
+        self.white = white
+        self.items = []     # [bitmap, (x, y)], later ones cover earlier ones
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def nbytes(self):
+        return sum(bitmap.nbytes for bitmap, _ in self.items)
+
+    def place(self, bitmap, position):
+        x, y = position
+        if x < 0 or y < 0 or x + bitmap.width > self.width or y + bitmap.height > self.height:
+            raise ValueError("Placed bitmap is out of bounds")
+        if bitmap.width and bitmap.height:
+            self.items.append([bitmap, (x, y)])
+
+    def row_pieces(self, top, bottom):
+        # [x, 0/1 pixels] of the placed bitmaps in rows top..bottom, bitmaps that overlap
+        # horizontally share a piece. Everything outside the pieces is background
+        groups = []
+        for index, (bitmap, (x, y)) in sorted(enumerate(self.items), key=lambda item: item[1][1][0]):
+            if y >= bottom or y + bitmap.height <= top:
+                continue
+            if groups and x < groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], x + bitmap.width)
+                groups[-1][2].append(index)
+            else:
+                groups.append([x, x + bitmap.width, [index]])
+
+        pieces = []
+        for left, right, indices in groups:
+            pixels = np.full((bottom - top, right - left), int(self.white), dtype=np.uint8)
+            for index in sorted(indices):
+                bitmap, (x, y) = self.items[index]
+                row_top, row_bottom = max(top, y), min(bottom, y + bitmap.height)
+                pixels[row_top - top:row_bottom - top, x - left:x - left + bitmap.width] = \
+                    bitmap.unpack_rows(row_top - y, row_bottom - y)
+            pieces.append([left, pixels])
+        return pieces
+
+    def unpack_rows(self, top, bottom):
+        bottom = min(bottom, self.height)
+        rows = np.full((max(bottom - top, 0), self.width), int(self.white), dtype=np.uint8)
+        for x, pixels in self.row_pieces(top, bottom):
+            rows[:, x:x + pixels.shape[1]] = pixels
+        return rows
+
+    def row_blocks(self, block_rows=BAND_ROWS):
+        for top in range(0, self.height, block_rows):
+            yield (self.unpack_rows(top, top + block_rows) * np.uint8(0xFF)).ravel()
+
+    def run_blocks(self, block_rows=BAND_ROWS):
+        '''
+                [values, lengths] of the 0/255 runs of every block of rows, the form
+                pw0_utils.rll_encode_runs() takes. Only the placed bitmaps are unpacked,
+                the margins around them are added as runs
+        '''
+
+        background = np.uint8(0xFF if self.white else 0)
+        for top in range(0, self.height, block_rows):
+            bottom = min(top + block_rows, self.height)
+            pieces = self.row_pieces(top, bottom)
+            if not pieces:
+                yield [np.array([background]), np.array([(bottom - top) * self.width], dtype=np.int64)]
+                continue
+
+            lefts = np.array([x for x, _ in pieces])
+            widths = np.array([pixels.shape[1] for _, pixels in pieces])
+            stacked = np.hstack([pixels for _, pixels in pieces]) * np.uint8(0xFF)
+            stacked_width = stacked.shape[1]
+            piece_starts = np.cumsum(widths) - widths
+
+            # Runs of the pieces side by side, cut where every piece starts in every row
+            flat = stacked.ravel()
+            cuts = np.empty(flat.size, dtype=bool)
+            cuts[0] = True
+            np.not_equal(flat[1:], flat[:-1], out=cuts[1:])
+            cuts.reshape(stacked.shape)[:, piece_starts] = True
+            starts = np.flatnonzero(cuts)
+            values = flat[starts]
+            lengths = np.diff(np.append(starts, flat.size))
+
+            # Background in front of every piece, the first one of a row also gets the end of the previous row
+            ends = lefts + widths
+            gaps = lefts - np.concatenate(([0], ends[:-1]))
+            trailing = self.width - int(ends[-1])
+            columns = starts % stacked_width
+            at_piece = np.flatnonzero(np.isin(columns, piece_starts))
+            piece_ids = np.searchsorted(piece_starts, columns[at_piece])
+            gap_lengths = gaps[piece_ids]
+            gap_lengths[(piece_ids == 0) & (starts[at_piece] >= stacked_width)] += trailing
+
+            values = np.append(np.insert(values, at_piece, background), background)
+            lengths = np.append(np.insert(lengths, at_piece, gap_lengths), trailing)
+            yield merge_runs(values, lengths)
+
+    def getbbox(self):
+        # Bounding box of the black pixels, assumes placed bitmaps don't cover each other's black pixels
+        if not self.white:
+            return (0, 0, self.width, self.height) if self.width and self.height else None
+        boxes = []
+        for bitmap, (x, y) in self.items:
+            bbox = bitmap.getbbox()
+            if bbox:
+                boxes.append((bbox[0] + x, bbox[1] + y, bbox[2] + x, bbox[3] + y))
+        if not boxes:
+            return None
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+    def crop(self, box):
+        left, top, right, bottom = box
+        cropped = PackedBitmap.blank(right - left, bottom - top, self.white)
+        for band_top in range(top, bottom, BAND_ROWS):
+            band_bottom = min(band_top + BAND_ROWS, bottom)
+            rows = np.full((band_bottom - band_top, right - left), int(self.white), dtype=np.uint8)
+            for x, pixels in self.row_pieces(band_top, band_bottom):
+                piece_left, piece_right = max(x, left), min(x + pixels.shape[1], right)
+                if piece_left < piece_right:
+                    rows[:, piece_left - left:piece_right - left] = pixels[:, piece_left - x:piece_right - x]
+            cropped.set_rows(band_top - top, rows)
+        return cropped
+
+    def to_bitmap(self):
+        return self.crop((0, 0, self.width, self.height))
+
+    def to_image(self):
+        return self.to_bitmap().to_image()
+
+    def invert(self):
+        canvas = VirtualCanvas(self.width, self.height, not self.white)
+        canvas.items = [[bitmap.invert(), position] for bitmap, position in self.items]
+        return canvas
+
+    def mirror(self):
+        canvas = VirtualCanvas(self.width, self.height, self.white)
+        canvas.items = [[bitmap.mirror(), (self.width - x - bitmap.width, y)] for bitmap, (x, y) in self.items]
+        return canvas
+
+    def reduce(self, factor):
+        # Preview of PackedBitmap.reduce(), placed bitmaps are reduced on their own and
+        # pasted at the nearest box, so their edges may be off by a fraction of a box
+        width = -(-self.width // factor)
+        height = -(-self.height // factor)
+        reduced = Image.new('L', (width, height), 255 if self.white else 0)
+        for bitmap, (x, y) in self.items:
+            reduced.paste(bitmap.reduce(factor), (x // factor, y // factor))
+        return reduced
+
+
+def preview_pyramid(bitmap, max_size=2048, min_size=256):
+    # Downsampled 8-bit previews, largest first, each level is half the size of the previous one
+    factor = max(-(-max(bitmap.size) // max_size), 1)
+    levels = [bitmap.reduce(factor)]
+    while max(levels[-1].size) > min_size and min(levels[-1].size) > 1:
+        levels.append(levels[-1].reduce(2))
+    return levels
@@ -0,0 +1,195 @@
+'''
+    On-disk render cache.
+
+    Entries are keyed by a SHA-256 over the input file contents and the render
+    parameters, so renaming or touching a file doesn't invalidate them.
+    Rendered canvases (only the placed bitmaps and their offsets, see
+    VirtualCanvas), single Gerber layers and RLL streams are stored as separate
+    files, the least recently used ones are removed once the cache grows over
+    max_size bytes.
+'''
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+from pw0_bitmap import PackedBitmap, VirtualCanvas
+from pw0_utils import atomic_write
+
+
+CACHE_VERSION = 3   # bump when the render pipeline starts producing different bitmaps
+BITMAP_EXT = '.bitmap'
+RLL_EXT = '.rll'
+LAYER_EXT = '.layer'
+
+_file_hashes = {}   # (path, size, mtime) -> content hash, saves rehashing within one process
+
+
+def file_digest(file_path):
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(memo_key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        digest = _file_hashes[memo_key] = sha.hexdigest()
+    return digest
+
+
+def derived_key(key, **params):
+    # Key of something computed from a cached entry, e.g. the RLL stream of a transformed bitmap
+    return hashlib.sha256(json.dumps([key, params], sort_keys=True).encode()).hexdigest()
+
+
+class RenderCache:
+    __slots__ = ('cache_dir', 'max_size')
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_paths, params):
+        # The order of the files doesn't matter, the Gerber renderer sorts them anyway
+        sha = hashlib.sha256(str(CACHE_VERSION).encode())
+        for digest in sorted(file_digest(path) for path in file_paths):
+            sha.update(digest.encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def _read(self, key, ext):
+        path = self._path(key, ext)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, key, ext, parts):
+        with atomic_write(self._path(key, ext)) as file:
+            for part in parts:
+                file.write(part)
+        self.evict()
+
+    def get_bitmap(self, key):
+        # Always a VirtualCanvas, a PackedBitmap comes back as a canvas with just that bitmap on it
+        data = self._read(key, BITMAP_EXT)
+        if data is None:
+            return None
+        width, height, white, count = struct.unpack_from('<II?I', data)
+        canvas = VirtualCanvas(width, height, white)
+        offset = 13
+        for _ in range(count):
+            x, y, item_width, item_height = struct.unpack_from('<iiII', data, offset)
+            offset += 16
+            size = item_height * ((item_width + 7) // 8)
+            bits = np.frombuffer(bytearray(data[offset:offset + size]), dtype=np.uint8)
+            canvas.place(PackedBitmap(bits.reshape(item_height, -1), item_width, item_height), (x, y))
+            offset += size
+        return canvas
+
+    def put_bitmap(self, key, bitmap):
+        items = bitmap.items if isinstance(bitmap, VirtualCanvas) else [[bitmap, (0, 0)]]
+        parts = [struct.pack('<II?I', bitmap.width, bitmap.height, getattr(bitmap, 'white', True), len(items))]
+        for item, (x, y) in items:
+            parts.append(struct.pack('<iiII', x, y, item.width, item.height))
+            parts.append(np.ascontiguousarray(item.bits).tobytes())
+        self._write(key, BITMAP_EXT, parts)
+
+    def get_layer(self, key):
+        # Same list as pw0_gerber.render_layer() returns
+        data = self._read(key, LAYER_EXT)
+        if data is None:
+            return None
+        width, height, x, y, gerber = struct.unpack_from('<IIii?', data)
+        if width == 0:  # empty layer
+            return [gerber, None, (x, y)]
+        bits = np.frombuffer(bytearray(data[17:]), dtype=np.uint8).reshape(height, (width + 7) // 8)
+        return [gerber, PackedBitmap(bits, width, height), (x, y)]
+
+    def put_layer(self, key, layer):
+        gerber, bitmap, (x, y) = layer
+        if bitmap is None:
+            self._write(key, LAYER_EXT, [struct.pack('<IIii?', 0, 0, x, y, gerber)])
+            return
+        self._write(key, LAYER_EXT, [struct.pack('<IIii?', bitmap.width, bitmap.height, x, y, gerber),
+                                     np.ascontiguousarray(bitmap.bits).tobytes()])
+
+    def get_rll(self, key):
+        # Same list as rll_encode_image_np() returns
+        data = self._read(key, RLL_EXT)
+        if data is None:
+            return None
+        white_pixel_count = struct.unpack_from('<Q', data)[0]
+        rll_data = bytearray(data[8:])
+        return [rll_data, len(rll_data), white_pixel_count]
+
+    def put_rll(self, key, rll_result):
+        self._write(key, RLL_EXT, [struct.pack('<Q', rll_result[2]), rll_result[0]])
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith((BITMAP_EXT, RLL_EXT, LAYER_EXT)):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:   # removed by another process
+                pass
+            total_size -= size
+
+
+def cached_bitmap(cache, file_paths, params, render):
+    # Returns [bitmap, key], render() only runs on a cache miss. Works without a cache too
+    if cache is None:
+        return [render(), None]
+
+    key = cache.key(file_paths, params)
+    bitmap = cache.get_bitmap(key)
+    if bitmap is not None:
+        print('\n---LOADED FROM RENDER CACHE---')
+        return [bitmap, key]
+
+    bitmap = render()
+    cache.put_bitmap(key, bitmap)
+    return [bitmap, key]
+
+
+def cached_rll_chunks(cache, key, encode):
+    # Yields the cached RLL stream, or the one encode() produces while storing it on the way
+    if cache is None or key is None:
+        yield from encode()
+        return
+
+    rll_result = cache.get_rll(key)
+    if rll_result is not None:
+        print('\n---LOADED RLL FROM RENDER CACHE---')
+        yield [rll_result[0], rll_result[2]]
+        return
+
+    rll_chunks = []
+    white_pixel_count = 0
+    for rll_chunk, chunk_white_pixels in encode():
+        rll_chunks.append(rll_chunk)
+        white_pixel_count += chunk_white_pixels
+        yield [rll_chunk, chunk_white_pixels]
+
+    rll_data = b''.join(rll_chunks)
+    cache.put_rll(key, [rll_data, len(rll_data), white_pixel_count])
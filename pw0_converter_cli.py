@@ -0,0 +1,373 @@
+'''
+    Headless batch converter, every input set is converted in its own worker process:
+
+        python pw0_converter_cli.py -t printer_file.pwmb top.gbr,drill.drl bottom.gbr,drill.drl board.svg
+
+    An input set is a comma separated list of files or a directory with Gerber/Excellon files.
+    With --panel all sets (and --copies of each) are packed onto the LCD and written to one file.
+    With --layers every set becomes a layer of one file, in order, e.g. copper, solder mask, silkscreen.
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pw0_cache
+import pw0_format
+import pw0_panel
+import pw0_profiles
+import pw0_trace
+import pw0_utils
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Convert Gerber/Excellon, SVG and PNG files to Anycubic PW0 printer files")
+    parser.add_argument('input_sets', nargs='+', metavar='SET',
+                        help="comma separated input files or a directory, one printer file is written per set")
+    parser.add_argument('-t', '--template', required=True, help="one-layer printer file to patch")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory for the patched printer files")
+    parser.add_argument('-g', '--gerbv', default=shutil.which('gerbv'),
+                        help="path to the gerbv executable, used for Gerber files the native renderer can't handle")
+    parser.add_argument('--renderer', choices=('native', 'gerbv'), default='native', help="Gerber/Excellon renderer")
+    parser.add_argument('-e', '--exposure', type=float, help="exposure time in seconds, default is taken from the template")
+    parser.add_argument('--size', type=float, nargs=2, metavar=('W', 'H'), help="PCB size in mm (for SVGs and PNGs)")
+    parser.add_argument('--source-dpi', type=float, help="source image DPI (for PNGs)")
+    parser.add_argument('--invert', action='store_true', help="invert image")
+    parser.add_argument('--mirror', action='store_true', help="mirror image horizontally")
+    parser.add_argument('--debug-dir', help="keep intermediate SVG/PNG files of every job in this directory")
+    parser.add_argument('--band-rows', type=int, metavar='N',
+                        help="render Gerber/SVG in bands of N rows and encode them as they come, "
+                             "peak memory is bounded by N instead of the LCD size")
+    parser.add_argument('--cache-dir', help="render cache directory, repeated jobs skip rendering and encoding")
+    parser.add_argument('--cache-size', type=float, default=1024, metavar='MB', help="render cache size limit")
+    parser.add_argument('--panel', action='store_true', help="pack all sets onto the LCD and write one printer file")
+    parser.add_argument('--copies', type=int, default=1, metavar='N', help="copies of every set on the panel")
+    parser.add_argument('--gap', type=float, default=2.0, metavar='MM', help="space between boards on the panel")
+    parser.add_argument('--layers', action='store_true', help="write the sets as the layers of one printer file")
+    parser.add_argument('--layer-exposures', type=float, nargs='+', metavar='SEC',
+                        help="exposure time of every layer with --layers, default is --exposure for all")
+    parser.add_argument('--ladder', type=float, nargs=3, metavar=('START', 'STEP', 'COUNT'),
+                        help="exposure calibration series, one printer file per exposure time instead of --exposure")
+    parser.add_argument('--ladder-layers', action='store_true',
+                        help="write the exposure series as one printer file, every layer exposes one strip of the board")
+    parser.add_argument('--trace', metavar='FILE', help="append per-stage timing and memory records to a JSON lines file")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="number of worker processes")
+    return parser.parse_args(argv)
+
+
+def expand_input_set(input_set):
+    if os.path.isdir(input_set):
+        return sorted(os.path.join(input_set, name) for name in os.listdir(input_set)
+                      if os.path.isfile(os.path.join(input_set, name)))
+    return [path for path in input_set.split(',') if path]
+
+
+def job_name(input_set):
+    name = os.path.basename(os.path.normpath(input_set.split(',')[0]))
+    return os.path.splitext(name)[0]
+
+
+def pcb_size_option(options, printer):
+    if options.size is None:
+        raise ValueError("PCB size not specified")
+    pcb_size = options.size
+    if pcb_size[0] <= 0 or pcb_size[1] <= 0:
+        raise ValueError("PCB size too small")
+    if pcb_size[0] > printer['disp_width'] or pcb_size[1] > printer['disp_height']:
+        raise ValueError("PCB size is larger than printer's display")
+    return pcb_size
+
+
+def render_params(file_paths, kind, options, printer):
+    # Everything the rendered bitmap depends on besides the input files, used as the render cache key
+    params = {'kind': kind, 'resolution': [printer['lcd_h_res'], printer['lcd_v_res']], 'dpi': printer['printer_dpi']}
+    if kind == 'svg':
+        params['size_mm'] = pcb_size_option(options, printer)
+    elif kind == 'png':
+        pcb_size_option(options, printer)
+        if not options.source_dpi:
+            raise ValueError("Source image DPI not specified")
+        params['source_dpi'] = options.source_dpi
+    else:  # if gerber/drl
+        if options.renderer == 'gerbv' and not options.gerbv:
+            raise ValueError("gerbv executable not found")
+        params['renderer'] = options.renderer
+        params['gerbv'] = options.gerbv
+    return params
+
+
+def render_input_set(file_paths, kind, options, printer, debug_dir, cache=None):
+    printer_resolution = [printer['lcd_h_res'], printer['lcd_v_res']]
+    printer_dpi = printer['printer_dpi']
+
+    if kind == 'svg':
+        return pw0_utils.render_svg(options.size, printer_resolution, printer_dpi, file_paths[0], debug_dir)
+    elif kind == 'png':
+        return pw0_utils.render_png(options.size, printer_resolution, printer_dpi, options.source_dpi, file_paths[0], debug_dir)
+    else:  # if gerber/drl
+        # Several jobs already keep the workers busy, their layers are rendered one after another
+        layer_workers = 1 if len(options.input_sets) > 1 and options.jobs > 1 else None
+        return pw0_utils.render_gerber(file_paths, options.gerbv, printer_resolution, printer_dpi, debug_dir,
+                                       options.renderer, layer_workers, cache)[0]
+
+
+def open_cache(options):
+    if not options.cache_dir:
+        return None
+    return pw0_cache.RenderCache(options.cache_dir, int(options.cache_size * 1024 * 1024))
+
+
+def job_debug_dir(options, name):
+    # Every job keeps its intermediate files in its own folder
+    if not options.debug_dir:
+        return None
+    return os.path.join(options.debug_dir, name)
+
+
+def encode_input_set(file_paths, options, printer, debug_dir):
+    # Returns the RLL chunks of the input set, vectors are rendered band by band in band mode
+    printer_resolution = [printer['lcd_h_res'], printer['lcd_v_res']]
+    printer_dpi = printer['printer_dpi']
+    kind = pw0_format.input_kind(file_paths)
+    params = render_params(file_paths, kind, options, printer)
+
+    cache = open_cache(options)
+    rll_key = None
+    if cache is not None:
+        rll_key = pw0_cache.derived_key(cache.key(file_paths, params), invert=options.invert, mirror=options.mirror)
+
+    def encode():
+        if options.band_rows and kind == 'svg':
+            return pw0_utils.encode_svg_bands(options.size, printer_resolution, printer_dpi, file_paths[0],
+                                              options.invert, options.mirror, options.band_rows)
+        if options.band_rows and kind == 'gerber' and options.renderer == 'gerbv':  # native bitmaps are 1 bpp anyway
+            return pw0_utils.encode_gerber_bands(file_paths, options.gerbv, printer_resolution, printer_dpi,
+                                                 options.invert, options.mirror, options.band_rows)
+
+        rendered_img = pw0_cache.cached_bitmap(cache, file_paths, params,
+                lambda: render_input_set(file_paths, kind, options, printer, debug_dir, cache))[0]
+        image = pw0_utils.transform_image(rendered_img, options.invert, options.mirror)
+        if image.size != tuple(printer_resolution):
+            raise ValueError("Source and target resolution mismatch")
+        return pw0_utils.rll_encode_stream(image)
+
+    return pw0_cache.cached_rll_chunks(cache, rll_key, encode)
+
+
+def write_output(options, printer, rll_chunks, file_out):
+    # Patches the template once, or once per exposure time of the ladder
+    if options.ladder:
+        rll_result = pw0_utils.join_rll_chunks(rll_chunks)  # encoded once, shared by every exposure time
+        return pw0_utils.write_exposure_ladder(options.template, printer['layer_data'], rll_result,
+                                               printer['display_properties'], pw0_utils.exposure_ladder(*options.ladder),
+                                               file_out, options.ladder_layers)
+    return [pw0_utils.write_pw0(options.template, printer['layer_data'], rll_chunks,
+                                printer['display_properties'][3], printer['exposure_time'], file_out=file_out)]
+
+
+def convert_job(input_set, options, printer, file_out):
+    # Runs in a worker process: render -> binarize -> encode -> patch
+    start = time.perf_counter()
+    file_paths = expand_input_set(input_set)
+    if not file_paths:
+        raise ValueError("No input files")
+
+    debug_dir = job_debug_dir(options, os.path.splitext(os.path.basename(file_out))[0])
+    rll_chunks = encode_input_set(file_paths, options, printer, debug_dir)
+    write_output(options, printer, rll_chunks, file_out)
+    return time.perf_counter() - start
+
+
+def render_job(input_set, options, printer):
+    # Runs in a worker process with --panel or --layers, returns the rendered bitmap of the set
+    file_paths = expand_input_set(input_set)
+    if not file_paths:
+        raise ValueError("No input files")
+    kind = pw0_format.input_kind(file_paths)
+    params = render_params(file_paths, kind, options, printer)
+    cache = open_cache(options)
+    debug_dir = job_debug_dir(options, job_name(input_set))
+    return pw0_cache.cached_bitmap(cache, file_paths, params,
+            lambda: render_input_set(file_paths, kind, options, printer, debug_dir, cache))[0]
+
+
+def render_sets(options, printer):
+    # Renders the sets in parallel, returns their bitmaps or None if any of them failed
+    bitmaps = [None] * len(options.input_sets)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        jobs = {executor.submit(render_job, input_set, options, printer): index
+                for index, input_set in enumerate(options.input_sets)}
+        for job in as_completed(jobs):
+            input_set = options.input_sets[jobs[job]]
+            try:
+                bitmaps[jobs[job]] = job.result()
+                print(f"OK     {input_set}")
+            except Exception as e:
+                failed += 1
+                print(f"FAILED {input_set}: {e}")
+    if failed:
+        print(f"\n{failed} of {len(jobs)} sets failed, printer file not written")
+        return None
+    return bitmaps
+
+
+def run_panel(options, printer):
+    # Renders the sets in parallel, then packs and encodes them as one image
+    start = time.perf_counter()
+    bitmaps = render_sets(options, printer)
+    if bitmaps is None:
+        return 1
+
+    resolution = [printer['lcd_h_res'], printer['lcd_v_res']]
+    gap = round(options.gap * printer['printer_dpi'] / 25.4)
+    try:
+        panel = pw0_panel.panelize(bitmaps, resolution, gap, options.copies)[0]
+    except ValueError as e:
+        print(f"FAILED panel: {e}")
+        return 1
+
+    _, ext = os.path.splitext(options.template)
+    file_out = os.path.join(options.output_dir, f"{job_name(options.input_sets[0])}_panel{ext}")
+    image = pw0_utils.transform_image(panel, options.invert, options.mirror)
+    write_output(options, printer, pw0_utils.rll_encode_stream(image), file_out)
+    boards = len(bitmaps) * options.copies
+    print(f"\n{boards} boards -> {file_out} ({time.perf_counter() - start:.1f} s)")
+    return 0
+
+
+def run_layers(options, printer):
+    # Renders the sets in parallel and writes them as the layers of one printer file
+    start = time.perf_counter()
+    bitmaps = render_sets(options, printer)
+    if bitmaps is None:
+        return 1
+
+    resolution = (printer['lcd_h_res'], printer['lcd_v_res'])
+    images = [pw0_utils.transform_image(bitmap, options.invert, options.mirror) for bitmap in bitmaps]
+    if any(image.size != resolution for image in images):
+        print("FAILED layers: Source and target resolution mismatch")
+        return 1
+    exposure_times = options.layer_exposures or [printer['exposure_time']] * len(images)
+
+    _, ext = os.path.splitext(options.template)
+    file_out = os.path.join(options.output_dir, f"{job_name(options.input_sets[0])}_layers{ext}")
+    try:
+        pw0_utils.patch_pw0_layers(options.template, printer['layer_data'], pw0_utils.encode_layers(images, options.jobs),
+                                   printer['display_properties'][3], exposure_times, file_out=file_out)
+    except ValueError as e:
+        print(f"FAILED layers: {e}")
+        return 1
+    print(f"\n{len(images)} layers -> {file_out} ({time.perf_counter() - start:.1f} s)")
+    return 0
+
+
+def load_template(template, exposure, cache_dir=None):
+    # The parsed template is kept next to the render cache, a known template isn't opened again
+    profiles_file = os.path.join(cache_dir, 'template_profiles.json') if cache_dir else None
+    profile = pw0_profiles.ProfileStore(profiles_file).get(template)
+    display_properties = profile['display_properties']
+    layer_data = profile['layer_data']
+    lcd_px_size, lcd_h_res, lcd_v_res = display_properties[:3]
+    return {
+        'printer_name': profile['printer_name'],
+        'display_properties': display_properties,
+        'layer_data': layer_data,
+        'lcd_h_res': lcd_h_res,
+        'lcd_v_res': lcd_v_res,
+        'printer_dpi': 25400.0 / lcd_px_size,
+        'disp_width': lcd_h_res * lcd_px_size / 1000,
+        'disp_height': lcd_v_res * lcd_px_size / 1000,
+        'exposure_time': layer_data[0] if exposure is None else exposure,
+    }
+
+
+def output_paths(options):
+    _, ext = os.path.splitext(options.template)
+    paths = []
+    for input_set in options.input_sets:
+        name = job_name(input_set)
+        path = os.path.join(options.output_dir, f"{name}{ext}")
+        suffix = len(paths)
+        while path in paths:  # same board name in several sets, or a set already named like a renamed one
+            path = os.path.join(options.output_dir, f"{name}_{suffix}{ext}")
+            suffix += 1
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.exposure is not None and options.exposure < 0.1:
+        print("Exposure time is too short!")
+        return 2
+
+    if options.copies < 1:
+        print("Number of copies must be at least 1")
+        return 2
+
+    if options.band_rows is not None:
+        if options.band_rows < 1:
+            print("Number of band rows must be at least 1")
+            return 2
+        if options.panel or options.layers:  # both render whole bitmaps
+            print("--band-rows can't be combined with --panel or --layers")
+            return 2
+
+    if options.ladder_layers and not options.ladder:
+        print("--ladder-layers needs --ladder")
+        return 2
+
+    if options.layers and (options.panel or options.ladder):
+        print("--layers can't be combined with --panel or --ladder")
+        return 2
+
+    if options.layer_exposures:
+        if not options.layers or len(options.layer_exposures) != len(options.input_sets):
+            print("--layer-exposures needs --layers and one exposure time per set")
+            return 2
+        if min(options.layer_exposures) < 0.1:
+            print("Exposure time is too short!")
+            return 2
+
+    if options.ladder:
+        try:
+            pw0_utils.exposure_ladder(*options.ladder)
+        except ValueError as e:
+            print(e)
+            return 2
+
+    if options.trace:
+        # Through the environment so that spawned workers trace too
+        os.environ['PW0_TRACE'] = os.path.abspath(options.trace)
+        pw0_trace.add_sink(pw0_trace.JsonLinesSink(os.environ['PW0_TRACE']))
+
+    printer = load_template(options.template, options.exposure, options.cache_dir)
+    os.makedirs(options.output_dir, exist_ok=True)
+    if options.panel:
+        return run_panel(options, printer)
+    if options.layers:
+        return run_layers(options, printer)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        jobs = {executor.submit(convert_job, input_set, options, printer, file_out): (input_set, file_out)
+                for input_set, file_out in zip(options.input_sets, output_paths(options))}
+        for job in as_completed(jobs):
+            input_set, file_out = jobs[job]
+            try:
+                elapsed = job.result()
+                print(f"OK     {input_set} -> {file_out} ({elapsed:.1f} s)")
+            except Exception as e:
+                failed += 1
+                print(f"FAILED {input_set}: {e}")
+
+    print(f"\n{len(jobs) - failed} of {len(jobs)} jobs converted")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
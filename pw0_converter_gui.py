@@ -1,27 +1,50 @@
+import time
+startup_time = time.perf_counter()
+
 import configparser
+import multiprocessing
 import os
 import sys
 import re
 import shutil
-import subprocess
+import threading
+import queue
 
-import magic
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
-from PIL import Image, ImageTk, ImageOps
 
+import pw0_cache
+import pw0_format
+import pw0_profiles
+import pw0_trace
 import pw0_utils
+import pw0_bitmap
+from pw0_bitmap import PackedBitmap
+from pw0_file import PW0File
 
 all_good = False    
 
-output_svg = "output.svg"
-output_png = "padded.png"
+debug_dir = None    # intermediate output.svg and padded.png go here if set
 
 gerbv_loaded = False
 
 display_img = None 
 rendered_img = None 
+preview_levels = None       # downsampled copies of the image on the canvas, largest first
+preview_transform = False   # whether invert/mirror apply to the preview
+rendered_key = None # render cache key of rendered_img
+rendered_rll = None # rendered_img encoded as is, invert and mirror are applied to the runs
+last_patch = None   # what the last patched file was made from, see patch_printer_file()
+render_cache = None
+template_profiles = pw0_profiles.ProfileStore()  # parsed printer files, replaced by the stored one in load_config()
+
+job_thread = None   # the worker thread that renders or patches, one job at a time
+job_cancel = threading.Event()
+job_messages = queue.Queue()    # progress and results from the worker, read on the Tk thread
+job_stage_names = {'vectorize': "Vectorizing", 'rasterize': "Rasterizing", 'binarize': "Binarizing",
+                   'encode': "Encoding", 'write': "Writing"}
+job_timings = {}    # stage -> seconds of the last job, shown under the progress bar
 
 lcd_h_res = None
 lcd_v_res = None
@@ -42,13 +65,20 @@ config = configparser.ConfigParser()
 config_ini_file = 'config.ini'
 config_files_section = 'files'
 config_gerbv_file = 'last_gerbv_file'
+config_gerbv_stamp = 'gerbv_checked'   # path, size and mtime of the gerbv that passed the version check
 config_printer_file = 'last_prn_file'
+config_output_dir = 'output_dir'
+config_cache_dir = 'render_cache_dir'
+config_profiles_file = 'template_profiles_file'
 config_settings_section = 'settings'
 config_img_invert = 'invert_image'
 config_img_mirror = 'mirror_image'
+config_debug_files = 'save_intermediate_files'
+config_cache_size = 'render_cache_size_mb'
 
 last_gerbv_file = ''
 last_printer_file = ''
+output_dir = ''
 
 def empty_if_none(config, section, option):
     try:
@@ -77,6 +107,7 @@ def save_settings():
         config.set(config_settings_section, config_img_mirror, str(checkbutton_mirror.get()))    
         save_config()
         
+        job_cancel.set()
         root.destroy()
         sys.exit()  
     except:
@@ -85,20 +116,28 @@ def save_settings():
 def load_config():
     global last_gerbv_file
     global last_printer_file
+    global output_dir
     global config_gerbv_file
     global config_printer_file
+    global config_output_dir
     global config_files_section
     global config_settings_section
     global config_ini_file
     global config
     global checkbutton_invert 
     global checkbutton_mirror
+    global debug_dir
+    global render_cache
+    global template_profiles
     
     config.read(config_ini_file)
     last_printer_file = empty_if_none(config, config_files_section, config_printer_file)
     if not config.has_section(config_files_section):
         config.add_section(config_files_section)
     config.set(config_files_section, config_printer_file, last_printer_file)
+    output_dir = empty_if_none(config, config_files_section, config_output_dir)
+    config.set(config_files_section, config_output_dir, output_dir)
+    output_dir_label.configure(text=output_dir if output_dir else "Output folder: script directory")
     last_gerbv_file = empty_if_none(config, config_files_section, config_gerbv_file)
     if last_gerbv_file == '':
         last_gerbv_file = shutil.which('gerbv')
@@ -110,36 +149,135 @@ def load_config():
     mirror = config.getboolean(config_settings_section, config_img_mirror, fallback=True)
     checkbutton_invert.set(invert)
     checkbutton_mirror.set(mirror)
+    if config.getboolean(config_settings_section, config_debug_files, fallback=False):
+        debug_dir = '.'
+
+    cache_dir = config.get(config_files_section, config_cache_dir, fallback='render_cache')
+    cache_size = config.getfloat(config_settings_section, config_cache_size, fallback=1024)
+    if cache_dir: # an empty path disables the cache
+        render_cache = pw0_cache.RenderCache(cache_dir, int(cache_size * 1024 * 1024))
+
+    profiles_file = config.get(config_files_section, config_profiles_file, fallback='template_profiles.json')
+    template_profiles = pw0_profiles.ProfileStore(profiles_file or None)  # an empty path keeps them in memory only
     
+class JobCancelled(Exception):
+    pass
+
+def job_progress(stage, fraction):
+    # Called through pw0_trace.report_progress() on the worker thread
+    if job_cancel.is_set():
+        raise JobCancelled()
+    job_messages.put(('progress', stage, fraction))
+
+def job_trace(record):
+    # pw0_trace sink, stages of the GUI's own jobs run on the worker thread
+    if threading.current_thread() is job_thread:
+        job_messages.put(('trace', record['stage'], record['wall_s']))
+
+def start_job(status_label, work, done):
+    # work() runs on the worker thread, done(result) on the Tk thread once it has finished.
+    # Tk widgets must not be touched in work(), read the settings it needs before starting
+    global job_thread
+
+    if job_thread is not None and job_thread.is_alive():
+        status_label.configure(text="Error: another job is running")
+        return
+
+    def run():
+        try:
+            job_messages.put(('done', status_label, done, work()))
+        except JobCancelled:
+            job_messages.put(('cancelled', status_label))
+        except Exception as e:
+            job_messages.put(('error', status_label, e))
+
+    job_cancel.clear()
+    job_timings.clear()
+    trace_label.configure(text="")
+    status_label.configure(text="Working...")
+    cancel_button.configure(state=tk.NORMAL)
+    job_thread = threading.Thread(target=run, daemon=True)
+    job_thread.start()
+    root.after(50, poll_job)
+
+def poll_job():
+    while True:
+        try:
+            message = job_messages.get_nowait()
+        except queue.Empty:
+            break
+        if message[0] == 'progress':
+            _, stage, fraction = message
+            job_label.configure(text=f"{job_stage_names.get(stage, stage)}...")
+            job_progressbar['value'] = fraction * 100
+            continue
+        if message[0] == 'trace':
+            _, stage, seconds = message
+            job_timings[stage] = job_timings.get(stage, 0) + seconds
+            trace_label.configure(text=", ".join(f"{name} {t:.2f} s" for name, t in job_timings.items()))
+            continue
+
+        job_label.configure(text="")
+        job_progressbar['value'] = 0
+        cancel_button.configure(state=tk.DISABLED)
+        if message[0] == 'done':
+            _, status_label, done, result = message
+            done(result)
+        elif message[0] == 'cancelled':
+            message[1].configure(text="Cancelled")
+        else:
+            _, status_label, error = message
+            status_label.configure(text=f"Error: {error}")
+        return
+
+    root.after(50, poll_job)
+
+def cancel_job():
+    job_cancel.set()
+    job_label.configure(text="Cancelling...")
+
+pw0_trace.progress_listeners.append(job_progress)
+pw0_trace.trace_sinks.append(job_trace)  # only needs the times, tracemalloc stays off unless PW0_TRACE is set
+
+def set_preview(levels, transform):
+    global preview_levels
+    global preview_transform
+
+    preview_levels = levels
+    preview_transform = transform
+
 def draw_image():
-    global display_img
+    global preview_levels
+    global preview_transform
     
-    img = display_img.copy()
     canvas_width = canvas.winfo_width()
     canvas_height = canvas.winfo_height()
+    # Smallest preview level that still covers the canvas
+    img = preview_levels[0]
+    for level in preview_levels:
+        if level.width < canvas_width and level.height < canvas_height:
+            break
+        img = level
+    if preview_transform:
+        img = pw0_utils.transform_image(img, checkbutton_invert.get(), checkbutton_mirror.get())
+    else:
+        img = img.copy()
     img.thumbnail((canvas_width, canvas_height))
 
-    tk_img = ImageTk.PhotoImage(img)
+    tk_img = pw0_trace.load_module('PIL.ImageTk').PhotoImage(img)
 
     canvas.image = tk_img  # Keep a reference to avoid garbage collection
     canvas.create_image(canvas_width // 2, canvas_height // 2, image=tk_img, anchor="center")
 
 def on_resize(event):
-    if display_img:
+    if preview_levels:
         draw_image()
 
 def apply_transform():
-    global checkbutton_invert
-    global checkbutton_mirror 
-    global display_img
+    # Only the preview is transformed here, the full image is transformed when patching
     global rendered_img
     
     if rendered_img is not None:
-        display_img = rendered_img.copy()
-        if checkbutton_invert.get():
-            display_img = ImageOps.invert(display_img)
-        if checkbutton_mirror.get():
-            display_img = display_img.transpose(Image.FLIP_LEFT_RIGHT)
         draw_image()
 
 def load_gerbv(dialog = True):
@@ -159,18 +297,53 @@ def load_gerbv(dialog = True):
     
     if not last_gerbv_file:
         return
-    
-    try:
-        retn = subprocess.run([last_gerbv_file, '--version'], capture_output = True)
-        if retn.stdout.decode()[:6] == 'gerbv ':
-            gerbv_file_label.configure(text=f"gerbv loaded successfully")
-            config.set(config_files_section, config_gerbv_file, last_gerbv_file)
-            save_config()
-            gerbv_loaded = True
-    except:
-        gerbv_file_label.configure(text=f"gerbv not loaded, gerber files won't be processed")
-        gerbv_loaded = False
+
+    # The version check starts a process, it's skipped for the gerbv that passed it before
+    gerbv_file = last_gerbv_file
+    stamp = (gerbv_file, file_stamp(gerbv_file))
+    if stamp[1] is not None and str(stamp) == config.get(config_files_section, config_gerbv_stamp, fallback=''):
+        gerbv_checked(gerbv_file, stamp, True)
+        return
+
+    gerbv_loaded = False
+    gerbv_file_label.configure(text="Checking gerbv...")
+    result = []
+    threading.Thread(target=lambda: result.append(pw0_utils.gerbv_version(gerbv_file)), daemon=True).start()
+
+    def wait():
+        if not result:
+            root.after(50, wait)
+        elif gerbv_file == last_gerbv_file: # another gerbv may have been chosen in the meantime
+            gerbv_checked(gerbv_file, stamp, result[0] is not None)
+    root.after(50, wait)
+
+def gerbv_checked(gerbv_file, stamp, ok):
+    global gerbv_loaded
+
+    gerbv_loaded = ok
+    if ok:
+        gerbv_file_label.configure(text=f"gerbv loaded successfully")
+        config.set(config_files_section, config_gerbv_file, gerbv_file)
+        config.set(config_files_section, config_gerbv_stamp, str(stamp))
+        save_config()
+    else:
+        gerbv_file_label.configure(text=f"gerbv not loaded, only the built-in Gerber renderer is used")
         
+def choose_output_dir():
+    global output_dir
+    global config_output_dir
+    global config_files_section
+    global config
+
+    directory = filedialog.askdirectory(initialdir = output_dir, title="Select output folder")
+    if not directory:
+        return
+
+    output_dir = directory
+    output_dir_label.configure(text=output_dir)
+    config.set(config_files_section, config_output_dir, output_dir)
+    save_config()
+
 def set_entry(entry, value):
     entry.delete(0, tk.END)
     if value is not None:
@@ -213,10 +386,13 @@ def load_pw0(dialog = True):
     try:
         printer_file_label.configure(text=os.path.basename(last_printer_file))
 
-        data = pw0_utils.read_pw0_file(last_printer_file)
-        printer_name = pw0_utils.parse_model(data)
-        display_properties = pw0_utils.parse_header(data)
-        layer_data = pw0_utils.parse_layer(data)
+        # Only parsed when the file is new or has changed since it was last loaded
+        profile = template_profiles.get(last_printer_file)
+        printer_name = profile['printer_name']
+        display_properties = profile['display_properties']
+        layer_data = profile['layer_data']
+        if profile['layer_count'] > 1:
+            print("WARNING: FOUND MORE THAN ONE LAYER IN THE FILE, PATCHING MAY NOT WORK!")
 
         lcd_h_res = display_properties[1]
         lcd_v_res = display_properties[2]
@@ -236,6 +412,10 @@ def load_pw0(dialog = True):
         lcd_label_text = f"{lcd_h_res}x{lcd_v_res}px, {lcd_px_size:.1f} μm - {disp_width:.1f}x{disp_height:.1f}mm"
         printer_lcd_label.configure(text=lcd_label_text)
 
+        if rendered_img is None: # nothing loaded yet, show the layer the printer file already holds
+            file_path = last_printer_file
+            start_job(printer_file_label, lambda: load_template_layer(file_path), show_template_layer)
+
         config.set(config_files_section, config_printer_file, last_printer_file)
         save_config()
     except Exception as e:
@@ -243,16 +423,31 @@ def load_pw0(dialog = True):
         printer_name_label.configure(text=error_message) 
         printer_lcd_label.configure(text="")
 
+def load_template_layer(file_path):
+    # Runs on the worker thread
+    with PW0File(file_path) as printer_file:
+        layer_img = pw0_utils.read_layer_image(printer_file.data, printer_file.layer_data(), printer_file.display_properties())
+    bitmap = PackedBitmap.from_image(layer_img)
+    return [bitmap, pw0_bitmap.preview_pyramid(bitmap), file_path]
+
+def show_template_layer(result):
+    global display_img
+
+    bitmap, levels, file_path = result
+    printer_file_label.configure(text=os.path.basename(file_path))
+    if rendered_img is None: # a PCB may have been loaded in the meantime
+        display_img = bitmap
+        set_preview(levels, False)  # the layer is already inverted and mirrored
+        draw_image()
+
 def load_pcb():
     global dpi_entry
     global w_entry
     global h_entry
-    global rendered_img
+    global render_cache
     global board_width
     global board_height
-    global output_svg
-    global vector_png
-    global output_png
+    global debug_dir
     global lcd_h_res
     global lcd_v_res
     global disp_width
@@ -262,15 +457,19 @@ def load_pcb():
     
     if not file_paths:
         return
-        
-    gerber_file_label.configure(text="Working...")
-    gerber_file_label.update_idletasks() # Force the label to update without waiting for main update loop
 
-    mime = magic.from_file(file_paths[0], mime = True) \
-            if len(file_paths) == 1 else ''
-    #print(mime)
+    # The render runs on the worker thread, it only gets copies of the settings
+    resolution = [lcd_h_res, lcd_v_res]
+    dpi = printer_dpi
+    gerbv = last_gerbv_file
+
+    try:
+        kind = pw0_format.input_kind(file_paths)
+    except ValueError as e:
+        gerber_file_label.configure(text=f"Error: {e}")
+        return
             
-    if (mime == 'image/svg+xml' or mime == 'image/svg'):
+    if kind == 'svg':
         try:
             pcb_size = [float(w_entry.get()), float(h_entry.get())]
         except:
@@ -283,10 +482,10 @@ def load_pcb():
             gerber_file_label.configure(text="Error: PCB size is larger than printer's display")
             return
             
-        pw0_utils.svg_disable_antialiasing(file_paths[0], output_svg)
-        pw0_utils.svg_to_png(pcb_size, [lcd_h_res, lcd_v_res], printer_dpi, output_svg, output_png)
+        params = {'kind': 'svg', 'size_mm': pcb_size, 'resolution': resolution, 'dpi': dpi}
+        render = lambda: pw0_utils.render_svg(pcb_size, resolution, dpi, file_paths[0], debug_dir)
         
-    elif (mime == 'image/png'):
+    elif kind == 'png':
         source_dpi = float(dpi_entry.get())
         pcb_size = [float(w_entry.get()), float(h_entry.get())]
         if pcb_size[0] <= 0 or pcb_size[1] <= 0:
@@ -296,39 +495,62 @@ def load_pcb():
             gerber_file_label.configure(text="Error: PCB size is larger than printer's display")
             return
                
-        pw0_utils.process_png(pcb_size, [lcd_h_res, lcd_v_res], printer_dpi, source_dpi, file_paths[0], output_png)
+        params = {'kind': 'png', 'resolution': resolution, 'dpi': dpi, 'source_dpi': source_dpi}
+        render = lambda: pw0_utils.render_png(pcb_size, resolution, dpi, source_dpi, file_paths[0], debug_dir)
         
     else:  # if gerber/drl
-        if not (gerbv_loaded):
-            gerber_file_label.configure(text="Error: gerbv executable not loaded")
-            return
-        else:
-            pcb_size = pw0_utils.gerber_to_png(file_paths, output_svg, output_png, last_gerbv_file, [lcd_h_res, lcd_v_res], printer_dpi)
-    
-    rendered_img = Image.open(output_png)
-    apply_transform()
-    draw_image()
-    
-    gerber_file_label.configure(
-            text = ', '.join([os.path.basename(path) for path in file_paths]))
+        if not gerbv_loaded: # gerbv is only the fallback of the built-in renderer
+            gerbv = None
+        params = {'kind': 'gerber', 'renderer': 'native', 'gerbv': gerbv, 'resolution': resolution, 'dpi': dpi}
+        render = lambda: pw0_utils.render_gerber(file_paths, gerbv, resolution, dpi, debug_dir,
+                                                 layer_cache=render_cache)[0]
+
+    def work():
+        bitmap, key = pw0_cache.cached_bitmap(render_cache, file_paths, params, render)
+        return [bitmap, key, pw0_bitmap.preview_pyramid(bitmap)]
+
+    def done(result):
+        global rendered_img
+        global rendered_key
+        global rendered_rll
+        global display_img
+
+        rendered_img, rendered_key, levels = result
+        rendered_rll = None
+        display_img = None
+        set_preview(levels, True)
+        draw_image()
+        gerber_file_label.configure(
+                text = ', '.join([os.path.basename(path) for path in file_paths]))
+
+    start_job(gerber_file_label, work, done)
             
 def filter_float(value):
     return re.fullmatch('([0-9]*[.])?[0-9]*', value) is not None
 
-def patch_printer_file():
+def file_stamp(file_path):
+    # Tells whether a file was changed since it was written
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def patch_printer_file(ladder=False):
     global patch_label
     global display_properties
     global layer_data
     global last_printer_file
     global exposure_time
     global display_img
+    global rendered_img
+    global rendered_key
+    global render_cache
     global lcd_h_res
     global lcd_v_res
     
-    patch_label.configure(text="Working...")
-    patch_label.update_idletasks() # Force the label to update without waiting for main update loop
-    
-    if any(var is None for var in (display_properties, layer_data, last_printer_file, exposure_time, display_img, lcd_h_res, lcd_v_res)):
+    source_img = rendered_img if rendered_img is not None else display_img
+    if any(var is None for var in (display_properties, layer_data, last_printer_file, exposure_time, source_img, lcd_h_res, lcd_v_res)):
         patch_label.configure(text="Error: Patch data not ready")
         return
 
@@ -337,115 +559,225 @@ def patch_printer_file():
         patch_label.configure(text="Exposure time is too short!")
         return
 
-    source_img_size = display_img.size
+    source_img_size = source_img.size
     if source_img_size[0] != lcd_h_res or source_img_size[1] != lcd_v_res:
         patch_label.configure(text="Error: Source and target resolution mismatch")
         return
-    
-    
-    rll_result = pw0_utils.rll_encode_image(display_img)
-    pw0_utils.patch_pw0(last_printer_file, layer_data, rll_result, display_properties[3], exposure_time)
-    patch_label.configure(text="Success")
-    
-root = tk.Tk()
-root.title("ANYCUBIC CONVERTER")
-root.geometry("1000x550")
-root.wm_minsize(600, 550)
-root.protocol("WM_DELETE_WINDOW", save_settings)
-
-checkbutton_invert = tk.BooleanVar() 
-checkbutton_mirror = tk.BooleanVar()
-
-control_frame = ttk.Frame(borderwidth=1, relief=tk.SOLID, width = 300, padding=[8, 10])  
-
-btn = tk.Button(control_frame, text = 'Choose gerbv executable', command = load_gerbv)
-btn.pack(anchor=tk.NW, fill=tk.X)
-
-gerbv_file_label = ttk.Label(control_frame, text="")
-gerbv_file_label.pack(anchor=tk.NW, fill=tk.X)
-
-btn = tk.Button(control_frame, text = 'Choose printer file', command = load_pw0)
-btn.pack(anchor=tk.NW, fill=tk.X)
-
-printer_file_label = ttk.Label(control_frame, text="")
-printer_file_label.pack(anchor=tk.NW, fill=tk.X)
-
-printer_name_label = ttk.Label(control_frame, text="")
-printer_name_label.pack(anchor=tk.NW, fill=tk.X)
-
-printer_lcd_label = ttk.Label(control_frame, text="")
-printer_lcd_label.pack(anchor=tk.NW, fill=tk.X)
 
-btn = tk.Button(control_frame, text = 'Choose PCB (GBR[+Excellon] / SVG / PNG)', command = load_pcb)
-btn.pack(anchor=tk.NW, fill=tk.X)
-
-gerber_file_label = ttk.Label(control_frame, text="Multiple gerber files can be selected")
-gerber_file_label.pack(anchor=tk.NW, fill=tk.X)
-
-label = ttk.Label(control_frame, text="\nPROCESSING OPTIONS")
-label.pack(anchor=tk.NW, fill=tk.X)
-
-
-Button1 = tk.Checkbutton(control_frame, text = "Invert image", 
-                variable = checkbutton_invert,
-                command = apply_transform, 
-                height = 1, 
-                width = 10,
-                anchor='w')
-Button1.pack(anchor=tk.NW, fill=tk.X)
-
-
-Button2 = tk.Checkbutton(control_frame, text = "Mirror image horizontally", 
-                variable = checkbutton_mirror, 
-                command = apply_transform,
-                height = 1, 
-                width = 10,
-                anchor='w')
-Button2.pack(anchor=tk.NW, fill=tk.X)
-
-label = ttk.Label(control_frame, text="Adjust exposure time (sec)")
-label.pack(anchor=tk.NW, fill=tk.X)
-exp_time_entry = ttk.Entry(control_frame, validate = "key")
-exp_time_entry.configure(validate = 'all',
-        validatecommand = (exp_time_entry.register(filter_float), '%P'))
-exp_time_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
-
-label = ttk.Label(control_frame, text="Source image DPI (for PNGs)")
-label.pack(anchor=tk.NW, fill=tk.X)
-dpi_entry = ttk.Entry(control_frame, validate = "key")
-dpi_entry.configure(validate = 'all',
-        validatecommand = (dpi_entry.register(filter_float), '%P'))
-dpi_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
-
-label = ttk.Label(control_frame, text="PCB width, mm (for SVGs and PNGs)")
-label.pack(anchor=tk.NW, fill=tk.X)
-w_entry = ttk.Entry(control_frame, validate = "key")
-w_entry.configure(validate = 'all',
-        validatecommand = (w_entry.register(filter_float), '%P'))
-w_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
-
-label = ttk.Label(control_frame, text="PCB height, mm (for SVGs and PNGs)")
-label.pack(anchor=tk.NW, fill=tk.X)
-h_entry = ttk.Entry(control_frame, validate = "key")
-h_entry.configure(validate = 'all',
-        validatecommand = (h_entry.register(filter_float), '%P'))
-h_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
-
-btn = tk.Button(control_frame, text = 'PATCH', command = patch_printer_file)
-btn.pack(anchor=tk.NW, fill=tk.X, pady=7)
-
-patch_label = ttk.Label(control_frame, text="")
-patch_label.pack(anchor=tk.NW, fill=tk.X, pady=7)
-
-control_frame.pack(anchor=tk.NW, side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
-control_frame.pack_propagate(0) # tell frame not to let its children control its size
-
-canvas = tk.Canvas(root, bg = "gray", width = 250, height = 250)
-canvas.pack(anchor=tk.NW, expand=True, fill=tk.BOTH)
-canvas.bind("<Configure>", on_resize)
-
-load_config()
-load_gerbv(False)
-load_pw0(False)
+    exposure_times = None
+    if ladder: # the exposure time entry is the first step
+        try:
+            ladder_step, ladder_count = float(ladder_step_entry.get()), int(float(ladder_count_entry.get()))
+        except ValueError:
+            patch_label.configure(text="Error: Ladder step and count not specified")
+            return
+        try:
+            exposure_times = pw0_utils.exposure_ladder(exposure_time, ladder_step, ladder_count)
+        except ValueError as e:
+            patch_label.configure(text=f"Error: {e}")
+            return
+    
+    # The worker thread only gets copies of the settings, they can be changed while it runs
+    invert = checkbutton_invert.get() if rendered_img is not None else False
+    mirror = checkbutton_mirror.get() if rendered_img is not None else False
+    ladder_layers = checkbutton_ladder_layers.get()
+    printer_file, layers, display, exp_time_addr2 = last_printer_file, layer_data, display_properties, display_properties[3]
+    exposure = exposure_time
+    file_out = pw0_utils.output_file_path(printer_file, output_dir)
+    patch = [source_img, printer_file, file_stamp(printer_file), layers, invert, mirror, file_out]
+    exposure_only = not ladder and last_patch is not None and last_patch[0] is source_img and \
+                    last_patch[1:] == patch[1:] + [file_stamp(file_out)]
+    base_rll = rendered_rll if source_img is rendered_img else None
+    rll_key = None
+    if rendered_key is not None and rendered_img is not None:
+        rll_key = pw0_cache.derived_key(rendered_key, invert=False, mirror=False)
+
+    def work():
+        if exposure_only:  # the image in the last patched file is still right
+            return [[pw0_utils.patch_exposure(file_out, layers, exp_time_addr2, exposure)], base_rll]
+        if source_img is not rendered_img and not ladder:  # the template's own layer
+            rll_chunks = pw0_utils.rll_encode_stream(source_img)
+            return [[pw0_utils.write_pw0(printer_file, layers, rll_chunks, exp_time_addr2, exposure, file_out=file_out)], None]
+
+        # The image is encoded once, invert, mirror and the ladder's exposure times reuse it
+        rll_result = base_rll
+        if rll_result is None:
+            rll_result = pw0_utils.join_rll_chunks(pw0_cache.cached_rll_chunks(render_cache, rll_key,
+                    lambda: pw0_utils.rll_encode_stream(source_img)))
+        transformed = pw0_utils.rll_transform(rll_result, source_img.size, invert, mirror)
+        if ladder:
+            return [pw0_utils.write_exposure_ladder(printer_file, layers, transformed, display,
+                                                    exposure_times, file_out, ladder_layers), rll_result]
+        return [[pw0_utils.patch_pw0(printer_file, layers, transformed, exp_time_addr2, exposure, file_out=file_out)],
+                rll_result]
+
+    def done(result):
+        global rendered_rll
+        global last_patch
+
+        file_outs, rll_result = result
+        if source_img is rendered_img:
+            rendered_rll = rll_result
+        if not ladder:
+            last_patch = patch + [file_stamp(file_out)]
+        if len(file_outs) > 1:
+            patch_label.configure(text=f"Success: {len(file_outs)} files")
+        else:
+            patch_label.configure(text=f"Success: {os.path.basename(file_outs[0])}")
 
-root.mainloop()
+    start_job(patch_label, work, done)
+
+def main():
+    # Builds the window, kept out of the module level: ProcessPoolExecutor workers import this module too
+    global root, checkbutton_invert, checkbutton_mirror, checkbutton_ladder_layers, gerbv_file_label
+    global printer_file_label, printer_name_label, printer_lcd_label, gerber_file_label, exp_time_entry
+    global dpi_entry, w_entry, h_entry, output_dir_label, ladder_step_entry, ladder_count_entry, patch_label
+    global job_label, job_progressbar, cancel_button, trace_label, canvas
+
+    root = tk.Tk()
+    root.title("ANYCUBIC CONVERTER")
+    root.geometry("1000x600")
+    root.wm_minsize(600, 600)
+    root.protocol("WM_DELETE_WINDOW", save_settings)
+
+    checkbutton_invert = tk.BooleanVar() 
+    checkbutton_mirror = tk.BooleanVar()
+    checkbutton_ladder_layers = tk.BooleanVar()
+
+    control_frame = ttk.Frame(borderwidth=1, relief=tk.SOLID, width = 300, padding=[8, 10])  
+
+    btn = tk.Button(control_frame, text = 'Choose gerbv executable', command = load_gerbv)
+    btn.pack(anchor=tk.NW, fill=tk.X)
+
+    gerbv_file_label = ttk.Label(control_frame, text="")
+    gerbv_file_label.pack(anchor=tk.NW, fill=tk.X)
+
+    btn = tk.Button(control_frame, text = 'Choose printer file', command = load_pw0)
+    btn.pack(anchor=tk.NW, fill=tk.X)
+
+    printer_file_label = ttk.Label(control_frame, text="")
+    printer_file_label.pack(anchor=tk.NW, fill=tk.X)
+
+    printer_name_label = ttk.Label(control_frame, text="")
+    printer_name_label.pack(anchor=tk.NW, fill=tk.X)
+
+    printer_lcd_label = ttk.Label(control_frame, text="")
+    printer_lcd_label.pack(anchor=tk.NW, fill=tk.X)
+
+    btn = tk.Button(control_frame, text = 'Choose PCB (GBR[+Excellon] / SVG / PNG)', command = load_pcb)
+    btn.pack(anchor=tk.NW, fill=tk.X)
+
+    gerber_file_label = ttk.Label(control_frame, text="Multiple gerber files can be selected")
+    gerber_file_label.pack(anchor=tk.NW, fill=tk.X)
+
+    label = ttk.Label(control_frame, text="\nPROCESSING OPTIONS")
+    label.pack(anchor=tk.NW, fill=tk.X)
+
+
+    Button1 = tk.Checkbutton(control_frame, text = "Invert image", 
+                    variable = checkbutton_invert,
+                    command = apply_transform, 
+                    height = 1, 
+                    width = 10,
+                    anchor='w')
+    Button1.pack(anchor=tk.NW, fill=tk.X)
+
+
+    Button2 = tk.Checkbutton(control_frame, text = "Mirror image horizontally", 
+                    variable = checkbutton_mirror, 
+                    command = apply_transform,
+                    height = 1, 
+                    width = 10,
+                    anchor='w')
+    Button2.pack(anchor=tk.NW, fill=tk.X)
+
+    label = ttk.Label(control_frame, text="Adjust exposure time (sec)")
+    label.pack(anchor=tk.NW, fill=tk.X)
+    exp_time_entry = ttk.Entry(control_frame, validate = "key")
+    exp_time_entry.configure(validate = 'all',
+            validatecommand = (exp_time_entry.register(filter_float), '%P'))
+    exp_time_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    label = ttk.Label(control_frame, text="Source image DPI (for PNGs)")
+    label.pack(anchor=tk.NW, fill=tk.X)
+    dpi_entry = ttk.Entry(control_frame, validate = "key")
+    dpi_entry.configure(validate = 'all',
+            validatecommand = (dpi_entry.register(filter_float), '%P'))
+    dpi_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    label = ttk.Label(control_frame, text="PCB width, mm (for SVGs and PNGs)")
+    label.pack(anchor=tk.NW, fill=tk.X)
+    w_entry = ttk.Entry(control_frame, validate = "key")
+    w_entry.configure(validate = 'all',
+            validatecommand = (w_entry.register(filter_float), '%P'))
+    w_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    label = ttk.Label(control_frame, text="PCB height, mm (for SVGs and PNGs)")
+    label.pack(anchor=tk.NW, fill=tk.X)
+    h_entry = ttk.Entry(control_frame, validate = "key")
+    h_entry.configure(validate = 'all',
+            validatecommand = (h_entry.register(filter_float), '%P'))
+    h_entry.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    btn = tk.Button(control_frame, text = 'Choose output folder', command = choose_output_dir)
+    btn.pack(anchor=tk.NW, fill=tk.X)
+
+    output_dir_label = ttk.Label(control_frame, text="")
+    output_dir_label.pack(anchor=tk.NW, fill=tk.X)
+
+    label = ttk.Label(control_frame, text="Exposure ladder: step (sec), count")
+    label.pack(anchor=tk.NW, fill=tk.X)
+    ladder_frame = ttk.Frame(control_frame)
+    ladder_step_entry = ttk.Entry(ladder_frame, width = 8)
+    ladder_step_entry.configure(validate = 'all',
+            validatecommand = (ladder_step_entry.register(filter_float), '%P'))
+    ladder_step_entry.pack(side=tk.LEFT, padx=(0, 5))
+    ladder_count_entry = ttk.Entry(ladder_frame, width = 5)
+    ladder_count_entry.configure(validate = 'all',
+            validatecommand = (ladder_count_entry.register(filter_float), '%P'))
+    ladder_count_entry.pack(side=tk.LEFT, padx=(0, 5))
+    ladder_layers_button = tk.Checkbutton(ladder_frame, text = "As strips in one file",
+                    variable = checkbutton_ladder_layers,
+                    anchor='w')
+    ladder_layers_button.pack(side=tk.LEFT)
+    ladder_frame.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    btn = tk.Button(control_frame, text = 'PATCH', command = patch_printer_file)
+    btn.pack(anchor=tk.NW, fill=tk.X, pady=(7, 0))
+
+    btn = tk.Button(control_frame, text = 'PATCH EXPOSURE LADDER', command = lambda: patch_printer_file(ladder=True))
+    btn.pack(anchor=tk.NW, fill=tk.X, pady=(3, 7))
+
+    patch_label = ttk.Label(control_frame, text="")
+    patch_label.pack(anchor=tk.NW, fill=tk.X, pady=7)
+
+    job_label = ttk.Label(control_frame, text="")
+    job_label.pack(anchor=tk.NW, fill=tk.X)
+
+    job_progressbar = ttk.Progressbar(control_frame, maximum=100)
+    job_progressbar.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    cancel_button = tk.Button(control_frame, text = 'Cancel', command = cancel_job, state = tk.DISABLED)
+    cancel_button.pack(anchor=tk.NW, fill=tk.X)
+
+    trace_label = ttk.Label(control_frame, text="", wraplength=280)
+    trace_label.pack(anchor=tk.NW, fill=tk.X, pady=3)
+
+    control_frame.pack(anchor=tk.NW, side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
+    control_frame.pack_propagate(0) # tell frame not to let its children control its size
+
+    canvas = tk.Canvas(root, bg = "gray", width = 250, height = 250)
+    canvas.pack(anchor=tk.NW, expand=True, fill=tk.BOTH)
+    canvas.bind("<Configure>", on_resize)
+
+    load_config()
+    load_gerbv(False)
+    load_pw0(False)
+    pw0_trace.emit({'stage': 'startup', 'wall_s': time.perf_counter() - startup_time})
+
+    root.mainloop()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # frozen Windows builds start the workers from the .exe
+    main()
@@ -0,0 +1,257 @@
+'''
+    Anycubic printer file container:
+
+        FILEMARK   "ANYCUBIC", version, number of sections, table of section addresses
+        HEADER     printer and print settings
+        PREVIEW    RGB565 thumbnail
+        LAYERDEF   layer amount followed by a 32-byte definition for every layer
+        EXTRA, MACHINE, MODEL, ...
+        layer image data
+
+    Every section starts with a 12-byte name and a uint32 length.
+    The section index is built once from the address table, fields are read on access.
+'''
+
+import mmap
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+SECTION_NAME_SIZE = 12
+SECTION_HEADER_SIZE = 16
+
+
+class Field:
+    # Little-endian value at a fixed offset from the start of its record
+    __slots__ = ('offset', 'fmt')
+
+    def __init__(self, offset, fmt):
+        self.offset = offset
+        self.fmt = fmt
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        return struct.unpack_from(self.fmt, record.data, record.addr + self.offset)[0]
+
+
+class Record:
+    __slots__ = ('data', 'addr')
+
+    def __init__(self, data, addr):
+        self.data = data
+        self.addr = addr
+
+    @classmethod
+    def field_offset(cls, name):
+        return getattr(cls, name).offset
+
+    def field_addr(self, name):
+        return self.addr + self.field_offset(name)
+
+
+class Section(Record):
+    __slots__ = ()
+    length = Field(12, '<I')
+
+    @property
+    def name(self):
+        return section_name(self.data, self.addr)
+
+
+class HeaderSection(Section):
+    __slots__ = ()
+    pixel_size = Field(16, '<f')        # um
+    layer_height = Field(20, '<f')
+    normal_exposure_time = Field(24, '<f')
+    exposure_time = Field(32, '<f')     # patched together with the layer exposure
+    bottom_layer_count = Field(36, '<I')
+    resolution_x = Field(60, '<I')
+    resolution_y = Field(64, '<I')
+
+
+class PreviewSection(Section):
+    __slots__ = ()
+    width = Field(16, '<I')
+    resolution = Field(20, '<I')
+    height = Field(24, '<I')
+    image_offset = 28
+
+    def image(self):
+        # Preview pixels are stored as little-endian RGB565
+        width, height = self.width, self.height
+        pixels = np.frombuffer(self.data, dtype='<u2', count=width * height,
+                               offset=self.addr + self.image_offset).reshape(height, width)
+        rgb = np.empty((height, width, 3), dtype=np.uint8)
+        rgb[..., 0] = (pixels >> 11) << 3
+        rgb[..., 1] = ((pixels >> 5) & 0x3F) << 2
+        rgb[..., 2] = (pixels & 0x1F) << 3
+        return Image.fromarray(rgb, 'RGB')
+
+
+class MachineSection(Section):
+    __slots__ = ()
+    name_offset = 16
+    name_size = 96
+
+    @property
+    def machine_name(self):
+        start = self.addr + self.name_offset
+        end = self.data.find(b'\0', start, start + self.name_size)
+        return bytes(self.data[start:end if end != -1 else start + self.name_size]).decode('utf-8')
+
+
+class LayerDef(Record):
+    __slots__ = ('index',)
+    size = 32
+    img_data_addr = Field(0, '<I')
+    img_size = Field(4, '<I')
+    lift_height = Field(8, '<f')
+    lift_speed = Field(12, '<f')
+    exposure_time = Field(16, '<f')
+    layer_height = Field(20, '<f')
+    white_pix_num = Field(24, '<I')
+
+    def __init__(self, data, addr, index):
+        super().__init__(data, addr)
+        self.index = index
+
+
+class LayerDefSection(Section):
+    __slots__ = ()
+    layer_num = Field(16, '<I')
+    table_offset = 20
+
+    def __len__(self):
+        return self.layer_num
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("Layer index out of range")
+        index %= len(self)
+        return LayerDef(self.data, self.addr + self.table_offset + index * LayerDef.size, index)
+
+
+SECTION_TYPES = {
+    'HEADER': HeaderSection,
+    'PREVIEW': PreviewSection,
+    'MACHINE': MachineSection,
+    'LAYERDEF': LayerDefSection,
+}
+
+
+def section_name(data, addr):
+    raw = bytes(data[addr:addr + SECTION_NAME_SIZE])
+    return raw.split(b'\0', 1)[0].decode('ascii', errors='replace')
+
+
+class PW0File:
+    __slots__ = ('file_path', 'data', 'version', 'sections', '_file')
+
+    mark_word = b'ANYCUBIC'
+    version_offset = 12
+    table_offset = 20
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, 'rb')
+        try:
+            if os.fstat(self._file.fileno()).st_size == 0:
+                raise ValueError("Printer file is empty")
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.sections = self._build_index()
+        except Exception:
+            self.close()
+            raise
+
+    def _build_index(self):
+        data = self.data
+        if data[:len(self.mark_word)] != self.mark_word:
+            raise ValueError("File mark not found")
+        self.version = struct.unpack_from('<I', data, self.version_offset)[0]
+
+        header_addr = self.header_addr()
+        sections = {}
+        for _, addr in self.section_table():
+            if addr < header_addr or addr > len(data) - SECTION_HEADER_SIZE:
+                continue    # unused entry
+            name = section_name(data, addr)
+            if name.isascii() and name.isupper() and name not in sections:   # skips entries that point to layer image data
+                sections[name] = addr
+
+        for name in ('HEADER', 'LAYERDEF', 'MACHINE'):
+            if name not in sections:
+                raise ValueError(f"{name} section not found")
+        # The image format name follows the machine name, the layer image data isn't searched
+        machine = Section(data, sections['MACHINE'])
+        if data.find(b'pw0Img', machine.addr, machine.addr + SECTION_HEADER_SIZE + machine.length) == -1:
+            raise ValueError("PW0 data not found")
+        return sections
+
+    def header_addr(self):
+        # The first entry of the address table points to HEADER, which directly follows the table
+        header_addr = struct.unpack_from('<I', self.data, self.table_offset)[0]
+        if not self.table_offset < header_addr <= len(self.data) - SECTION_HEADER_SIZE:
+            raise ValueError("Section table out of bounds")
+        return header_addr
+
+    def section_table(self):
+        # [(field address, section address)] of every entry of the address table, used or not
+        return [(field_addr, struct.unpack_from('<I', self.data, field_addr)[0])
+                for field_addr in range(self.table_offset, self.header_addr() - 3, 4)]
+
+    def section(self, name):
+        addr = self.sections.get(name)
+        if addr is None:
+            raise ValueError(f"{name} section not found")
+        return SECTION_TYPES.get(name, Section)(self.data, addr)
+
+    @property
+    def header(self):
+        return self.section('HEADER')
+
+    @property
+    def machine(self):
+        return self.section('MACHINE')
+
+    @property
+    def preview(self):
+        return self.section('PREVIEW')
+
+    @property
+    def layers(self):
+        return self.section('LAYERDEF')
+
+    def display_properties(self):
+        # [pixel size, horizontal resolution, vertical resolution, exposure time address]
+        header = self.header
+        return [header.pixel_size, header.resolution_x, header.resolution_y,
+                header.field_addr('exposure_time')]
+
+    def layer_data(self, index=0):
+        # [exposure time, its address, white pixel count address, image data address,
+        #  image size address, image size, LAYERDEF address]
+        layers = self.layers
+        layer = layers[index]
+        if layer.img_data_addr + layer.img_size > len(self.data):
+            raise ValueError("Image data out of bounds")
+        return [layer.exposure_time, layer.field_addr('exposure_time'), layer.field_addr('white_pix_num'),
+                layer.img_data_addr, layer.field_addr('img_size'), layer.img_size, layers.addr]
+
+    def close(self):
+        data = getattr(self, 'data', None)
+        if data is not None:
+            try:
+                data.close()
+            except BufferError:  # arrays from np.frombuffer() may still reference the mapping
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
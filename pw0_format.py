@@ -0,0 +1,58 @@
+'''
+    Input file type detection from the first and last few KB of a file:
+
+        png       PNG signature
+        svg       <svg element near the start
+        gerber    RS-274X format or unit statement near the start, or M02 at the end
+        excellon  M48 header near the start, or M30 at the end
+
+    Results are cached per path, size and modification time.
+'''
+
+import os
+import re
+
+
+HEAD_SIZE = 8192
+TAIL_SIZE = 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+_kinds = {}     # (path, size, mtime) -> kind
+
+
+def sniff(head, tail):
+    if head.startswith(PNG_SIGNATURE):
+        return 'png'
+    if re.search(rb'<svg[\s>]', head):
+        return 'svg'
+    if re.search(rb'%(FS[LT]?[AI]|MO(MM|IN))', head) or re.search(rb'M0?2\*\s*$', tail):
+        return 'gerber'
+    if re.search(rb'^\s*M48\s*$', head, re.MULTILINE) or re.search(rb'M30\s*$', tail):
+        return 'excellon'
+    return None
+
+
+def file_kind(file_path):
+    # 'png', 'svg', 'gerber', 'excellon' or None
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _kinds:
+        with open(file_path, 'rb') as file:
+            head = file.read(HEAD_SIZE)
+            tail = b''
+            if stat.st_size > HEAD_SIZE:
+                file.seek(stat.st_size - TAIL_SIZE)
+                tail = file.read()
+        _kinds[memo_key] = sniff(head, tail or head)
+    return _kinds[memo_key]
+
+
+def input_kind(file_paths):
+    # How a selection of files is converted: 'svg', 'png' or 'gerber' (Gerber and Excellon files combined)
+    kinds = [file_kind(path) for path in file_paths]
+    for kind in ('svg', 'png'):
+        if kind in kinds:
+            if len(kinds) > 1:
+                raise ValueError(f"{kind.upper()} files can't be combined with other files")
+            return kind
+    return 'gerber'
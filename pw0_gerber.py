@@ -0,0 +1,772 @@
+'''
+    In-process renderer for the RS-274X and Excellon subset PCB tools export:
+
+        standard and macro apertures, flashes, linear and circular draws,
+        regions, dark/clear polarity, drill hits and routed/G85 slots
+
+    Files are parsed into primitives in inches, which are then drawn into a 1 bpp
+    image at printer DPI, one per file. The layers are combined as bitmaps: copper
+    black on white with the drill holes white on top of it, the same colors the gerbv
+    pipeline produces. Anything outside the subset
+    raises ValueError, so callers can fall back to gerbv.
+'''
+
+import ast
+import math
+import multiprocessing
+import operator
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import pw0_trace
+from pw0_trace import report_progress
+from pw0_bitmap import PackedBitmap, VirtualCanvas
+
+
+MM_PER_INCH = 25.4
+ARC_TOLERANCE = 0.25    # max distance between an arc and the chords it's drawn with, in pixels
+CIRCLE_POINTS = 32      # vertices of a circle when it's part of a swept outline
+PROGRESS_PRIMITIVES = 2000  # primitives drawn between progress reports, which are also the cancel points
+
+
+def is_gerber(text):
+    # Every RS-274X file has a format statement, Excellon files don't
+    return '%FS' in text
+
+
+def rotate(points, degrees):
+    if not degrees:
+        return points
+    angle = math.radians(degrees)
+    cos, sin = math.cos(angle), math.sin(angle)
+    return [(x * cos - y * sin, x * sin + y * cos) for x, y in points]
+
+
+def circle_points(cx, cy, r, count=CIRCLE_POINTS):
+    return [(cx + r * math.cos(2 * math.pi * i / count), cy + r * math.sin(2 * math.pi * i / count))
+            for i in range(count)]
+
+
+def rectangle_points(cx, cy, width, height):
+    w, h = width / 2, height / 2
+    return [(cx - w, cy - h), (cx + w, cy - h), (cx + w, cy + h), (cx - w, cy + h)]
+
+
+def convex_hull(points):
+    # Monotone chain, counter-clockwise without repeating the first point
+    points = sorted(set(points))
+    if len(points) <= 2:
+        return points
+
+    def half(points):
+        hull = []
+        for p in points:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    lower = half(points)
+    upper = half(reversed(points))
+    return lower[:-1] + upper[:-1]
+
+
+class Aperture:
+    '''
+            Shapes are ('circle', exposure, cx, cy, r) or ('polygon', exposure, points)
+            in inches around the flash point, exposure False clears instead of darkening
+    '''
+    __slots__ = ('shapes', 'radius', 'outline', 'extent')
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        # A plain centered circle, with or without a hole, is drawn as a round-capped stroke,
+        # anything else is swept. Holes only apply to flashes
+        self.radius = None
+        dark = [shape for shape in shapes if shape[1]]
+        if len(dark) == 1 and dark[0][0] == 'circle' and dark[0][2:4] == (0, 0):
+            self.radius = dark[0][4]
+
+        points = []
+        for shape in shapes:
+            if shape[0] == 'circle':
+                points += circle_points(*shape[2:])
+            else:
+                points += shape[2]
+        self.outline = convex_hull(points)
+        self.extent = max((math.hypot(x, y) for x, y in points), default=0)
+
+
+def standard_aperture(template, params, unit):
+    # The optional hole is a clear circle in the middle, drawn like exposure off in a macro
+    hole_index = {'C': 1, 'R': 2, 'O': 2, 'P': 3}.get(template)
+    hole = []
+    if hole_index is not None and len(params) > hole_index and params[hole_index] > 0:
+        hole = [('circle', False, 0, 0, params[hole_index] * unit / 2)]
+
+    if template == 'P':
+        diameter, vertices = params[0] * unit, round(params[1])
+        points = circle_points(0, 0, diameter / 2, vertices)
+        return Aperture([('polygon', True, rotate(points, params[2] if len(params) > 2 else 0))] + hole)
+
+    params = [p * unit for p in params]
+    if template == 'C':
+        return Aperture([('circle', True, 0, 0, params[0] / 2)] + hole)
+    if template == 'R':
+        return Aperture([('polygon', True, rectangle_points(0, 0, params[0], params[1]))] + hole)
+    if template == 'O':
+        width, height = params[:2]
+        if width > height:
+            offset, r = (width - height) / 2, height / 2
+            return Aperture([('polygon', True, rectangle_points(0, 0, width - height, height)),
+                             ('circle', True, -offset, 0, r), ('circle', True, offset, 0, r)] + hole)
+        offset, r = (height - width) / 2, width / 2
+        return Aperture([('polygon', True, rectangle_points(0, 0, width, height - width)),
+                         ('circle', True, 0, -offset, r), ('circle', True, 0, offset, r)] + hole)
+    raise ValueError(f"Unknown aperture template {template}")
+
+
+EXPRESSION_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+                        ast.Div: operator.truediv, ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+def evaluate(expression, variables):
+    # Macro arithmetic: numbers, $n variables, + - x / and parentheses
+    expression = re.sub(r'\$(\d+)', r'v\1', expression.replace('x', '*').replace('X', '*'))
+
+    def value(node):
+        if isinstance(node, ast.Expression):
+            return value(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return float(node.value)
+        if isinstance(node, ast.Name):
+            return variables.get(int(node.id[1:]), 0.0)   # undefined variables are 0
+        if isinstance(node, ast.BinOp) and type(node.op) in EXPRESSION_OPERATORS:
+            return EXPRESSION_OPERATORS[type(node.op)](value(node.left), value(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in EXPRESSION_OPERATORS:
+            return EXPRESSION_OPERATORS[type(node.op)](value(node.operand))
+        raise ValueError(f"Invalid macro expression {expression}")
+
+    try:
+        return value(ast.parse(expression, mode='eval'))
+    except SyntaxError:
+        raise ValueError(f"Invalid macro expression {expression}")
+
+
+def thermal_points(cx, cy, outer, inner, gap):
+    # The four ring quadrants of a thermal, each as a polygon
+    ro, ri, g = outer / 2, inner / 2, gap / 2
+    quadrants = []
+    for quadrant in range(4):
+        base = quadrant * 90
+        outer_start = math.degrees(math.asin(min(g / ro, 1)))
+        inner_start = math.degrees(math.asin(min(g / ri, 1))) if ri > g else 45
+        steps = CIRCLE_POINTS // 4
+        points = [(ro * math.cos(math.radians(base + outer_start + (90 - 2 * outer_start) * i / steps)),
+                   ro * math.sin(math.radians(base + outer_start + (90 - 2 * outer_start) * i / steps)))
+                  for i in range(steps + 1)]
+        points += [(ri * math.cos(math.radians(base + 90 - inner_start - (90 - 2 * inner_start) * i / steps)),
+                    ri * math.sin(math.radians(base + 90 - inner_start - (90 - 2 * inner_start) * i / steps)))
+                   for i in range(steps + 1)]
+        quadrants.append([(cx + x, cy + y) for x, y in points])
+    return quadrants
+
+
+def macro_aperture(body, params, unit):
+    variables = {i + 1: p for i, p in enumerate(params)}
+    shapes = []
+    for statement in body:
+        if statement.startswith('0'):   # comment
+            continue
+        if statement.startswith('$'):
+            name, expression = statement[1:].split('=', 1)
+            variables[int(name)] = evaluate(expression, variables)
+            continue
+
+        code, *modifiers = statement.split(',')
+        code = int(code)
+        m = [evaluate(modifier, variables) for modifier in modifiers]
+        exposure = m[0] != 0 if code != 7 else True
+        if code == 1:
+            points = rotate([(m[2], m[3])], m[4] if len(m) > 4 else 0)
+            shapes.append(('circle', exposure, *points[0], m[1] / 2))
+        elif code in (2, 20):
+            (sx, sy), (ex, ey) = (m[2], m[3]), (m[4], m[5])
+            length = math.hypot(ex - sx, ey - sy)
+            if length == 0:
+                continue
+            nx, ny = -(ey - sy) / length * m[1] / 2, (ex - sx) / length * m[1] / 2
+            points = [(sx + nx, sy + ny), (ex + nx, ey + ny), (ex - nx, ey - ny), (sx - nx, sy - ny)]
+            shapes.append(('polygon', exposure, rotate(points, m[6])))
+        elif code == 21:
+            shapes.append(('polygon', exposure, rotate(rectangle_points(m[3], m[4], m[1], m[2]), m[5])))
+        elif code == 22:
+            points = rectangle_points(m[3] + m[1] / 2, m[4] + m[2] / 2, m[1], m[2])
+            shapes.append(('polygon', exposure, rotate(points, m[5])))
+        elif code == 4:
+            count = round(m[1])
+            points = [(m[2 + 2 * i], m[3 + 2 * i]) for i in range(count + 1)]
+            shapes.append(('polygon', exposure, rotate(points, m[4 + 2 * count])))
+        elif code == 5:
+            points = circle_points(m[2], m[3], m[4] / 2, round(m[1]))
+            # the polygon rotates around the macro origin, not its center
+            shapes.append(('polygon', exposure, rotate(points, m[5] if len(m) > 5 else 0)))
+        elif code == 7:
+            for points in thermal_points(*m[:5]):
+                shapes.append(('polygon', True, rotate(points, m[5])))
+        else:
+            raise ValueError(f"Aperture macro primitive {code} is not supported")
+
+    scaled = []
+    for shape in shapes:
+        if shape[0] == 'circle':
+            scaled.append(('circle', shape[1], shape[2] * unit, shape[3] * unit, shape[4] * unit))
+        else:
+            scaled.append(('polygon', shape[1], [(x * unit, y * unit) for x, y in shape[2]]))
+    return Aperture(scaled)
+
+
+def arc_points(start, end, center, clockwise, dpi):
+    # Chord points of an arc from start to end, start itself is not included
+    (x0, y0), (x1, y1), (cx, cy) = start, end, center
+    r = math.hypot(x0 - cx, y0 - cy)
+    a0 = math.atan2(y0 - cy, x0 - cx)
+    a1 = math.atan2(y1 - cy, x1 - cx)
+    sweep = (a0 - a1) if clockwise else (a1 - a0)
+    sweep %= 2 * math.pi
+    if sweep < 1e-9:
+        sweep = 2 * math.pi     # start == end is a full circle
+
+    r_px = r * dpi
+    step = 2 * math.acos(1 - ARC_TOLERANCE / r_px) if r_px > ARC_TOLERANCE else math.pi / 2
+    count = max(int(math.ceil(sweep / step)), 1)
+    direction = -1 if clockwise else 1
+    points = [(cx + r * math.cos(a0 + direction * sweep * i / count), cy + r * math.sin(a0 + direction * sweep * i / count))
+              for i in range(1, count)]
+    return points + [end]
+
+
+class GerberParser:
+    '''
+            Turns an RS-274X file into a list of primitives in inches:
+
+                ('flash', dark, aperture, x, y)
+                ('stroke', dark, aperture, points)
+                ('region', dark, points)
+    '''
+
+    def __init__(self, dpi):
+        self.dpi = dpi
+        self.integer_digits = 2
+        self.decimal_digits = 6
+        self.omit_trailing = False
+        self.unit = 1.0     # file units in inches
+        self.apertures = {}
+        self.macros = {}
+        self.aperture = None
+        self.dark = True
+        self.interpolation = 1
+        self.multi_quadrant = False
+        self.operation = None
+        self.x = self.y = 0.0
+        self.region = False
+        self.contour = []
+        self.primitives = []
+
+    def coordinate(self, text):
+        if '.' in text:
+            return float(text) * self.unit
+        if self.omit_trailing:
+            sign = -1 if text.startswith('-') else 1
+            digits = text.lstrip('+-').ljust(self.integer_digits + self.decimal_digits, '0')
+            return sign * int(digits) / 10 ** self.decimal_digits * self.unit
+        return int(text) / 10 ** self.decimal_digits * self.unit
+
+    def parse(self, text):
+        for match in re.finditer(r'%([^%]*)%|([^%*]*)\*', text):
+            if match.group(1) is not None:
+                self.extended(re.sub(r'\s', '', match.group(1)))
+            else:
+                statement = re.sub(r'\s', '', match.group(2))
+                if re.match(r'G0?4(?!\d)', statement):   # comment
+                    continue
+                if statement in ('M02', 'M2', 'M00', 'M0'):
+                    break
+                if statement:
+                    self.word(statement)
+        self.end_contour()
+        return self.primitives
+
+    def extended(self, block):
+        statements = [s for s in block.split('*') if s]
+        if not statements:
+            return
+        command = statements[0][:2]
+        if command == 'AM':
+            self.macros[statements[0][2:]] = statements[1:]
+            return
+
+        for statement in statements:
+            command, value = statement[:2], statement[2:]
+            if command == 'FS':
+                match = re.fullmatch(r'([LT]?)([AI])X(\d)(\d)Y(\d)(\d)', value)
+                if not match:
+                    raise ValueError(f"Unsupported format statement {statement}")
+                if match.group(2) == 'I':
+                    raise ValueError("Incremental coordinates are not supported")
+                self.omit_trailing = match.group(1) == 'T'
+                self.integer_digits, self.decimal_digits = int(match.group(3)), int(match.group(4))
+            elif command == 'MO':
+                self.unit = 1 / MM_PER_INCH if value == 'MM' else 1.0
+            elif command == 'AD':
+                self.define_aperture(value)
+            elif command == 'LP':
+                self.dark = value == 'D'
+            elif command == 'SR':
+                if value not in ('', 'X1Y1I0J0', 'X1Y1'):
+                    raise ValueError("Step and repeat is not supported")
+            elif command in ('LM', 'LR', 'LS'):
+                if value not in ('N', '0', '1'):
+                    raise ValueError(f"Aperture transformation {statement} is not supported")
+            elif command == 'IP':
+                if value == 'NEG':
+                    raise ValueError("Negative image polarity is not supported")
+            elif command in ('TF', 'TA', 'TO', 'TD', 'LN', 'IN', 'AS', 'OF', 'IR', 'MI', 'SF', 'IJ', 'IO', 'KO'):
+                pass    # attributes and deprecated image settings that PCB tools leave at their defaults
+            else:
+                raise ValueError(f"Unknown extended command {statement}")
+
+    def define_aperture(self, value):
+        match = re.fullmatch(r'D(\d+)([^,]+)(?:,(.*))?', value)
+        if not match:
+            raise ValueError(f"Invalid aperture definition {value}")
+        number, template, params = int(match.group(1)), match.group(2), match.group(3)
+        params = [float(p) for p in params.split('X')] if params else []
+        if template in self.macros:
+            self.apertures[number] = macro_aperture(self.macros[template], params, self.unit)
+        else:
+            self.apertures[number] = standard_aperture(template, params, self.unit)
+
+    def word(self, statement):
+        if statement.startswith(('G54', 'G55')):
+            statement = statement[3:]   # deprecated prefix of aperture selection
+        codes = re.findall(r'([GXYIJDM])([+-]?[\d.]+)', statement)
+        if ''.join(c + v for c, v in codes) != statement:
+            raise ValueError(f"Unsupported statement {statement}")
+
+        coordinates = {}
+        operation = None
+        for code, value in codes:
+            if code == 'G':
+                self.g_code(int(value))
+            elif code == 'D':
+                number = int(value)
+                if number >= 10:
+                    if number not in self.apertures:
+                        raise ValueError(f"Aperture D{number} is not defined")
+                    self.aperture = self.apertures[number]
+                else:
+                    operation = number
+            elif code == 'M':
+                pass
+            else:
+                coordinates[code] = self.coordinate(value)
+
+        if operation is None and coordinates:
+            operation = self.operation  # deprecated modal operation
+        if operation is not None:
+            self.operation = operation
+            self.operate(operation, coordinates)
+
+    def g_code(self, code):
+        if code in (1, 2, 3):
+            self.interpolation = code
+        elif code == 36:
+            self.region = True
+            self.contour = []
+        elif code == 37:
+            self.end_contour()
+            self.region = False
+        elif code == 74:
+            self.multi_quadrant = False
+        elif code == 75:
+            self.multi_quadrant = True
+        elif code == 70:
+            self.unit = 1.0
+        elif code == 71:
+            self.unit = 1 / MM_PER_INCH
+        elif code == 91:
+            raise ValueError("Incremental coordinates are not supported")
+        elif code not in (90,):
+            raise ValueError(f"G{code:02} is not supported")
+
+    def end_contour(self):
+        if len(self.contour) > 2:
+            self.primitives.append(('region', self.dark, self.contour))
+        self.contour = []
+
+    def arc_center(self, start, end, i, j, clockwise):
+        if self.multi_quadrant:
+            return (start[0] + i, start[1] + j)
+        # Single quadrant arcs have unsigned offsets, pick the center that fits both ends best
+        best = None
+        for sx, sy in ((1, 1), (1, -1), (-1, 1), (-1, -1)):
+            center = (start[0] + sx * abs(i), start[1] + sy * abs(j))
+            r0 = math.hypot(start[0] - center[0], start[1] - center[1])
+            r1 = math.hypot(end[0] - center[0], end[1] - center[1])
+            a0 = math.atan2(start[1] - center[1], start[0] - center[0])
+            a1 = math.atan2(end[1] - center[1], end[0] - center[0])
+            sweep = ((a0 - a1) if clockwise else (a1 - a0)) % (2 * math.pi)
+            if sweep <= math.pi / 2 + 1e-6 and (best is None or abs(r0 - r1) < best[0]):
+                best = (abs(r0 - r1), center)
+        return best[1] if best else (start[0] + i, start[1] + j)
+
+    def path_to(self, x, y, coordinates):
+        # Points from the current position to x, y with the current interpolation
+        if self.interpolation == 1:
+            return [(x, y)]
+        clockwise = self.interpolation == 2
+        center = self.arc_center((self.x, self.y), (x, y), coordinates.get('I', 0.0), coordinates.get('J', 0.0), clockwise)
+        if not self.multi_quadrant and (self.x, self.y) == (x, y):
+            return [(x, y)]     # a single quadrant arc can't be a full circle
+        return arc_points((self.x, self.y), (x, y), center, clockwise, self.dpi)
+
+    def operate(self, operation, coordinates):
+        x = coordinates.get('X', self.x)
+        y = coordinates.get('Y', self.y)
+        if operation == 1:
+            if self.region:
+                if not self.contour:
+                    self.contour = [(self.x, self.y)]
+                self.contour += self.path_to(x, y, coordinates)
+            else:
+                if self.aperture is None:
+                    raise ValueError("Draw without an aperture")
+                points = [(self.x, self.y)] + self.path_to(x, y, coordinates)
+                self.primitives.append(('stroke', self.dark, self.aperture, points))
+        elif operation == 2:
+            if self.region:
+                self.end_contour()
+        elif operation == 3:
+            if self.aperture is None:
+                raise ValueError("Flash without an aperture")
+            self.primitives.append(('flash', self.dark, self.aperture, x, y))
+        else:
+            raise ValueError(f"D{operation:02} is not supported")
+        self.x, self.y = x, y
+
+
+def parse_gerber(text, dpi):
+    return GerberParser(dpi).parse(text)
+
+
+def parse_excellon(text, dpi):
+    # Drill hits and slots as clear primitives, holes are white on top of the copper
+    unit = 1.0
+    integer_digits, decimal_digits = 2, 4
+    leading_zeros = False   # 'LZ': leading zeros are written and trailing ones are left out
+    format_set = False
+    tools = {}
+    tool = None
+    x = y = 0.0
+    route = False
+    tool_down = False
+    primitives = []
+
+    def coordinate(text):
+        if '.' in text:
+            return float(text) * unit
+        sign = -1 if text.startswith('-') else 1
+        digits = text.lstrip('+-')
+        if leading_zeros:
+            digits = digits.ljust(integer_digits + decimal_digits, '0')
+        return sign * int(digits) / 10 ** decimal_digits * unit
+
+    for line in text.splitlines():
+        line = line.split(';', 1)[0].strip().upper()
+        if not line:
+            continue
+
+        units = re.match(r'(METRIC|INCH)(?:,(LZ|TZ))?(?:,(0+)\.(0+))?', line)
+        if units:
+            unit = 1 / MM_PER_INCH if units.group(1) == 'METRIC' else 1.0
+            if units.group(2):
+                leading_zeros = units.group(2) == 'LZ'
+            if units.group(3):
+                integer_digits, decimal_digits = len(units.group(3)), len(units.group(4))
+                format_set = True
+            elif not format_set:
+                integer_digits, decimal_digits = (3, 3) if units.group(1) == 'METRIC' else (2, 4)
+            continue
+        if line in ('M71', 'M72'):
+            unit = 1 / MM_PER_INCH if line == 'M71' else 1.0
+            continue
+        if line in ('M30', 'M00'):
+            break
+
+        definition = re.fullmatch(r'T(\d+)(?:[FSBH][\d.]+)*C([\d.]+).*', line)
+        if definition:
+            diameter = float(definition.group(2)) * unit
+            tools[int(definition.group(1))] = Aperture([('circle', True, 0, 0, diameter / 2)])
+            tool = tools[int(definition.group(1))]
+            continue
+        selection = re.fullmatch(r'T(\d+)', line)
+        if selection:
+            tool = tools.get(int(selection.group(1)))
+            if tool is None and int(selection.group(1)) != 0:
+                raise ValueError(f"Drill tool T{selection.group(1)} is not defined")
+            continue
+
+        if line == 'M15':
+            tool_down = True
+            continue
+        if line in ('M16', 'M17'):
+            tool_down = False
+            continue
+        if line == 'G05':
+            route = False
+            continue
+        if line.startswith(('M48', 'M95', '%', 'FMAT', 'ICI', 'G90', 'VER', 'DETECT', 'ATC', 'M47')):
+            continue
+        if line.startswith(('G91', 'R', 'G02', 'G03')):
+            raise ValueError(f"Excellon command {line} is not supported")
+
+        match = re.fullmatch(r'(G0[01])?(?:X([+-]?[\d.]+))?(?:Y([+-]?[\d.]+))?(?:G85(?:X([+-]?[\d.]+))?(?:Y([+-]?[\d.]+))?)?', line)
+        if not match or not any(match.groups()):
+            continue    # header parameters and other commands that don't draw anything
+        g, mx, my, sx, sy = match.groups()
+        new_x = coordinate(mx) if mx else x
+        new_y = coordinate(my) if my else y
+        if g == 'G00':
+            route = True
+            x, y = new_x, new_y
+            continue
+        if tool is None:
+            raise ValueError("Drill hit without a tool")
+        if g == 'G01' or (route and not sx and not sy):
+            if tool_down:
+                primitives.append(('stroke', False, tool, [(x, y), (new_x, new_y)]))
+            x, y = new_x, new_y
+            continue
+        if 'G85' in line:
+            end_x = coordinate(sx) if sx else new_x
+            end_y = coordinate(sy) if sy else new_y
+            primitives.append(('stroke', False, tool, [(new_x, new_y), (end_x, end_y)]))
+            x, y = end_x, end_y
+            continue
+        x, y = new_x, new_y
+        primitives.append(('flash', False, tool, x, y))
+
+    return primitives
+
+
+def primitives_bbox(primitives):
+    xs, ys = [], []
+    for primitive in primitives:
+        if primitive[0] == 'flash':
+            _, _, aperture, x, y = primitive
+            xs += [x - aperture.extent, x + aperture.extent]
+            ys += [y - aperture.extent, y + aperture.extent]
+        elif primitive[0] == 'stroke':
+            extent = primitive[2].extent
+            xs += [p[0] - extent for p in primitive[3]] + [p[0] + extent for p in primitive[3]]
+            ys += [p[1] - extent for p in primitive[3]] + [p[1] + extent for p in primitive[3]]
+        else:
+            xs += [p[0] for p in primitive[2]]
+            ys += [p[1] for p in primitive[2]]
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class Canvas:
+    # 1 bpp PIL image with the board coordinates mapped to pixels, y grows upwards in Gerber
+    __slots__ = ('image', 'draw', 'dpi', 'left', 'top')
+
+    def __init__(self, size, dpi, left, top, background=1):
+        self.image = Image.new('1', size, background)
+        self.draw = ImageDraw.Draw(self.image)
+        self.dpi = dpi
+        self.left = left
+        self.top = top
+
+    def px(self, x, y):
+        return ((x - self.left) * self.dpi - 0.5, (self.top - y) * self.dpi - 0.5)
+
+    def circle(self, x, y, r, fill):
+        px, py = self.px(x, y)
+        r *= self.dpi
+        self.draw.ellipse([px - r, py - r, px + r, py + r], fill=fill)
+
+    def polygon(self, points, fill):
+        self.draw.polygon([self.px(x, y) for x, y in points], fill=fill)
+
+    def flash(self, aperture, x, y, dark):
+        for shape in aperture.shapes:
+            fill = 0 if dark == shape[1] else 1
+            if shape[0] == 'circle':
+                self.circle(x + shape[2], y + shape[3], shape[4], fill)
+            else:
+                self.polygon([(x + px, y + py) for px, py in shape[2]], fill)
+
+    def stroke(self, aperture, points, dark):
+        fill = 0 if dark else 1
+        if aperture.radius is not None:
+            r = aperture.radius
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                length = math.hypot(x1 - x0, y1 - y0)
+                if length:
+                    nx, ny = -(y1 - y0) / length * r, (x1 - x0) / length * r
+                    self.polygon([(x0 + nx, y0 + ny), (x1 + nx, y1 + ny), (x1 - nx, y1 - ny), (x0 - nx, y0 - ny)], fill)
+            for x, y in points:
+                self.circle(x, y, r, fill)
+            return
+
+        # Other apertures: the convex hull of the outline at both ends of every segment
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            swept = [(x0 + x, y0 + y) for x, y in aperture.outline] + [(x1 + x, y1 + y) for x, y in aperture.outline]
+            self.polygon(convex_hull(swept), fill)
+
+    def render(self, primitives):
+        for primitive in primitives:
+            if primitive[0] == 'flash':
+                _, dark, aperture, x, y = primitive
+                self.flash(aperture, x, y, dark)
+            elif primitive[0] == 'stroke':
+                _, dark, aperture, points = primitive
+                self.stroke(aperture, points, dark)
+            else:
+                _, dark, points = primitive
+                self.polygon(points, 0 if dark else 1)
+
+
+def parse_file(file_path, dpi):
+    # Returns [is_gerber, primitives]
+    with open(file_path, 'r', errors='replace') as file:
+        text = file.read()
+    if is_gerber(text):
+        return [True, parse_gerber(text, dpi)]
+    return [False, parse_excellon(text, dpi)]
+
+
+def render_layer(file_path, dpi, progress=(0.0, 1.0)):
+    '''
+            Renders one file on its own, returns [is_gerber, bitmap, (x, y)]. x, y is the
+            position of the bitmap on a pixel grid anchored at the board origin, so layers
+            rendered separately line up. Copper is black on white, drill holes white on black.
+            progress is the part of the 'rasterize' stage this file reports as
+    '''
+
+    first, last = progress
+    report_progress('rasterize', first)
+    gerber, primitives = parse_file(file_path, dpi)
+    bbox = primitives_bbox(primitives)
+    if bbox is None:
+        return [gerber, None, (0, 0)]
+
+    x = math.floor(bbox[0] * dpi)
+    y = math.floor(-bbox[3] * dpi)
+    width = math.ceil(bbox[2] * dpi) - x + 1
+    height = math.ceil(-bbox[1] * dpi) - y + 1
+    canvas = Canvas((width, height), dpi, x / dpi, -y / dpi, 1 if gerber else 0)
+    for start in range(0, len(primitives), PROGRESS_PRIMITIVES):
+        report_progress('rasterize', first + (last - first) * start / len(primitives))
+        canvas.render(primitives[start:start + PROGRESS_PRIMITIVES])
+    return [gerber, PackedBitmap.from_image(canvas.image), (x, y)]
+
+
+def paste_clipped(target, bitmap, position, op):
+    # Combines the part of bitmap that falls inside target
+    x, y = position
+    box = (max(-x, 0), max(-y, 0), min(bitmap.width, target.width - x), min(bitmap.height, target.height - y))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return
+    if box != (0, 0, bitmap.width, bitmap.height):
+        bitmap = bitmap.crop(box)
+    target.paste(bitmap, (x + box[0], y + box[1]), op)
+
+
+def composite_layers(layers, resolution):
+    '''
+            Combines render_layer() results into a VirtualCanvas of the given resolution
+            with the board in the middle: copper AND NOT drills. Clear polarity in a copper
+            layer only affects that layer. Only the board area is held in memory
+    '''
+
+    layers = [layer for layer in layers if layer[1] is not None]
+    if not layers:
+        raise ValueError("Nothing to print, the Gerber files are empty")
+
+    left = min(x for _, _, (x, y) in layers)
+    top = min(y for _, _, (x, y) in layers)
+    right = max(x + bitmap.width for _, bitmap, (x, y) in layers)
+    bottom = max(y + bitmap.height for _, bitmap, (x, y) in layers)
+    offset_x = (resolution[0] - (right - left)) // 2 - left
+    offset_y = (resolution[1] - (bottom - top)) // 2 - top
+
+    # Board area on the LCD, a board larger than the LCD is cut off
+    board_left, board_top = max(left + offset_x, 0), max(top + offset_y, 0)
+    board_right, board_bottom = min(right + offset_x, resolution[0]), min(bottom + offset_y, resolution[1])
+
+    # With only drill files the holes show up on a black board
+    copper = any(gerber for gerber, _, _ in layers)
+    result = VirtualCanvas(resolution[0], resolution[1], white=copper)
+    board = PackedBitmap.blank(board_right - board_left, board_bottom - board_top, white=copper)
+    for gerber, bitmap, (x, y) in sorted(layers, key=lambda layer: not layer[0]):   # copper first
+        paste_clipped(board, bitmap, (x + offset_x - board_left, y + offset_y - board_top),
+                      np.logical_and if gerber else np.logical_or)
+    result.place(board, (board_left, board_top))
+    return result
+
+
+def clear_progress_listeners():
+    # Pool initializer, a forked worker would otherwise call the listeners it copied from its parent
+    pw0_trace.progress_listeners.clear()
+
+
+@pw0_trace.traced('rasterize_gerber')
+def render_files(file_paths, resolution, dpi, workers=None, cache=None):
+    '''
+            Renders every file in its own process and composites them, see composite_layers().
+            cache is a pw0_cache.RenderCache, layers found in it aren't rendered again
+    '''
+
+    layers = [None] * len(file_paths)
+    keys = [None] * len(file_paths)
+    if cache is not None:
+        for index, path in enumerate(file_paths):
+            keys[index] = cache.key([path], {'kind': 'layer', 'dpi': dpi})
+            layers[index] = cache.get_layer(keys[index])
+    missing = [index for index, layer in enumerate(layers) if layer is None]
+
+    paths = [file_paths[index] for index in missing]
+    if len(paths) <= 1 or workers == 1:
+        rendered = [render_layer(path, dpi, (index / len(paths), (index + 1) / len(paths)))
+                    for index, path in enumerate(paths)]
+    else:
+        # Forking from a thread other than the main one, like the GUI's worker thread, copies locks
+        # that other threads hold into the workers, they are spawned instead. Either way they start
+        # without the progress listeners of this process, progress is counted in finished files
+        context = None if threading.current_thread() is threading.main_thread() else multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=clear_progress_listeners) as executor:
+            futures = [executor.submit(render_layer, path, dpi) for path in paths]
+            try:
+                for count, _ in enumerate(as_completed(futures)):
+                    report_progress('rasterize', (count + 1) / len(paths))
+            except BaseException:   # cancelled, files that haven't started aren't rendered
+                for future in futures:
+                    future.cancel()
+                raise
+            rendered = [future.result() for future in futures]
+
+    for index, layer in zip(missing, rendered):
+        layers[index] = layer
+        if cache is not None:
+            cache.put_layer(keys[index], layer)
+    return composite_layers(layers, resolution)
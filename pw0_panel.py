@@ -0,0 +1,95 @@
+'''
+    Panelizer: packs several boards, or copies of one, onto the printer's LCD so
+    that they are exposed and encoded together.
+
+    Boards are cropped to their black pixels and placed with MaxRects (best short
+    side fit). The gap is added to every board and to the far edges of the LCD, so
+    neighbours end up at least gap pixels apart. Boards aren't rotated.
+'''
+
+import pw0_trace
+from pw0_bitmap import VirtualCanvas
+
+
+def split_free_rect(free, used):
+    # Parts of the free rectangle that the used one doesn't cover
+    fx, fy, fw, fh = free
+    x, y, w, h = used
+    if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+        return [free]
+
+    parts = []
+    if x > fx:
+        parts.append((fx, fy, x - fx, fh))
+    if x + w < fx + fw:
+        parts.append((x + w, fy, fx + fw - x - w, fh))
+    if y > fy:
+        parts.append((fx, fy, fw, y - fy))
+    if y + h < fy + fh:
+        parts.append((fx, y + h, fw, fy + fh - y - h))
+    return parts
+
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[0] + inner[2] <= outer[0] + outer[2] and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def pack_rectangles(sizes, bin_size, gap=0):
+    # Returns the top left corner of every rectangle, in the order of sizes
+    bin_width, bin_height = bin_size[0] + gap, bin_size[1] + gap
+    free_rects = [(0, 0, bin_width, bin_height)]
+    positions = [None] * len(sizes)
+
+    # Large boards first, they are the hardest to fit
+    order = sorted(range(len(sizes)), key=lambda i: (max(sizes[i]), sizes[i][0] * sizes[i][1]), reverse=True)
+    for index in order:
+        width, height = sizes[index][0] + gap, sizes[index][1] + gap
+        best = None
+        for fx, fy, fw, fh in free_rects:
+            if width <= fw and height <= fh:
+                score = (min(fw - width, fh - height), max(fw - width, fh - height), fy, fx)
+                if best is None or score < best:
+                    best = score
+        if best is None:
+            raise ValueError(f"Board {index + 1} of {len(sizes)} doesn't fit on the display")
+
+        x, y = best[3], best[2]
+        positions[index] = (x, y)
+        used = (x, y, width, height)
+        free_rects = [part for free in free_rects for part in split_free_rect(free, used)]
+        free_rects = [rect for i, rect in enumerate(free_rects)
+                      if not any(j != i and contains(other, rect) and (other != rect or j < i)
+                                 for j, other in enumerate(free_rects))]
+    return positions
+
+
+def crop_board(bitmap):
+    bbox = bitmap.getbbox()
+    if not bbox:
+        raise ValueError("Nothing to print, the rendered image is empty")
+    return bitmap.crop(bbox)
+
+
+@pw0_trace.traced('panelize')
+def panelize(bitmaps, resolution, gap, copies=1):
+    '''
+            Places copies of every bitmap on a white VirtualCanvas of the given resolution,
+            returns [panel, board positions]. The packed group is centered on the LCD
+    '''
+
+    print('\n---PANELIZING---')
+    boards = [board for board in map(crop_board, bitmaps) for _ in range(copies)]
+    positions = pack_rectangles([board.size for board in boards], resolution, gap)
+
+    used_width = max(x + board.width for board, (x, y) in zip(boards, positions))
+    used_height = max(y + board.height for board, (x, y) in zip(boards, positions))
+    offset_x = (resolution[0] - used_width) // 2
+    offset_y = (resolution[1] - used_height) // 2
+    positions = [(x + offset_x, y + offset_y) for x, y in positions]
+
+    panel = VirtualCanvas(resolution[0], resolution[1])
+    for board, position in zip(boards, positions):
+        panel.place(board, position)
+    print(f"{len(boards)} boards placed")
+    return [panel, positions]
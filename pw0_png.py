@@ -0,0 +1,122 @@
+'''
+    Streaming PNG decoder for source images too large to load at once.
+
+    The image data is inflated with zlib a piece at a time and cut into bands of
+    rows. PIL undoes the row filters of every band: the band goes through its PNG
+    decoder with the last row of the band before in front of it, stored without a
+    filter, since Up, Average and Paeth rows refer to the row above. Only 8-bit
+    container modes are needed for that, so every format whose pixels fit in 1 to
+    4 bytes works, 16-bit grayscale with or without alpha included. 16-bit RGB and
+    RGBA (6 and 8 bytes) and interlaced files can't be split into bands this way
+    and are loaded whole, png_streamable() tells them apart.
+'''
+
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from pw0_bitmap import BAND_ROWS
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}   # by colour type
+FILTER_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}   # by bytes per pixel
+PIECE_SIZE = 1 << 20
+
+
+def png_layout(input_png):
+    # [width, height, bits per pixel, interlaced] from the IHDR chunk, None if it's not a PNG file
+    with open(input_png, 'rb') as file:
+        header = file.read(33)
+    if len(header) < 33 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    width, height, depth, color_type, _, _, interlace = struct.unpack_from('>IIBBBBB', header, 16)
+    return [width, height, depth * PNG_CHANNELS.get(color_type, 0), bool(interlace)]
+
+
+def png_streamable(input_png):
+    layout = png_layout(input_png)
+    return layout is not None and layout[2] > 0 and not layout[3] and max(layout[2] // 8, 1) in FILTER_MODES
+
+
+def png_data_pieces(file, piece_size=PIECE_SIZE):
+    # Inflated image data of the IDAT chunks, at most piece_size bytes at a time
+    if file.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    decompressor = zlib.decompressobj()
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            raise ValueError("PNG file is truncated")
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            yield decompressor.flush()
+            return
+        if chunk_type != b'IDAT':
+            file.seek(length + 4, 1)    # chunk data and CRC
+            continue
+
+        remaining = length
+        while remaining:
+            data = file.read(min(remaining, piece_size))
+            if not data:
+                raise ValueError("PNG file is truncated")
+            remaining -= len(data)
+            # Mostly blank scans inflate a thousandfold, the output is limited as well
+            while data:
+                yield decompressor.decompress(data, piece_size)
+                data = decompressor.unconsumed_tail
+        file.seek(4, 1)
+
+
+def png_bands(input_png, band_rows=BAND_ROWS, rows=None):
+    '''
+            Decodes a PNG band by band, yields [source rows, band] with band as a
+            PIL image in the mode Image.open() gives. Without rows a band holds
+            band_rows rows, with a sorted array of row indices only those rows
+            are kept and bands without any are skipped
+    '''
+
+    with Image.open(input_png) as image:    # only reads the chunks before the image data
+        rawmode = image.tile[0][3]
+        mode, palette, info = image.mode, image.palette, dict(image.info)
+    width, height, bits, _ = png_layout(input_png)
+    bytes_per_pixel = max(bits // 8, 1)
+    filter_mode = FILTER_MODES[bytes_per_pixel]
+    row_bytes = (width * bits + 7) // 8
+
+    previous = bytes(row_bytes)     # the row above the first one counts as zeros
+    pending = bytearray()
+    top = 0
+    with open(input_png, 'rb') as file:
+        for piece in png_data_pieces(file):
+            pending += piece
+            while top < height:
+                count = min(band_rows, height - top)
+                size = count * (row_bytes + 1)  # every row starts with its filter type
+                if len(pending) < size:
+                    break
+                data = zlib.compress(b'\0' + previous + pending[:size], 0)
+                del pending[:size]
+                unfiltered = Image.frombytes(filter_mode, (row_bytes // bytes_per_pixel, count + 1), data,
+                                             'zip', filter_mode).tobytes()
+                previous = unfiltered[-row_bytes:]
+
+                source_rows = np.arange(top, top + count)
+                pixels = np.frombuffer(unfiltered, dtype=np.uint8, offset=row_bytes).reshape(count, row_bytes)
+                if rows is not None:
+                    source_rows = rows[np.searchsorted(rows, top):np.searchsorted(rows, top + count)]
+                    pixels = pixels[source_rows - top]
+                top += count
+                if not source_rows.size:
+                    continue
+
+                band = Image.frombytes(mode, (width, source_rows.size), pixels.tobytes(), 'raw', rawmode)
+                if palette is not None:
+                    band.putpalette(palette.palette, palette.rawmode)
+                band.info = dict(info)  # keeps the transparency
+                yield [source_rows, band]
+    if top < height:
+        raise ValueError("PNG image data is truncated")
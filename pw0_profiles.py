@@ -0,0 +1,85 @@
+'''
+    Printer template profiles: what the converters read from a template, stored
+    in a JSON file so that a known template loads without opening it.
+
+        {'path': ..., 'size': ..., 'mtime_ns': ..., 'sha256': ...,
+         'printer_name': 'Photon Mono 4', 'pixel_size': 17.0, 'resolution': [9024, 5120],
+         'display_properties': [...], 'layer_data': [...], 'layer_count': 1, 'sections': {'HEADER': 52, ...}}
+
+    Profiles are keyed by the absolute path and checked against the file's size
+    and modification time, a changed template is parsed again. The least recently
+    used profiles are dropped once there are more than max_profiles.
+'''
+
+import json
+import os
+
+import pw0_cache
+from pw0_file import PW0File
+from pw0_utils import atomic_write
+
+
+PROFILES_VERSION = 1    # bump when profiles get new or different fields
+
+
+def read_profile(file_path):
+    # Parses the template, see the module docstring for the fields
+    stat = os.stat(file_path)
+    with PW0File(file_path) as printer_file:
+        display_properties = printer_file.display_properties()
+        profile = {
+            'path': os.path.abspath(file_path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'printer_name': printer_file.machine.machine_name,
+            'pixel_size': display_properties[0],
+            'resolution': display_properties[1:3],
+            'display_properties': display_properties,
+            'layer_data': printer_file.layer_data(),
+            'layer_count': len(printer_file.layers),
+            'sections': dict(printer_file.sections),
+        }
+    profile['sha256'] = pw0_cache.file_digest(file_path)
+    return profile
+
+
+class ProfileStore:
+    __slots__ = ('file_path', 'max_profiles', 'profiles')
+
+    def __init__(self, file_path=None, max_profiles=64):
+        # Without a file the profiles only live as long as the store
+        self.file_path = file_path
+        self.max_profiles = max_profiles
+        self.profiles = {}  # path -> profile, least recently used first
+        if file_path:
+            try:
+                with open(file_path) as file:
+                    data = json.load(file)
+                if data.get('version') == PROFILES_VERSION:
+                    self.profiles = data['profiles']
+            except (FileNotFoundError, ValueError, KeyError):    # no or broken store, starts empty
+                pass
+
+    def get(self, file_path):
+        # Returns the profile of the template, parsing it only if it's new or has changed
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        profile = self.profiles.pop(path, None)
+        fresh = profile is not None and profile['size'] == stat.st_size and profile['mtime_ns'] == stat.st_mtime_ns
+        if not fresh:
+            profile = read_profile(path)
+        self.profiles[path] = profile   # moves it to the end, most recently used
+        while len(self.profiles) > self.max_profiles:
+            del self.profiles[next(iter(self.profiles))]
+        if not fresh:
+            self.save()
+        return profile
+
+    def save(self):
+        if not self.file_path:
+            return
+        directory = os.path.dirname(self.file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with atomic_write(self.file_path) as file:
+            file.write(json.dumps({'version': PROFILES_VERSION, 'profiles': self.profiles}, indent=1).encode())
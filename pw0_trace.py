@@ -0,0 +1,261 @@
+'''
+    Per-stage tracing. Pipeline stages run inside stage(), which measures them and
+    passes a record to every sink in trace_sinks:
+
+        {'stage': 'binarize', 'wall_s': 0.41, 'cpu_s': 0.40, 'peak_traced_mb': 312.0,
+         'size': [9024, 5120], 'bytes_in': ..., 'bytes_out': ..., 'pid': ..., 'thread': ...}
+
+    A sink is any callable that takes the record. add_sink() registers one and starts
+    tracemalloc, setting PW0_TRACE=file.jsonl adds a JsonLinesSink that way at import,
+    worker processes inherit it, so production runs can be profiled without code
+    changes. tracemalloc slows down code that allocates many small Python objects, it
+    only runs while tracing.
+
+    peak_traced_mb is the most memory the stage had allocated on top of what was
+    allocated when it started, numpy arrays included. Nested stages count for their
+    outer stage as well. Stages running at the same time on different threads share
+    one tracemalloc peak, so theirs are only approximate. Sinks appended to trace_sinks
+    directly get records without it unless tracemalloc was started otherwise.
+
+    Heavy dependencies are imported with load_module() when they're first needed,
+    `python pw0_trace.py` prints what every dependency costs on a cold start.
+'''
+
+import functools
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+trace_sinks = []
+memory_stages = threading.local()    # [traced at start, peak so far] of the open stages of a thread
+progress_listeners = []     # called as listener(stage, fraction) during a conversion, raising in one stops it
+
+
+class JsonLinesSink:
+    # Appends every record as a line of JSON, safe to share between threads and processes
+    __slots__ = ('file_path', 'lock')
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock, open(self.file_path, 'a') as file:
+            file.write(line)
+
+
+class MemorySink:
+    __slots__ = ('records',)
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+def report_progress(stage, fraction=0.0):
+    # Stages are 'vectorize', 'rasterize', 'binarize', 'encode' and 'write'
+    for listener in progress_listeners:
+        listener(stage, fraction)
+
+
+def add_sink(sink):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    trace_sinks.append(sink)
+
+
+def peak_rss_mb():
+    # Peak RSS over the lifetime of the process, not of a stage, None on Windows
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024   # bytes on macOS, KB elsewhere
+
+
+def emit(record):
+    for sink in list(trace_sinks):
+        sink(record)
+
+
+def memory_start():
+    if not tracemalloc.is_tracing():
+        return
+    stack = memory_stages.__dict__.setdefault('stack', [])
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:   # reset_peak() below drops the peak the outer stage has reached so far
+        stack[-1][1] = max(stack[-1][1], peak)
+    stack.append([current, current])
+    tracemalloc.reset_peak()
+
+
+def memory_stop():
+    # Peak memory of the stage in bytes over what it started with, None if memory_start() didn't measure
+    stack = getattr(memory_stages, 'stack', None)
+    if not stack or not tracemalloc.is_tracing():
+        return None
+    start, peak = stack.pop()
+    peak = max(peak, tracemalloc.get_traced_memory()[1])
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    return peak - start
+
+
+def finish(record, wall, cpu, peak=None):
+    record['wall_s'] = wall
+    record['cpu_s'] = cpu
+    if peak is not None:
+        record['peak_traced_mb'] = peak / (1024 * 1024)
+    record['pid'] = os.getpid()
+    record['thread'] = threading.current_thread().name
+    emit(record)
+
+
+@contextmanager
+def stage(name, **fields):
+    # The stage can add fields (size, bytes_in, bytes_out, ...) to the record it gets
+    record = {'stage': name, **fields}
+    if not trace_sinks:
+        yield record
+        return
+
+    memory_start()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        finish(record, wall, cpu, memory_stop())
+
+
+def data_size(value):
+    # Returns [bytes, [width, height] or None] of what a stage takes or gives
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return [len(value), None]
+    if isinstance(value, str):  # file path
+        return [os.path.getsize(value) if os.path.isfile(value) else None, None]
+    if hasattr(value, 'unpack_rows'):  # PackedBitmap or VirtualCanvas
+        return [value.nbytes, list(value.size)]
+    if hasattr(value, 'getbands'):  # PIL image
+        width, height = value.size
+        row_bytes = (width + 7) // 8 if value.mode == '1' else width * len(value.getbands())
+        return [row_bytes * height, [width, height]]
+    if isinstance(value, (list, tuple)) and value:
+        if all(isinstance(item, str) for item in value):
+            sizes = [data_size(item)[0] for item in value]
+            return [sum(size for size in sizes if size), None]
+        return data_size(value[0])
+    return [None, None]
+
+
+def traced(name):
+    # Decorator form of stage(), the first argument and the result give the sizes
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not trace_sinks:
+                return function(*args, **kwargs)
+            with stage(name) as record:
+                record['bytes_in'], record['size'] = data_size(args[0]) if args else [None, None]
+                result = function(*args, **kwargs)
+                record['bytes_out'], size_out = data_size(result)
+                record['size'] = size_out or record['size']
+                return result
+        return wrapper
+    return decorator
+
+
+def traced_chunks(name, chunks, **fields):
+    # stage() for a stream of [rll_chunk, white_pixel_count], only the time spent making chunks counts
+    if not trace_sinks:
+        yield from chunks
+        return
+
+    record = {'stage': name, **fields, 'bytes_out': 0}
+    wall = cpu = 0.0
+    peak = None     # the consumer runs other stages between chunks, every chunk is measured on its own
+    chunks = iter(chunks)
+    try:
+        while True:
+            start_wall, start_cpu = time.perf_counter(), time.thread_time()
+            memory_start()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                wall += time.perf_counter() - start_wall
+                cpu += time.thread_time() - start_cpu
+                chunk_peak = memory_stop()
+                if chunk_peak is not None:
+                    peak = max(peak or 0, chunk_peak)
+            record['bytes_out'] += len(chunk[0])
+            yield chunk
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        finish(record, wall, cpu, peak)
+
+
+def load_module(name):
+    # Imports a dependency on first use, the import is traced as a stage of its own
+    module = sys.modules.get(name)
+    if module is None:
+        with stage('import', module=name):
+            module = importlib.import_module(name)
+    return module
+
+
+# In import order, modules that several of them share count for the first one
+DEPENDENCIES = ('numpy', 'PIL.Image', 'xml.etree.ElementTree', 'cairocffi', 'cairosvg.surface',
+                'tkinter', 'PIL.ImageTk', 'pw0_utils', 'pw0_converter_cli')
+
+IMPORT_SCRIPT = '''
+import importlib, json, sys, time
+times = []
+for name in sys.argv[1:]:
+    start = time.perf_counter()
+    try:
+        importlib.import_module(name)
+        times.append([name, time.perf_counter() - start])
+    except Exception:   # missing, or e.g. cairocffi without the cairo library
+        times.append([name, None])
+print(json.dumps(times))
+'''
+
+
+def import_report(modules=DEPENDENCIES):
+    # [module, seconds] of importing every module in a fresh interpreter, seconds is None if it's missing
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, *modules], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if os.environ.get('PW0_TRACE'):
+    add_sink(JsonLinesSink(os.environ['PW0_TRACE']))
+
+
+if __name__ == '__main__':
+    report = import_report()
+    print(f"{'module':<26}{'import, ms':>12}")
+    for name, seconds in report:
+        print(f"{name:<26}{'missing' if seconds is None else f'{seconds * 1000:.1f}':>12}")
+    print(f"{'total':<26}{sum(seconds or 0 for _, seconds in report) * 1000:>12.1f}")
@@ -1,33 +1,47 @@
-import re
 import os
+import mmap
 import subprocess
 import struct
-import xml.etree.ElementTree as ET
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from PIL import Image, ImageOps
-from cairosvg import svg2png
+from pw0_bitmap import BAND_ROWS, PackedBitmap, VirtualCanvas, merge_runs, nearest_indices
+from pw0_file import LayerDef, LayerDefSection, PW0File
+import pw0_format
+import pw0_trace
+from pw0_trace import load_module, report_progress
+
+
+# Read once at import, os.umask() can only be read by setting it, which isn't thread safe
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 def is_gbr(filename):
-    patterns = [
-        r'FSLAX',
-        r'%MOMM.*%' + '|' + r'%MOIN.*%',
-        r'M02.*'
-    ]
+    return pw0_format.file_kind(filename) == 'gerber'
 
-    with open(filename, 'r') as file:
-        content = file.read()
 
-    return all(re.search(pattern, content) for pattern in patterns)
 
+def gerbv_version(gerbv):
+    # First line of `gerbv --version`, or None if it isn't gerbv or doesn't start
+    try:
+        retn = subprocess.run([gerbv, '--version'], capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    output = retn.stdout.decode(errors='replace')
+    return output.splitlines()[0] if output.startswith('gerbv ') else None
 
 
-def gerber_to_png(filenames, output_svg, output_png, gerbv, disp_res, dpi):
+
+@pw0_trace.traced('gerbv')
+def gerber_to_svg(filenames, gerbv, disp_res, dpi):
     color_bg = "#000000"
     color_fg = "#FFFFFF"
     h_inch = disp_res[0] / dpi
     w_inch = disp_res[1] / dpi
     print('\n---VECTORIZING GERBER/EXCELLON---')
+    report_progress('vectorize')
     
     args = []
     filenames = sorted(filenames, key=is_gbr) # put excellon files before gerbers for proper rendering
@@ -35,311 +49,422 @@ def gerber_to_png(filenames, output_svg, output_png, gerbv, disp_res, dpi):
         flip_colors = is_gbr(filename)
         args += ['--background=' + (color_bg, color_fg)[flip_colors],
                  '--foreground=' + (color_fg, color_bg)[flip_colors], filename]
-    args += ["--border=0", f"--window_inch={h_inch:.6f}x{w_inch:.6f}", "--export=svg", "--output=" + output_svg]
-    print(args)
-    subprocess.run([gerbv, *args])
-    
+
+    # gerbv can only export to a file, it's read back and removed right away
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_svg = os.path.join(work_dir, "output.svg")
+        args += ["--border=0", f"--window_inch={h_inch:.6f}x{w_inch:.6f}", "--export=svg", "--output=" + output_svg]
+        print(args)
+        with subprocess.Popen([gerbv, *args]) as process:
+            try:
+                while True: # give the listeners a chance to stop gerbv
+                    try:
+                        process.wait(timeout=0.1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        report_progress('vectorize')
+            except BaseException:
+                process.kill()
+                raise
+        with open(output_svg, 'rb') as file:
+            return file.read()
+
+
+
+@pw0_trace.traced('svg_patch')
+def svg_set_crisp_edges(svg_data):
+    # Add the CSS property shape-rendering:crispEdges to SVG data
+    print('\n---PATCHING VECTOR---')
+
+    ET = load_module('xml.etree.ElementTree')
+    namespaces = {'svg': 'http://www.w3.org/2000/svg'}
+    ET.register_namespace('', namespaces['svg'])
+    root = ET.fromstring(svg_data)
+
+    if root.get('shape-rendering') != 'crispEdges':
+        root.set('shape-rendering', 'crispEdges')
+
+    return ET.tostring(root)
+
+
+
+@pw0_trace.traced('rasterize')
+def rasterize_svg(svg_data, width, height):
+    # Renders SVG data into an RGBA image straight from the cairo surface, without a PNG round trip
+    Image = load_module('PIL.Image')
     print('\n---RASTERIZING VECTOR---')
-    svg_disable_antialiasing(output_svg, output_svg)
-    
-    svg2png(url = output_svg, write_to = output_png,
-                     output_width = disp_res[0], output_height = disp_res[1])
+    report_progress('rasterize')
+    Tree, PNGSurface = svg_backend()
+    surface = PNGSurface(Tree(bytestring=svg_data), None, 96,
+                         output_width=width, output_height=height)
+    surface.cairo.flush()
+    # cairo keeps premultiplied native-endian ARGB32, which is BGRa in memory on little-endian machines
+    return Image.frombuffer('RGBA', (surface.width, surface.height), memoryview(surface.cairo.get_data()),
+                            'raw', 'BGRa', surface.cairo.get_stride(), 1)
+
+
+
+def binarize_band(band):
+    # Thresholds a few rows of an image into a PackedBitmap
+    Image = load_module('PIL.Image')
+    if band.mode != 'RGBA':
+        band = band.convert('RGBA')
+    white_background = Image.new("RGBA", band.size, (255, 255, 255, 255))
+    combined = Image.alpha_composite(white_background, band)
+    grayscale = combined.convert('L')
+    return PackedBitmap.from_image(grayscale.point(lambda p: 255 if p > 1 else 0, '1'))
 
 
+
+@pw0_trace.traced('binarize')
+def binarize_image(image, band_rows=BAND_ROWS):
+    # Thresholds the image band by band, full size 8-bit copies are never made
     print('\n---BINARIZING IMAGE---')
-    Image.MAX_IMAGE_PIXELS = None   # disable image size limit
+    width, height = image.size
+    bitmap = PackedBitmap.blank(width, height)
+    for top in range(0, height, band_rows):
+        report_progress('binarize', top / height)
+        band = image.crop((0, top, width, min(top + band_rows, height)))
+        bitmap.bits[top:top + band.height] = binarize_band(band).bits
 
-    image = Image.open(output_png)
+    return bitmap
 
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    combined = Image.alpha_composite(white_background, image)
-    grayscale = combined.convert('L')
-    binary_image = grayscale.point(lambda p: 255 if p > 1 else 0)
 
-    print('\n---CENTERING IMAGE---')
-    inverted_image = ImageOps.invert(binary_image)
-    bbox = inverted_image.getbbox()
-    #print(bbox)
-    if bbox:
-        cropped_image = binary_image.crop(bbox)
-        new_image = Image.new("L", binary_image.size, (255))
-        paste_position = ((binary_image.size[0] - cropped_image.size[0]) // 2,
-                          (binary_image.size[1] - cropped_image.size[1]) // 2)
-        
-        new_image.paste(cropped_image, paste_position)
-    else:
-        new_image = inverted_image
-    print('\n---SAVING TO PNG---')
 
-    new_image.save(output_png, format='PNG')
-    print(f"Processed image saved to {output_png}")
-        
-    w_mm = cropped_image.size[0] * 25.4 / dpi
-    h_mm = cropped_image.size[1] * 25.4 / dpi
-    #print(f"\nBoard dimensions: {w_mm:.4f}x{h_mm:.4f} mm")
-    return [w_mm, h_mm]
+@pw0_trace.traced('binarize')
+def binarize_png(input_png, size, band_rows=BAND_ROWS):
+    '''
+            Same as binarize_image(Image.open(input_png)).resize(size), but the PNG is
+            decoded band by band and only the scaled bitmap is kept. Every band is
+            thresholded and its rows and columns picked before the next one is read
+    '''
 
+    np = load_module('numpy')
+    pw0_png = load_module('pw0_png')
+    print('\n---BINARIZING AND SCALING PNG---')
+    width, height = size
+    source_width, source_height = pw0_png.png_layout(input_png)[:2]
+    columns = nearest_indices(source_width, width)
+    rows = nearest_indices(source_height, height)
 
+    # Only the source rows that end up in the output are thresholded, each of them once
+    scaled = PackedBitmap.blank(width, height)
+    for source_rows, band in pw0_png.png_bands(input_png, band_rows, np.unique(rows)):
+        report_progress('binarize', source_rows[0] / source_height)
+        first, last = np.searchsorted(rows, [source_rows[0], source_rows[-1] + 1])
+        pixels = binarize_band(band).unpack_rows(0, band.height)
+        scaled.set_rows(first, pixels[np.searchsorted(source_rows, rows[first:last])][:, columns])
 
-def svg_disable_antialiasing(input_svg, output_svg):
-    # Add the CSS property shape-rendering:crispEdges to an SVG file
-    print('\n---PATCHING VECTOR---')  
-    
-    tree = ET.parse(input_svg)
-    root = tree.getroot()
-    
-    namespaces = {'svg': 'http://www.w3.org/2000/svg'}
-    ET.register_namespace('', namespaces['svg'])
-    
-    if root.get('shape-rendering') != 'crispEdges':
-        root.set('shape-rendering', 'crispEdges')
-        
-    tree.write(output_svg)
+    return scaled
 
 
-def svg_to_png(size_mm, printer_resolution, printer_dpi, input_svg, output_png):
-    print('\n---RASTERIZING VECTOR---')
-    h_res = round(printer_dpi * size_mm[0] / 25.4)
-    v_res = round(printer_dpi * size_mm[1] / 25.4)
-    output_img_width = printer_resolution[0]
-    output_img_height = printer_resolution[1]
-    print(f"SVG TO PNG: {size_mm[0]}x{size_mm[1]}mm at {printer_dpi:.2f} DPI - {h_res}x{v_res} px") 
-    svg2png(url = input_svg, write_to = output_png,
-                     output_width = h_res, output_height = v_res)
-    
-    print('\n---BINARIZING IMAGE---')
-    Image.MAX_IMAGE_PIXELS = None   # disable image size limit
-    image = Image.open(output_png)
 
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    combined = Image.alpha_composite(white_background, image)
-    grayscale = combined.convert('L')
-    binary_image = grayscale.point(lambda p: 255 if p > 1 else 0)
+@pw0_trace.traced('center')
+def center_image(bitmap):
+    # Moves the board to the center of the bitmap, returns [VirtualCanvas, board size in px]
+    print('\n---CENTERING IMAGE---')
+    bbox = bitmap.getbbox()
+    #print(bbox)
+    if not bbox:
+        return [bitmap.invert(), (0, 0)]
+
+    cropped = bitmap.crop(bbox)
+    new_bitmap = VirtualCanvas(bitmap.width, bitmap.height)
+    paste_position = ((bitmap.width - cropped.width) // 2,
+                      (bitmap.height - cropped.height) // 2)
+    new_bitmap.place(cropped, paste_position)
+    return [new_bitmap, cropped.size]
+
 
+
+@pw0_trace.traced('pad')
+def pad_image(bitmap, printer_resolution):
     print('\n---PADDING---')
-    orig_width, orig_height = binary_image.size
+    output_img_width = printer_resolution[0]
+    output_img_height = printer_resolution[1]
+    orig_width, orig_height = bitmap.size
     # Check if padding is needed
     if orig_width >= output_img_width or orig_height >= output_img_height:
         print(f"Target size ({output_img_width}, {output_img_height}) is smaller than or equal to the current image size ({orig_width}, {orig_height}). No padding needed.")
-        padded_image = binary_image
+        return bitmap
+
+    # The margins are only virtual, see VirtualCanvas
+    padded_bitmap = VirtualCanvas(output_img_width, output_img_height)
+
+    # Place original image in the center of the canvas
+    pad_width = (output_img_width - orig_width) // 2
+    pad_height = (output_img_height - orig_height) // 2
+    paste_position = (pad_width, pad_height)
+    padded_bitmap.place(bitmap, paste_position)
+    return padded_bitmap
+
+
+
+def save_debug_file(debug_dir, file_name, data):
+    # Intermediate files are only written when a debug directory is given
+    if debug_dir is None:
+        return
+    os.makedirs(debug_dir, exist_ok=True)
+    path = os.path.join(debug_dir, file_name)
+    if isinstance(data, (PackedBitmap, VirtualCanvas)):
+        data.to_image().save(path, format='PNG')
     else:
-        padded_image = Image.new(
-                'L', (output_img_width, output_img_height), "white") 
-
-        # Paste original image in the center of a new image
-        pad_width = (output_img_width - orig_width) // 2
-        pad_height = (output_img_height - orig_height) // 2
-        paste_position = (pad_width, pad_height)
-        padded_image.paste(binary_image, paste_position)
-    
-    print('\n---SAVING TO PNG---')
-    padded_image.save(output_png, format='PNG')
-    print(f"Processed image saved to {output_png}")
+        with open(path, 'wb') as file:
+            file.write(data)
+    print(f"Intermediate file saved to {path}")
 
-    return padded_image   
 
 
+def svg_backend():
+    # cairosvg loads the cairo library, so it's only imported once an SVG is rendered
+    Tree = load_module('cairosvg.parser').Tree
+    PNGSurface = load_module('cairosvg.surface').PNGSurface
+    return [Tree, PNGSurface]
 
-def process_png(size_mm, printer_resolution, printer_dpi, source_dpi, input_png, output_png):
-    Image.MAX_IMAGE_PIXELS = None   # disable image size limit
-    output_img_width = printer_resolution[0]
-    output_img_height = printer_resolution[1]
 
-    image = Image.open(input_png)
 
-    print('\n---BINARIZING IMAGE---')
-    image = image.convert("RGBA")
-    white_background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-    combined = Image.alpha_composite(white_background, image)
-    grayscale = combined.convert('L')
-    binary_image = grayscale.point(lambda p: 255 if p > 1 else 0)
+_band_surface = None
 
-    print('\n---SCALING---')
-    scale_factor = printer_dpi / source_dpi
-    new_width = round(binary_image.width * scale_factor)
-    new_height = round(binary_image.height * scale_factor)
-    scaled_image = binary_image.resize((new_width, new_height), Image.NEAREST)
-    
-    print('\n---PADDING---')
-    orig_width, orig_height = scaled_image.size
-    # Check if padding is needed
-    if orig_width >= output_img_width or orig_height >= output_img_height:
-        print(f"Target size ({output_img_width}, {output_img_height}) is smaller than or equal to the current image size ({orig_width}, {orig_height}). No padding needed.")
-        padded_image = scaled_image
-    else:
-        padded_image = Image.new(
-                'L', (output_img_width, output_img_height), "white") 
-
-        # Paste original image in the center of a new image
-        pad_width = (output_img_width - orig_width) // 2
-        pad_height = (output_img_height - orig_height) // 2
-        paste_position = (pad_width, pad_height)
-        padded_image.paste(scaled_image, paste_position)
-    
-    print('\n---SAVING TO PNG---')
-    padded_image.save(output_png, format='PNG')
-    print(f"Processed image saved to {output_png}")
 
-    return padded_image
+def band_surface_class():
+    # BandSurface subclasses cairosvg's PNGSurface, so it's made on first use too
+    global _band_surface
+    if _band_surface is not None:
+        return _band_surface
 
+    cairocffi = load_module('cairocffi')
+    PNGSurface = svg_backend()[1]
 
+    class BandSurface(PNGSurface):
+        # Renders one band of rows of a canvas, with the SVG drawn at an offset inside the canvas
 
-def read_pw0_file(file_path):
-    print('\n--- LOADING PW0 FILE ---')
-    with open(file_path, 'rb') as file:
-        data = file.read()
-        check_word = 'pw0Img'
-        check_bytes = check_word.encode('utf-8')
-        check_addr = data.find(check_bytes) 
-        if check_addr != -1:
-            print("PW0 data found")
-        else:
-            raise ValueError("PW0 data not found")
-            return
+        def __init__(self, tree, canvas_width, band_top, band_height, offset, output_width, output_height):
+            self.canvas_width = canvas_width
+            self.band_top = band_top
+            self.band_height = band_height
+            self.offset = offset
+            self.offset_applied = False
+            super().__init__(tree, None, 96, output_width=output_width, output_height=output_height)
 
-        return(data)
+        def _create_surface(self, width, height):
+            cairo_surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, self.canvas_width, self.band_height)
+            return cairo_surface, self.canvas_width, self.band_height
 
+        def set_context_size(self, *args):
+            if not self.offset_applied:  # nested <svg> elements set the context size again
+                self.context.translate(self.offset[0], self.offset[1] - self.band_top)
+                self.offset_applied = True
+            super().set_context_size(*args)
 
+    _band_surface = BandSurface
+    return _band_surface
 
-def parse_header(data):
-    print('\n--- PARSING HEADER ---')
-    pix_size_offset = 16
-    exp_time_offset = 32
-    disp_width_offset = 60
-    disp_height_offset = 64
 
-    header_word = 'HEADER'
-    word_bytes = header_word.encode('utf-8')
-    header_addr = data.find(word_bytes)
-    if header_addr != -1:
-        print(f"'{header_word}' found at offset: 0x{header_addr:08X}")
-    else:
-        raise ValueError("File header not found")
-        return
 
-    if (header_addr + disp_height_offset) >= len(data):
-        raise ValueError("Header data out of bounds")
-        return
+def rasterize_svg_bands(svg_data, canvas_size, svg_size, offset=(0, 0), band_rows=BAND_ROWS):
+    # Yields the canvas as RGBA bands, only one band is held in memory at a time
+    Image = load_module('PIL.Image')
+    print('\n---RASTERIZING VECTOR IN BANDS---')
+    Tree = svg_backend()[0]
+    BandSurface = band_surface_class()
+    tree = Tree(bytestring=svg_data)
+    canvas_width, canvas_height = canvas_size
+    for band_top in range(0, canvas_height, band_rows):
+        report_progress('rasterize', band_top / canvas_height)
+        band_height = min(band_rows, canvas_height - band_top)
+        surface = BandSurface(tree, canvas_width, band_top, band_height, offset, *svg_size)
+        surface.cairo.flush()
+        yield Image.frombuffer('RGBA', (canvas_width, band_height), memoryview(surface.cairo.get_data()),
+                               'raw', 'BGRa', surface.cairo.get_stride(), 1)
 
-    # Parse LCD pixel size
-    pix_size_addr = header_addr + pix_size_offset
-    pixel_size = data[pix_size_addr:pix_size_addr + 4]
-    pixel_size = struct.unpack('<f', pixel_size)[0]  # Unpack the bytes as a little-endian fp32
-    print(f"Pixel size: {pixel_size:.1f} um")
 
-    # Parse exposure time
-    exp_time_addr = header_addr + exp_time_offset
-    exp_time = data[exp_time_addr:exp_time_addr + 4]
-    exp_time = struct.unpack('<f', exp_time)[0]
-    print(f"Exposure time: {exp_time:.1f} sec")
 
-    # Parse display horizontal resolution
-    disp_width_addr = header_addr + disp_width_offset
-    disp_width = data[disp_width_addr:disp_width_addr + 4]
-    disp_width = struct.unpack('<I', disp_width)[0]  # Unpack the bytes as a little-endian uint32
-    print(f"Horizontal resolution: {disp_width} px")
+def svg_band_blocks(svg_data, canvas_size, svg_size, offset, invert, mirror, band_rows=BAND_ROWS):
+    # Flat pixel blocks for rll_encode_blocks(), binarized and transformed one band at a time
+    for band in rasterize_svg_bands(svg_data, canvas_size, svg_size, offset, band_rows):
+        bitmap = transform_image(binarize_band(band), invert, mirror)
+        yield from bitmap.row_blocks(band_rows)
 
-    disp_height_addr = header_addr + disp_height_offset
-    disp_height = data[disp_height_addr:disp_height_addr + 4]
-    disp_height = struct.unpack('<I', disp_height)[0]
-    print(f"Vertical resolution: {disp_height} px")
 
-    return [pixel_size, disp_width, disp_height, exp_time_addr]
 
+def svg_bands_bbox(svg_data, canvas_size, band_rows=BAND_ROWS):
+    # Bounding box of the black pixels, found without holding the whole image
+    bbox = None
+    band_top = 0
+    for band in rasterize_svg_bands(svg_data, canvas_size, canvas_size, band_rows=band_rows):
+        band_bbox = binarize_band(band).getbbox()
+        if band_bbox:
+            left, top, right, bottom = band_bbox
+            top += band_top
+            bottom += band_top
+            if bbox:
+                left, top = min(left, bbox[0]), min(top, bbox[1])
+                right, bottom = max(right, bbox[2]), max(bottom, bbox[3])
+            bbox = (left, top, right, bottom)
+        band_top += band.height
+    return bbox
 
 
-# Returns a string with printer name
-def parse_model(data):
-    print('\n--- PARSING MODEL ---')
-    model_offset = 16
-    model_word = 'MACHINE'
 
-    word_bytes = model_word.encode('utf-8')
-    machine_addr = data.find(word_bytes)
-    if machine_addr != -1:
-        print(f"'{model_word}' found at offset: 0x{machine_addr:08X}")
-    else:
-        raise ValueError("Printer model not found")
-        return
+def encode_gerber_bands(filenames, gerbv, disp_res, dpi, invert, mirror, band_rows=BAND_ROWS):
+    '''
+            Band mode of render_gerber() + rll_encode_stream(), peak memory is bounded by
+            band_rows instead of the panel size. The vector is rendered twice: once to find
+            the board, once through a viewport moved so that the board ends up centered
+    '''
 
-    model_addr = machine_addr + model_offset
-    if model_addr >= len(data): # Ensure offset is within bounds
-        raise ValueError("Model address out of bounds")
-        return
+    svg_data = svg_set_crisp_edges(gerber_to_svg(filenames, gerbv, disp_res, dpi))
+
+    print('\n---CENTERING IMAGE---')
+    bbox = svg_bands_bbox(svg_data, disp_res, band_rows)
+    if not bbox:
+        raise ValueError("Nothing to print, the rendered image is empty")
+    left, top, right, bottom = bbox
+    offset = ((disp_res[0] - (right - left)) // 2 - left,
+              (disp_res[1] - (bottom - top)) // 2 - top)
+
+    print('\n---ENCODING TO RLL---')
+    blocks = svg_band_blocks(svg_data, disp_res, disp_res, offset, invert, mirror, band_rows)
+    return pw0_trace.traced_chunks('encode_bands', rll_encode_blocks(blocks), size=list(disp_res))
 
-    string_bytes = []
-    # Get printer name
-    for i in range(model_addr, len(data)):
-        if data[i] == 0:  
-            break
-        string_bytes.append(data[i])
 
-    # Convert the collected bytes to a string
-    result_string = bytes(string_bytes).decode('utf-8')
-    print(f"Printer model: {result_string}")
 
-    return result_string
+def encode_svg_bands(size_mm, printer_resolution, printer_dpi, input_svg, invert, mirror, band_rows=BAND_ROWS):
+    # Band mode of render_svg() + rll_encode_stream()
+    h_res = round(printer_dpi * size_mm[0] / 25.4)
+    v_res = round(printer_dpi * size_mm[1] / 25.4)
+    print(f"SVG TO PNG: {size_mm[0]}x{size_mm[1]}mm at {printer_dpi:.2f} DPI - {h_res}x{v_res} px") 
+    if h_res > printer_resolution[0] or v_res > printer_resolution[1]:
+        raise ValueError("PCB size is larger than printer's display")
 
+    with open(input_svg, 'rb') as file:
+        svg_data = svg_set_crisp_edges(file.read())
 
+    # Same position as pad_image() gives
+    offset = ((printer_resolution[0] - h_res) // 2, (printer_resolution[1] - v_res) // 2)
 
-def parse_layer(data):
-    print('\n--- PARSING LAYERS ---')
-    layer_num_offset = 16
-    img_data_addr_offset = 20
-    img_size_offset = 24
-    exposure_time_offset = 36
-    white_pix_num_offset = 44
-    layer_word = 'LAYERDEF'
+    print('\n---ENCODING TO RLL---')
+    blocks = svg_band_blocks(svg_data, printer_resolution, (h_res, v_res), offset, invert, mirror, band_rows)
+    return pw0_trace.traced_chunks('encode_bands', rll_encode_blocks(blocks), size=list(printer_resolution))
 
-    word_bytes = layer_word.encode('utf-8')
-    layer_addr = data.find(word_bytes)  # Search for the word 'LAYERDEF'
-    if layer_addr != -1:
-        print(f"'{layer_word}' found at offset: 0x{layer_addr:08X}")
+
+
+def render_gerber(filenames, gerbv, disp_res, dpi, debug_dir=None, renderer='native', workers=None, layer_cache=None):
+    '''
+            In-memory Gerber pipeline, returns [image, [board width mm, board height mm]].
+            The native renderer draws every file into its own bitmap in parallel and
+            combines them, the bitmaps are kept in layer_cache (a RenderCache) if given.
+            gerbv is used when it's asked for or when the files use something the native
+            renderer doesn't support
+    '''
+
+    binary_image = None
+    if renderer == 'native':
+        print('\n---RASTERIZING GERBER/EXCELLON---')
+        report_progress('rasterize')
+        try:
+            binary_image = load_module('pw0_gerber').render_files(filenames, disp_res, dpi, workers, layer_cache)
+        except ValueError as e:
+            if not gerbv:
+                raise
+            print(f"Native renderer failed: {e}. Falling back to gerbv")
+
+    if binary_image is None:
+        svg_data = svg_set_crisp_edges(gerber_to_svg(filenames, gerbv, disp_res, dpi))
+        save_debug_file(debug_dir, "output.svg", svg_data)
+        binary_image = binarize_image(rasterize_svg(svg_data, disp_res[0], disp_res[1]))
+
+    new_image, board_size = center_image(binary_image)
+    save_debug_file(debug_dir, "padded.png", new_image)
+
+    w_mm = board_size[0] * 25.4 / dpi
+    h_mm = board_size[1] * 25.4 / dpi
+    #print(f"\nBoard dimensions: {w_mm:.4f}x{h_mm:.4f} mm")
+    return [new_image, [w_mm, h_mm]]
+
+
+
+def render_svg(size_mm, printer_resolution, printer_dpi, input_svg, debug_dir=None):
+    h_res = round(printer_dpi * size_mm[0] / 25.4)
+    v_res = round(printer_dpi * size_mm[1] / 25.4)
+    print(f"SVG TO PNG: {size_mm[0]}x{size_mm[1]}mm at {printer_dpi:.2f} DPI - {h_res}x{v_res} px") 
+
+    with open(input_svg, 'rb') as file:
+        svg_data = svg_set_crisp_edges(file.read())
+    save_debug_file(debug_dir, "output.svg", svg_data)
+
+    binary_image = binarize_image(rasterize_svg(svg_data, h_res, v_res))
+    padded_image = pad_image(binary_image, printer_resolution)
+    save_debug_file(debug_dir, "padded.png", padded_image)
+    return padded_image
+
+
+
+def render_png(size_mm, printer_resolution, printer_dpi, source_dpi, input_png, debug_dir=None):
+    Image = load_module('PIL.Image')
+    pw0_png = load_module('pw0_png')
+    Image.MAX_IMAGE_PIXELS = None   # disable image size limit
+    streamable = pw0_png.png_streamable(input_png)
+    with Image.open(input_png) as image:
+        scale_factor = printer_dpi / source_dpi
+        new_width = round(image.width * scale_factor)
+        new_height = round(image.height * scale_factor)
+        binary_image = None if streamable else binarize_image(image)
+
+    if streamable:
+        # Large scans never need the whole source image in memory
+        scaled_image = binarize_png(input_png, (new_width, new_height))
     else:
-        raise ValueError("Layer information not found")
-        return
+        print('\n---SCALING---')
+        with pw0_trace.stage('scale', size=[new_width, new_height]):
+            scaled_image = binary_image.resize((new_width, new_height))
 
-    if (layer_addr + white_pix_num_offset) >= len(data): # Ensure largest offset is within bounds
-        raise ValueError("Layer data out of bounds")
-        return
+    padded_image = pad_image(scaled_image, printer_resolution)
+    save_debug_file(debug_dir, "padded.png", padded_image)
+    return padded_image
 
-    # Read amount of layers
-    layer_num_addr = layer_addr + layer_num_offset
-    layer_num = data[layer_num_addr:layer_num_addr + 4]
-    value = struct.unpack('<I', layer_num)[0]  # Unpack the bytes as a little-endian uint32
-    print(f"Layer amount: {value}")
-    if value > 1:
-        print("WARNING: FOUND MORE THAN ONE LAYER IN THE FILE, PATCHING MAY NOT WORK!")
-
-    # Read exposure time    
-    exposure_time_addr = layer_addr + exposure_time_offset
-    exposure_time = data[exposure_time_addr:exposure_time_addr + 4]
-    exposure_time = struct.unpack('<f', exposure_time)[0]  # Unpack the bytes as a little-endian fp32
-    print(f"Exposure time: {exposure_time:.1f} sec at 0x{exposure_time_addr:08X}")
-
-    # Read the amount of white pixels in layer image
-    white_pix_num_addr = layer_addr + white_pix_num_offset
-    white_pix_num = data[white_pix_num_addr:white_pix_num_addr + 4]
-    value = struct.unpack('<I', white_pix_num)[0]
-    print(f"Number of white pixels in layer image: {value} at 0x{white_pix_num_addr:08X}")
-
-    # Read the image data address
-    img_data_loc_addr = layer_addr + img_data_addr_offset
-    img_data_addr = data[img_data_loc_addr:img_data_loc_addr + 4]
-    img_data_addr = struct.unpack('<I', img_data_addr)[0]
-    print(f"Layer image data address: 0x{img_data_addr:08X}")
-
-    # Read the image data size
-    img_size_addr = layer_addr + img_size_offset
-    int32_bytes = data[img_size_addr:img_size_addr + 4]
-    value = struct.unpack('<I', int32_bytes)[0]
-    print(f"Compressed image data size: {value} bytes at 0x{white_pix_num_addr:08X}")
-
-    if (img_data_addr) > len(data): # Ensure image data is within bounds
-        raise ValueError("Image data out of bounds")
-        return
 
-    return [exposure_time, exposure_time_addr, white_pix_num_addr, img_data_addr, img_size_addr]
+
+# File based versions of the pipeline above, they keep the intermediate files
+
+def gerber_to_png(filenames, output_svg, output_png, gerbv, disp_res, dpi):
+    svg_data = svg_set_crisp_edges(gerber_to_svg(filenames, gerbv, disp_res, dpi))
+    with open(output_svg, 'wb') as file:
+        file.write(svg_data)
+
+    binary_image = binarize_image(rasterize_svg(svg_data, disp_res[0], disp_res[1]))
+    new_image, board_size = center_image(binary_image)
+    new_image.to_image().save(output_png, format='PNG')
+    print(f"Processed image saved to {output_png}")
+
+    w_mm = board_size[0] * 25.4 / dpi
+    h_mm = board_size[1] * 25.4 / dpi
+    return [w_mm, h_mm]
+
+
+
+def svg_disable_antialiasing(input_svg, output_svg):
+    with open(input_svg, 'rb') as file:
+        svg_data = svg_set_crisp_edges(file.read())
+    with open(output_svg, 'wb') as file:
+        file.write(svg_data)
+
+
+def svg_to_png(size_mm, printer_resolution, printer_dpi, input_svg, output_png):
+    padded_image = render_svg(size_mm, printer_resolution, printer_dpi, input_svg)
+    padded_image = padded_image.to_image()
+    padded_image.save(output_png, format='PNG')
+    print(f"Processed image saved to {output_png}")
+    return padded_image
+
+
+
+def process_png(size_mm, printer_resolution, printer_dpi, source_dpi, input_png, output_png):
+    padded_image = render_png(size_mm, printer_resolution, printer_dpi, source_dpi, input_png)
+    padded_image = padded_image.to_image()
+    padded_image.save(output_png, format='PNG')
+    print(f"Processed image saved to {output_png}")
+    return padded_image
 
 
 
@@ -393,41 +518,548 @@ def rll_encode_image(image):
 
 
 
-def patch_pw0(file_path, layer_data, rll_result, exp_time_addr2, exposure_time):
+def image_runs(pixels):
+    # Split a flat pixel array into runs of equal value, returns [values, lengths]
+    np = load_module('numpy')
+    if pixels.size == 0:
+        return [pixels[:0], np.zeros(0, dtype=np.int64)]
+
+    starts = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    lengths = np.diff(np.append(starts, pixels.size))
+    return [pixels[starts], lengths]
+
+
+
+def runs_to_words(values, lengths):
+    # Split runs longer than 0xFFF pixels and pack them into 0xCLLL words
+    np = load_module('numpy')
+    max_len = 0xFFF
+    chunks = (lengths + max_len - 1) // max_len   # words needed for every run
+    word_lengths = np.full(int(chunks.sum()), max_len, dtype=np.uint16)
+    word_lengths[np.cumsum(chunks) - 1] = lengths - (chunks - 1) * max_len   # remainder goes last
+    word_colors = np.repeat((values.astype(np.uint16) & 0xF) << 12, chunks)
+    return word_colors | word_lengths
+
+
+
+@pw0_trace.traced('encode')
+def rll_encode_image_np(image):
+    '''
+            Same output as rll_encode_image(), but run boundaries
+            are found with NumPy instead of a per-pixel loop
+    '''
+
+    np = load_module('numpy')
+    print('\n---ENCODING TO RLL---')
+    if isinstance(image, VirtualCanvas):  # margins are runs, never pixels
+        return join_rll_chunks(rll_encode_runs(image.run_blocks()))
+    if isinstance(image, PackedBitmap):  # unpack one block at a time
+        return join_rll_chunks(rll_encode_blocks(image.row_blocks()))
+
+    if image.mode != 'L':
+        image = image.convert('L')
+    pixels = np.asarray(image).ravel()
+
+    white_pixel_count = int(np.count_nonzero(pixels == 0xFF))
+    values, lengths = image_runs(pixels)
+    words = runs_to_words(values, lengths)
+
+    # rll_encode_image() never flushes the last run, keep the output identical
+    rll_data = bytearray(words[:-1].astype('>u2').tobytes())
+    rll_size = len(rll_data)
+
+    return [rll_data, rll_size, white_pixel_count]
+
+
+
+def join_rll_chunks(rll_chunks):
+    # Collects a stream of [rll_chunk, white_pixel_count] into what rll_encode_image_np() returns
+    rll_chunks = list(rll_chunks)
+    rll_data = bytearray().join(rll_chunk for rll_chunk, _ in rll_chunks)
+    return [rll_data, len(rll_data), sum(white for _, white in rll_chunks)]
+
+
+
+def rll_encode_blocks(blocks):
+    '''
+            Streaming form of rll_encode_image_np(). Takes flat pixel arrays that
+            follow each other in the image and yields [rll_chunk, white_pixel_count]
+            for each of them
+    '''
+
+    return rll_encode_runs(image_runs(pixels) for pixels in blocks)
+
+
+
+def rll_encode_runs(run_blocks):
+    '''
+            Same as rll_encode_blocks(), but takes [values, lengths] of the runs of
+            every block, see image_runs(). The run that is still open at the end
+            of a block is carried over to the next one
+    '''
+
+    np = load_module('numpy')
+    open_value = None
+    open_length = 0
+    for values, lengths in run_blocks:
+        if lengths.size == 0:
+            continue
+        white_pixel_count = int(lengths[values == 0xFF].sum())
+        if open_value is not None:
+            if values[0] == open_value:
+                lengths[0] += open_length
+            else:
+                values = np.concatenate(([open_value], values))
+                lengths = np.concatenate(([open_length], lengths))
+
+        open_value = values[-1]
+        open_length = int(lengths[-1])
+        words = runs_to_words(values[:-1], lengths[:-1])
+        yield [words.astype('>u2').tobytes(), white_pixel_count]
+
+    if open_value is not None:
+        # rll_encode_image() never flushes the last word, keep the output identical
+        words = runs_to_words(np.array([open_value]), np.array([open_length]))
+        yield [words[:-1].astype('>u2').tobytes(), 0]
+
+
+
+def image_row_blocks(image, block_rows=BAND_ROWS):
+    # Yields the pixels of an image as flat arrays of block_rows rows
+    np = load_module('numpy')
+    if isinstance(image, (PackedBitmap, VirtualCanvas)):
+        yield from image.row_blocks(block_rows)
+        return
+    if image.mode != 'L':
+        image = image.convert('L')
+    width, height = image.size
+    for top in range(0, height, block_rows):
+        block = image.crop((0, top, width, min(top + block_rows, height)))
+        yield np.asarray(block).ravel()
+
+
+
+def rll_encode_stream(image, block_rows=BAND_ROWS):
+    print('\n---ENCODING TO RLL---')
+    height = image.size[1]
+    if isinstance(image, VirtualCanvas):  # margins are runs, never pixels
+        run_blocks = image.run_blocks(block_rows)
+    else:
+        run_blocks = (image_runs(block) for block in image_row_blocks(image, block_rows))
+
+    def blocks():
+        for index, runs in enumerate(run_blocks):
+            report_progress('encode', index * block_rows / height)
+            yield runs
+
+    return pw0_trace.traced_chunks('encode', rll_encode_runs(blocks()), size=list(image.size))
+
+
+
+def encode_layers(images, workers=None):
+    # Encodes every layer image in its own process, results keep the order of images
+    if len(images) == 1 or workers == 1:
+        return [rll_encode_image_np(image) for image in images]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(rll_encode_image_np, images))
+
+
+
+def rll_runs(rll_data, white_pixel_count, resolution):
+    '''
+            Splits an RLL stream back into [values, lengths] of its runs. The
+            encoder never writes the last run, its length follows from the
+            resolution and its colour from the white pixel count
+    '''
+
+    np = load_module('numpy')
+    words = np.frombuffer(bytes(rll_data), dtype='>u2')
+    values = words >> 12
+    lengths = (words & 0xFFF).astype(np.int64)
+
+    missing = resolution[0] * resolution[1] - int(lengths.sum())
+    if missing < 0:
+        raise ValueError("RLL data is longer than the layer")
+    if missing:
+        tail_white = white_pixel_count - int(lengths[values == 0xF].sum())
+        if tail_white not in (0, missing):
+            raise ValueError("White pixel count doesn't match the RLL data")
+        values = np.append(values, 0xF if tail_white else 0x0)
+        lengths = np.append(lengths, missing)
+    return [values, lengths]
+
+
+
+def mirror_runs(values, lengths, width):
+    # Cuts the runs at the row boundaries and reverses their order in every row
+    np = load_module('numpy')
+    ends = np.cumsum(lengths)
+    row_starts = np.arange(0, int(ends[-1]), width)
+    inside = np.searchsorted(ends, row_starts, side='right')   # run that contains every row start
+    cut = row_starts != ends[inside] - lengths[inside]          # rows that start inside a run
+    cuts = np.insert(ends - lengths, inside[cut] + 1, row_starts[cut])
+    cut_values = np.insert(values, inside[cut] + 1, values[inside[cut]])
+    cut_lengths = np.diff(np.append(cuts, ends[-1]))
+
+    # Pieces of a row are reversed in place: first of the row + last of the row - index
+    first = np.searchsorted(cuts, row_starts)
+    last = np.append(first[1:], cuts.size) - 1
+    counts = last - first + 1
+    order = np.repeat(first + last, counts) - np.arange(cuts.size)
+    cut_values, cut_lengths = cut_values[order], cut_lengths[order]
+
+    # Neighbours of the same colour, also across rows, are one run again
+    return merge_runs(cut_values, cut_lengths)
+
+
+
+@pw0_trace.traced('transform')
+def rll_transform(rll_result, resolution, invert, mirror):
+    '''
+            Same result as encoding transform_image(image, invert, mirror), but
+            works on the runs of the encoded image. Inverting flips the colour of
+            every word, mirroring reverses the runs of every row
+    '''
+
+    np = load_module('numpy')
+    rll_data, rll_size, white_pixel_count = rll_result
+    if mirror:
+        values, lengths = rll_runs(rll_data, white_pixel_count, resolution)
+        values, lengths = mirror_runs(values, lengths, resolution[0])
+        # rll_encode_image() never flushes the last run, keep the output identical
+        rll_data = bytearray(runs_to_words(values, lengths)[:-1].astype('>u2').tobytes())
+    if invert:
+        words = np.frombuffer(bytes(rll_data), dtype='>u2') ^ np.uint16(0xF000)
+        rll_data = bytearray(words.astype('>u2').tobytes())
+        white_pixel_count = resolution[0] * resolution[1] - white_pixel_count
+    return [rll_data, len(rll_data), white_pixel_count]
+
+
+
+@pw0_trace.traced('decode')
+def rll_decode(data, img_data_addr, img_size, white_pixel_count, resolution):
+
+    '''
+            Expands 0xCLLL words back into a (height, width) uint8 array.
+            Color nibble C is scaled to 0..255, so 0xF gives a white pixel
+    '''
+
+    np = load_module('numpy')
+    print('\n---DECODING RLL---')
+    width, height = resolution
+    if img_data_addr + img_size > len(data):
+        raise ValueError("Image data out of bounds")
+
+    # The encoder doesn't store the trailing run, rll_runs() gets its color from the white pixel count
+    values, lengths = rll_runs(data[img_data_addr:img_data_addr + img_size // 2 * 2], white_pixel_count, resolution)
+    pixels = np.repeat((values * 0x11).astype(np.uint8), lengths)
+
+    return pixels.reshape(height, width)
+
+
+
+def read_layer_image(data, layer_data, display_properties):
+    # Returns the layer image stored in a printer file as a PIL image
+    Image = load_module('PIL.Image')
+    white_pixel_count = struct.unpack_from('<I', data, layer_data[2])[0]
+    img_data_addr = layer_data[3]
+    img_size = layer_data[5]
+    resolution = display_properties[1:3]
+    return Image.fromarray(rll_decode(data, img_data_addr, img_size, white_pixel_count, resolution), 'L')
+
+
+
+def pw0_to_png(file_path, output_png):
+    with PW0File(file_path) as printer_file:
+        image = read_layer_image(printer_file.data, printer_file.layer_data(), printer_file.display_properties())
+    image.save(output_png, format='PNG')
+    print(f"Layer image saved to {output_png}")
+    return image
+
+
+
+def transform_image(image, invert, mirror):
+    # Applies the GUI processing options to a rendered image, PackedBitmap or VirtualCanvas
+    Image = load_module('PIL.Image')
+    ImageOps = load_module('PIL.ImageOps')
+    if isinstance(image, (PackedBitmap, VirtualCanvas)):
+        if invert:
+            image = image.invert()
+        if mirror:
+            image = image.mirror()
+        return image
+    if invert:
+        image = ImageOps.invert(image)
+    if mirror:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    return image
+
+
+
+def patched_file_name(file_path):
+    file_name = os.path.basename(file_path)
+    name, ext = os.path.splitext(file_name)
+    return f"{name}_patched{ext}"
+
+
+
+def output_file_path(file_path, output_dir=None, file_out=None):
+    # Patched files go to output_dir, or to the working directory if it's not set
+    if file_out is None:
+        file_out = os.path.join(output_dir or '', patched_file_name(file_path))
+    out_dir = os.path.dirname(file_out)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    return file_out
+
+
+
+@contextmanager
+def atomic_write(file_out):
+    # Writes to a temp file next to file_out and renames it only if everything went well
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_out)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        # mkstemp() creates the file as 0600, it gets the mode a plain open() would have given it
+        try:
+            mode = os.stat(file_out).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_out)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+
+def verify_output(file_out):
+    # Every written file is validated, a broken one is removed rather than left for the printer
+    try:
+        load_module('pw0_validate').check_file(file_out)
+    except ValueError:
+        os.remove(file_out)
+        raise
+
+
+
+@pw0_trace.traced('write')
+def write_pw0(file_path, layer_data, rll_chunks, exp_time_addr2, exposure_time, output_dir=None, file_out=None):
     print('\n---PATCHING---')
     print(f"Exposure time: {exposure_time} sec")
-    #print(layer_data)
     exposure_time_addr = layer_data[1]
     white_pix_num_addr = layer_data[2]
     img_data_addr = layer_data[3]
     img_size_addr = layer_data[4]
 
-    rll_data = rll_result[0]
-    rll_size = rll_result[1]
-    white_pixel_count = rll_result[2]
+    file_out = output_file_path(file_path, output_dir, file_out)
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as template:
+        if img_data_addr > len(template):
+            raise ValueError("Image data out of bounds")
+
+        with atomic_write(file_out) as out:
+            # Everything before the old layer image data is copied as is
+            out.write(template[:img_data_addr])
+
+            # Add new layer image data as it's being encoded
+            rll_size = 0
+            white_pixel_count = 0
+            for rll_chunk, chunk_white_pixels in rll_chunks:
+                out.write(rll_chunk)
+                rll_size += len(rll_chunk)
+                white_pixel_count += chunk_white_pixels
+
+            report_progress('write') # the image data is written while it's encoded, only the fields are left
+            patches = [
+                (img_size_addr, '<I', rll_size),                # layer image size
+                (white_pix_num_addr, '<I', white_pixel_count),  # white pixel count
+                (exposure_time_addr, '<f', exposure_time),      # exposure time in the layer description
+                (exp_time_addr2, '<f', exposure_time),          # exposure time in the header
+            ]
+            for addr, fmt, value in patches:
+                out.seek(addr)
+                out.write(struct.pack(fmt, value))
+
+    verify_output(file_out)
+    print(f'{file_out} written, {rll_size} bytes of layer image data.')
+    return file_out
+
+
+
+@pw0_trace.traced('write')
+def patch_exposure(file_path, layer_data, exp_time_addr2, exposure_time):
+    # Rewrites only the exposure time fields of a file write_pw0() made, the image stays as is
+    print('\n---PATCHING EXPOSURE TIME---')
+    print(f"Exposure time: {exposure_time} sec")
+    with open(file_path, "r+b") as f:
+        for addr in (layer_data[1], exp_time_addr2):
+            f.seek(addr)
+            f.write(struct.pack('<f', exposure_time))
+    verify_output(file_path)
+    print(f'{file_path} patched')
+    return file_path
+
+
+
+def patch_pw0(file_path, layer_data, rll_result, exp_time_addr2, exposure_time, output_dir=None, file_out=None):
+    # Patches the layer with an already encoded image, see rll_encode_image_np()
+    rll_chunks = [[rll_result[0], rll_result[2]]]
+    return write_pw0(file_path, layer_data, rll_chunks, exp_time_addr2, exposure_time, output_dir, file_out)
 
-    with open(file_path, "rb") as f:
-        original_data = bytearray(f.read())
 
-    # Remove old layer image data
-    #print(f'Layer image data address: 0x{img_data_addr:08X}')
-    new_data = original_data[:img_data_addr]
 
-    # Add new layer image data
-    new_data.extend(rll_data)
+@pw0_trace.traced('write')
+def patch_pw0_layers(file_path, layer_data, rll_results, exp_time_addr2, exposure_times, output_dir=None, file_out=None):
+    print('\n---PATCHING LAYERS---')
+    if len(rll_results) != len(exposure_times):
+        raise ValueError("Every layer needs its own exposure time")
 
-    # Patch layer image size
-    new_data[img_size_addr:img_size_addr + 4] = struct.pack('<I', rll_size)
-    # Patch white pixel count
-    new_data[white_pix_num_addr:white_pix_num_addr + 4] = struct.pack('<I', white_pixel_count)
-    # Patch exposure time in the layer description
-    new_data[exposure_time_addr:exposure_time_addr + 4] = struct.pack('<f', exposure_time)
+    img_data_addr = layer_data[3]
+    with PW0File(file_path) as printer_file:
+        if img_data_addr > len(printer_file.data):
+            raise ValueError("Image data out of bounds")
+        layers = printer_file.layers
+        layer_num = len(layers)
+        section_length = layers.length
+        section_table = printer_file.section_table()
+        original_data = bytearray(printer_file.data[:img_data_addr])
+
+    layer_addr = layers.addr
+    table_addr = layer_addr + LayerDefSection.table_offset
+    table_end = table_addr + layer_num * LayerDef.size
+    if layer_num == 0 or table_end > img_data_addr:
+        raise ValueError("Layer table out of bounds")
+
+    # Everything behind the old table moves by the size difference of the new one
+    shift = (len(rll_results) - layer_num) * LayerDef.size
+    template_def = original_data[table_addr:table_addr + LayerDef.size]
+
+    layer_table = bytearray()
+    data_addr = img_data_addr + shift
+    stored = {}     # id of rll_data -> its address, layers that share one image point at a single copy
+    for (rll_data, rll_size, white_pixel_count), exposure_time in zip(rll_results, exposure_times):
+        print(f"Layer {len(layer_table) // LayerDef.size}: {rll_size} bytes, exposure time {exposure_time} sec")
+        if id(rll_data) not in stored:
+            stored[id(rll_data)] = data_addr
+            data_addr += rll_size
+        layer_def = bytearray(template_def) # lift and layer height settings stay as in the template
+        struct.pack_into('<I', layer_def, LayerDef.field_offset('img_data_addr'), stored[id(rll_data)])
+        struct.pack_into('<I', layer_def, LayerDef.field_offset('img_size'), rll_size)
+        struct.pack_into('<f', layer_def, LayerDef.field_offset('exposure_time'), exposure_time)
+        struct.pack_into('<I', layer_def, LayerDef.field_offset('white_pix_num'), white_pixel_count)
+        layer_table.extend(layer_def)
+
+    new_data = original_data[:table_addr]
+    new_data.extend(layer_table)
+    new_data.extend(original_data[table_end:img_data_addr])
+
+    # Patch layer amount and LAYERDEF section length
+    struct.pack_into('<I', new_data, layers.field_addr('layer_num'), len(rll_results))
+    struct.pack_into('<I', new_data, layers.field_addr('length'), section_length + shift)
+    # Patch addresses of the sections that moved
+    for field_addr, section_addr in section_table:
+        if section_addr >= table_end:
+            struct.pack_into('<I', new_data, field_addr, section_addr + shift)
     # Patch exposure time in the header
-    new_data[exp_time_addr2:exp_time_addr2 + 4] = struct.pack('<f', exposure_time)
-    
-    file_name = os.path.basename(file_path)
-    name, ext = os.path.splitext(file_name)
-    file_out = f"{name}_patched{ext}"
-    with open(file_out, "wb") as f:
-        f.write(new_data)
-    print(f'{file_out} written to the script directory.')
+    new_data[exp_time_addr2:exp_time_addr2 + 4] = struct.pack('<f', exposure_times[0])
+
+    file_out = output_file_path(file_path, output_dir, file_out)
+    with atomic_write(file_out) as out:
+        out.write(new_data)
+        written = set()
+        for rll_result in rll_results:
+            if id(rll_result[0]) not in written:
+                written.add(id(rll_result[0]))
+                out.write(rll_result[0])
+    verify_output(file_out)
+    print(f'{file_out} with {len(rll_results)} layers written.')
+    return file_out
+
+
+
+def exposure_ladder(start, step, count):
+    # Exposure times of a calibration series
+    if count < 1:
+        raise ValueError("Exposure ladder needs at least one step")
+    if step <= 0:
+        raise ValueError("Exposure ladder step has to be positive")
+    exposure_times = [round(start + index * step, 3) for index in range(int(count))]
+    if min(exposure_times) < 0.1:
+        raise ValueError("Exposure time is too short!")
+    if len(set(exposure_times)) != len(exposure_times):    # they would be written to the same file
+        raise ValueError("Exposure ladder step is too small")
+    return exposure_times
+
+
+
+def ladder_file_path(file_out, exposure_time):
+    name, ext = os.path.splitext(file_out)
+    return f"{name}_{exposure_time:g}s{ext}"
+
+
+
+def ladder_strips(rll_result, resolution, count):
+    '''
+            Cuts the rows of an encoded image that have white pixels into count
+            strips of about the same height, returns an encoded image per strip
+            with everything outside of it black. The layers of a file are exposed
+            one after the other, so every strip only gets the time of its layer
+    '''
+
+    np = load_module('numpy')
+    width = resolution[0]
+    rll_data, rll_size, white_pixel_count = rll_result
+    values, lengths = rll_runs(rll_data, white_pixel_count, resolution)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    white = values == 0xF
+    if not white.any():
+        raise ValueError("Nothing to expose, the layer is black")
+    first_row = int(starts[white][0]) // width
+    last_row = (int(ends[white][-1]) - 1) // width + 1
+    if last_row - first_row < count:
+        raise ValueError("Exposure ladder has more steps than the board has rows")
+
+    strips = []
+    bounds = np.linspace(first_row, last_row, count + 1).round().astype(np.int64) * width
+    for top, bottom in zip(bounds[:-1], bounds[1:]):
+        # The runs clipped to the strip, with black before and after it
+        strip_values, strip_lengths = merge_runs(
+            np.concatenate(([0x0], values, [0x0])),
+            np.concatenate(([top], np.clip(ends, top, bottom) - np.clip(starts, top, bottom), [ends[-1] - bottom])))
+        # rll_encode_image() never flushes the last run, keep the output the same
+        strip_data = bytearray(runs_to_words(strip_values, strip_lengths)[:-1].astype('>u2').tobytes())
+        strips.append([strip_data, len(strip_data), int(strip_lengths[strip_values == 0xF].sum())])
+    return strips
+
+
+
+def write_exposure_ladder(file_path, layer_data, rll_result, display_properties, exposure_times, file_out,
+                          one_file=False, workers=None):
+    '''
+            Patches the template with the encoded layer for every exposure time, returns
+            the written files. Either one file per exposure time, written in parallel,
+            or one file with a layer per exposure time that each expose one strip of
+            the board, see ladder_strips()
+    '''
+
+    print('\n---EXPOSURE LADDER---')
+    print(f"Exposure times: {', '.join(f'{exposure_time:g}' for exposure_time in exposure_times)} sec")
+    exp_time_addr2 = display_properties[3]
+    if one_file:
+        name, ext = os.path.splitext(file_out)
+        file_out = f"{name}_ladder{ext}"
+        strips = ladder_strips(rll_result, display_properties[1:3], len(exposure_times))
+        return [patch_pw0_layers(file_path, layer_data, strips, exp_time_addr2, exposure_times, file_out=file_out)]
+
+    # Threads share rll_result, the writes are mostly I/O
+    def write(exposure_time):
+        return patch_pw0(file_path, layer_data, rll_result, exp_time_addr2, exposure_time,
+                         file_out=ladder_file_path(file_out, exposure_time))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(write, exposure_times))
@@ -0,0 +1,200 @@
+'''
+    Printer file validator and layer diff.
+
+    validate() checks what the printer relies on: the section table and section
+    lengths, the layer table and, for every layer, that the image data is inside
+    the file, decodes to no more pixels than the display has and matches the
+    stored white pixel count. Everything works on the 0xCLLL words of the layer
+    images, nothing is decoded to pixels, so it's cheap enough to run after every
+    patch.
+
+    diff_layers() compares a layer of two files run by run and reports how many
+    pixels differ and where.
+
+        python pw0_validate.py FILE [FILE ...]
+        python pw0_validate.py --diff FILE_A FILE_B [--layer N]
+'''
+
+import argparse
+import struct
+import sys
+
+import numpy as np
+
+import pw0_trace
+from pw0_bitmap import merge_runs
+from pw0_file import SECTION_HEADER_SIZE, LayerDef, LayerDefSection, PW0File
+from pw0_utils import rll_runs
+
+
+def layer_runs(data, layer, resolution):
+    # [values, lengths] of a layer image, the tail run the encoder leaves out included
+    addr, size = layer.img_data_addr, layer.img_size
+    if addr + size > len(data):
+        raise ValueError("Image data out of bounds")
+    if size % 2:
+        raise ValueError("Image data size is odd")
+    return rll_runs(data[addr:addr + size], layer.white_pix_num, resolution)
+
+
+def layer_problems(data, layer, resolution, table_end):
+    addr, size = layer.img_data_addr, layer.img_size
+    if addr < table_end:
+        return ["Image data overlaps the layer table"]
+
+    problems = []
+    if addr + size <= len(data):
+        words = np.frombuffer(data[addr:addr + size - size % 2], dtype='>u2')
+        colors = words >> 12
+        grey = np.count_nonzero((colors != 0x0) & (colors != 0xF))
+        if grey:
+            problems.append(f"{grey} runs are neither black nor white")
+        empty = np.count_nonzero((words & 0xFFF) == 0)
+        if empty:
+            problems.append(f"{empty} runs have zero length")
+
+    try:
+        values, lengths = layer_runs(data, layer, resolution)
+    except ValueError as error:
+        return problems + [str(error)]
+    # rll_runs() only checks the count when the last run is missing
+    white_pixel_count = int(lengths[values == 0xF].sum())
+    if white_pixel_count != layer.white_pix_num:
+        problems.append(f"White pixel count is {layer.white_pix_num}, the image has {white_pixel_count}")
+    return problems
+
+
+@pw0_trace.traced('validate')
+def validate(file_path):
+    '''
+            Checks a printer file, returns the problems found as a list of
+            messages, an empty list if the file is fine
+    '''
+
+    try:
+        printer_file = PW0File(file_path)
+    except (OSError, ValueError, struct.error) as error:
+        return [str(error)]
+
+    with printer_file:
+        data = printer_file.data
+        problems = []
+        for name in printer_file.sections:
+            section = printer_file.section(name)
+            if section.addr + SECTION_HEADER_SIZE + section.length > len(data):
+                problems.append(f"{name} section runs past the end of the file")
+
+        header = printer_file.header
+        resolution = (header.resolution_x, header.resolution_y)
+        layers = printer_file.layers
+        table_end = layers.addr + LayerDefSection.table_offset + len(layers) * LayerDef.size
+        if len(layers) == 0:
+            problems.append("File has no layers")
+        if table_end > layers.addr + SECTION_HEADER_SIZE + layers.length:
+            problems.append("Layer table is longer than the LAYERDEF section")
+        if table_end > len(data):
+            problems.append("Layer table out of bounds")
+            return problems
+
+        for index in range(len(layers)):
+            problems.extend(f"Layer {index}: {problem}"
+                            for problem in layer_problems(data, layers[index], resolution, table_end))
+    return problems
+
+
+def check_file(file_path):
+    # Raises ValueError with every problem of the file, see validate()
+    problems = validate(file_path)
+    if problems:
+        raise ValueError(f"{file_path} is broken: {'; '.join(problems)}")
+
+
+def read_layer(file_path, index):
+    # [resolution, image bytes, white pixel count, runs] of one layer
+    with PW0File(file_path) as printer_file:
+        header = printer_file.header
+        resolution = (header.resolution_x, header.resolution_y)
+        layer = printer_file.layers[index]
+        rll_data = printer_file.data[layer.img_data_addr:layer.img_data_addr + layer.img_size]
+        runs = layer_runs(printer_file.data, layer, resolution)
+        return [resolution, rll_data, layer.white_pix_num, runs]
+
+
+def diff_regions(starts, ends, width):
+    '''
+            Groups differing pixel spans into [left, top, right, bottom, pixels]
+            regions of consecutive rows. Spans that cross a row count for the
+            full width
+    '''
+
+    top_rows = starts // width
+    bottom_rows = (ends - 1) // width
+    one_row = top_rows == bottom_rows
+    lefts = np.where(one_row, starts % width, 0)
+    rights = np.where(one_row, (ends - 1) % width + 1, width)
+
+    # Spans are sorted and don't overlap, a region ends where a row without differences follows
+    breaks = np.flatnonzero(np.append(True, top_rows[1:] > bottom_rows[:-1] + 1))
+    last = np.append(breaks[1:], starts.size) - 1
+    return [[int(left), int(top), int(right), int(bottom), int(pixels)] for left, top, right, bottom, pixels in
+            zip(np.minimum.reduceat(lefts, breaks), top_rows[breaks], np.maximum.reduceat(rights, breaks),
+                bottom_rows[last] + 1, np.add.reduceat(ends - starts, breaks))]
+
+
+@pw0_trace.traced('diff')
+def diff_layers(file_a, file_b, index=0):
+    '''
+            Compares a layer of two printer files, returns [differing pixels, regions],
+            see diff_regions(). Works on the runs, the layers aren't decoded
+    '''
+
+    resolution, rll_a, white_a, (values_a, lengths_a) = read_layer(file_a, index)
+    resolution_b, rll_b, white_b, (values_b, lengths_b) = read_layer(file_b, index)
+    if resolution != resolution_b:
+        raise ValueError("Printer files have different resolutions")
+    if white_a == white_b and rll_a == rll_b:
+        return [0, []]
+
+    # Every run boundary of either file starts a segment that has one colour in both
+    values_a, lengths_a = merge_runs(values_a, lengths_a)
+    values_b, lengths_b = merge_runs(values_b, lengths_b)
+    ends_a, ends_b = np.cumsum(lengths_a), np.cumsum(lengths_b)
+    ends = np.sort(np.concatenate((ends_a, ends_b)), kind='stable')    # merges two sorted arrays
+    ends = ends[np.append(ends[1:] != ends[:-1], True)]
+    starts = np.append(0, ends[:-1])
+
+    differ = values_a[np.searchsorted(ends_a, ends)] != values_b[np.searchsorted(ends_b, ends)]
+    starts, ends = starts[differ], ends[differ]
+    if not starts.size:
+        return [0, []]
+    return [int((ends - starts).sum()), diff_regions(starts, ends, resolution[0])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate printer files or compare their layers")
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('--diff', action='store_true', help="compare a layer of two files")
+    parser.add_argument('--layer', type=int, default=0, help="layer to compare, the first one by default")
+    args = parser.parse_args()
+
+    if args.diff:
+        if len(args.files) != 2:
+            parser.error("--diff needs exactly two files")
+        pixels, regions = diff_layers(*args.files, index=args.layer)
+        print(f"{pixels} pixels differ in {len(regions)} regions")
+        for left, top, right, bottom, region_pixels in regions:
+            print(f"  x {left}..{right}, y {top}..{bottom}: {region_pixels} pixels")
+        return 1 if pixels else 0
+
+    broken = 0
+    for file_path in args.files:
+        problems = validate(file_path)
+        print(f"{file_path}: {'OK' if not problems else 'BROKEN'}")
+        for problem in problems:
+            print(f"  {problem}")
+        broken += bool(problems)
+    return 1 if broken else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())